@@ -0,0 +1,141 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from atomic_file import AtomicFile
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class ArtworkFetcher:
+    """Downloads title artwork, trying every region candidate at once, through an on-disk HTTP cache.
+
+    Cached images are revalidated with If-None-Match/If-Modified-Since once they are older than max_age, and 404s are
+    remembered for negative_ttl so missing regions aren't asked for on every build.
+    """
+    IMAGE_NAMES = ["iconTex.png", "bootTvTex.png"]
+
+    def __init__(self, cache_dir: Optional[str] = None, max_connections: int = 16, timeout: float = 30,
+                 max_age: float = 24 * 60 * 60, negative_ttl: float = 7 * 24 * 60 * 60):
+        self.cache_dir = cache_dir or os.path.join(Config.get_cache_dir(), "artwork")
+        self.timeout = timeout
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_connections)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self) -> "ArtworkFetcher":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def get_cache_paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, key[:2], key)
+        return path + ".png", path + ".json"
+
+    def fetch(self, url: str) -> Optional[bytes]:
+        """Contents of url, or None if the server doesn't have it."""
+        body_path, meta_path = self.get_cache_paths(url)
+        meta = self._read_meta(meta_path)
+        body = self._read_body(body_path) if meta.get("status") == 200 else None
+        age = time.time() - meta.get("fetched_at", 0)
+
+        if meta.get("status") == 404 and age < self.negative_ttl:
+            return None
+        if body is not None and age < self.max_age:
+            return body
+
+        headers = {}
+        if body is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if body is not None:
+                logger.warning(f"Could not revalidate {url} ({e}), using cached copy")
+                return body
+            logger.warning(f"Could not fetch {url}: {e}")
+            return None
+
+        if r.status_code == 304 and body is not None:
+            meta["fetched_at"] = time.time()
+            AtomicFile.write(meta_path, json.dumps(meta).encode("utf-8"))
+            return body
+        elif r.status_code == 404:
+            AtomicFile.write(meta_path, json.dumps({"url": url, "status": 404,
+                                                      "fetched_at": time.time()}).encode("utf-8"))
+            return None
+        elif r.status_code != 200:
+            logger.warning(f"Could not fetch {url}: HTTP {r.status_code}")
+            return None
+
+        AtomicFile.write(body_path, r.content)
+        AtomicFile.write(meta_path, json.dumps({
+            "url": url,
+            "status": 200,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }).encode("utf-8"))
+        logger.debug(f"Downloaded {url} ({len(r.content)} bytes)")
+        return r.content
+
+    def fetch_images(self, base_urls: List[str], names: Optional[List[str]] = None) -> List[Optional[bytes]]:
+        """For each image name, the image from the first base URL that has it.
+
+        All candidates are requested concurrently, so this takes about as long as the slowest single request.
+        """
+        names = names or self.IMAGE_NAMES
+        futures = [[self.executor.submit(self.fetch, base_url + name) for base_url in base_urls] for name in names]
+        return [next((data for data in (future.result() for future in candidates) if data is not None), None)
+                for candidates in futures]
+
+    def prefetch(self, base_urls: Iterable[List[str]], names: Optional[List[str]] = None) -> int:
+        """Warm the cache with the artwork of many titles at once. Returns the number of titles with full artwork."""
+        start_time = time.monotonic()
+        names = names or self.IMAGE_NAMES
+        futures = [[[self.executor.submit(self.fetch, base_url + name) for base_url in urls] for name in names]
+                   for urls in base_urls]
+        found = sum(all(any(future.result() is not None for future in candidates) for candidates in title)
+                    for title in futures)
+        logger.info(f"Prefetched artwork for {found}/{len(futures)} titles in {time.monotonic() - start_time:.1f}s")
+        return found
+
+    @staticmethod
+    def _read_meta(path: str) -> Dict[str, Any]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _read_body(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
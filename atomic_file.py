@@ -0,0 +1,72 @@
+from typing import IO, Any, Optional
+import os
+import tempfile
+
+
+class AtomicFile:
+    """Writes a file under a temporary name next to path, and only renames it to path once writing succeeded.
+
+    Readers therefore see either the old file or the whole new one, never a partial one. With sync=True, the new file
+    and its directory entry are also on disk by the time the with block exits.
+    """
+
+    def __init__(self, path: str, mode: str = "wb", prefix: Optional[str] = None, suffix: Optional[str] = None,
+                 sync: bool = False):
+        self.path = path
+        self.mode = mode
+        self.prefix = prefix
+        self.suffix = suffix
+        self.sync = sync
+        self.temp_path: Optional[str] = None
+        self.f: Optional[IO[Any]] = None
+
+    @classmethod
+    def write(cls, path: str, contents: Any, **kwargs: Any) -> None:
+        with cls(path, "w" if isinstance(contents, str) else "wb", **kwargs) as f:
+            f.write(contents)
+
+    @staticmethod
+    def sync_directory(path: str) -> None:
+        # New and renamed entries are only durable once their directory is, which Windows has no way to ask for
+        if os.name != "posix":
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __enter__(self) -> IO[Any]:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix=self.prefix, suffix=self.suffix)
+        try:
+            self.f = os.fdopen(fd, self.mode)
+        except BaseException:
+            os.close(fd)
+            os.unlink(self.temp_path)
+            raise
+        return self.f
+
+    def __exit__(self, exc_type, *args) -> None:
+        try:
+            if exc_type is None:
+                if self.sync:
+                    self.f.flush()
+                    os.fsync(self.f.fileno())
+                self.f.close()
+                os.replace(self.temp_path, self.path)
+                if self.sync:
+                    self.sync_directory(os.path.dirname(os.path.abspath(self.path)))
+                return
+        except BaseException:
+            self._discard()
+            raise
+        self._discard()
+
+    def _discard(self) -> None:
+        self.f.close()
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
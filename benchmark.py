@@ -0,0 +1,221 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+
+from build_scheduler import BuildScheduler
+from game import Title, create_title
+from synthetic_disc import SyntheticDisc
+from tools import Nfs2Iso2Nfs, WiimsISOTools
+
+logger = logging.getLogger(__name__)
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
+
+class StageResult(NamedTuple):
+    seconds: float
+    bytes: int
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+class Benchmark:
+    """Builds synthetic Wii and GameCube discs end to end and reports how long every stage took.
+
+    Results are keyed by system and stage, e.g. "wii:nfs", and are the best of all repeats. With fake_tools, wit and
+    nfs2iso2nfs are replaced by the stand-in scripts in benchmark_tools/, so the rest of the pipeline can be measured on
+    machines without the tools. The wit stand-in moves about as much data without understanding it, and the
+    nfs2iso2nfs one writes real, single core encrypted NFS parts with the native writer.
+    """
+    STAND_IN_DIR = os.path.join(project_root, "benchmark_tools")
+    STAND_INS = [(WiimsISOTools, "wit"), (Nfs2Iso2Nfs, "nfs2iso2nfs")]
+    SYSTEMS = ["wii", "gamecube"]
+
+    # A stage regresses when it gets slower than its baseline by more than this fraction...
+    DEFAULT_THRESHOLD = 0.2
+    # ...and by more than this many seconds, so near instant stages don't trip over noise
+    MIN_REGRESSION_SECONDS = 0.1
+
+    def __init__(self, work_dir: str, size: int, entropy: float = 1.0, systems: Optional[List[str]] = None,
+                 fake_tools: bool = False, repeat: int = 1):
+        self.work_dir = os.path.abspath(work_dir)
+        self.size = size
+        self.entropy = entropy
+        self.systems = systems or self.SYSTEMS
+        self.fake_tools = fake_tools
+        self.repeat = repeat
+
+    @property
+    def params(self) -> Dict[str, Any]:
+        # Results are only comparable between runs with the same parameters
+        return {"size": self.size, "entropy": self.entropy, "systems": sorted(self.systems),
+                "fake_tools": self.fake_tools}
+
+    def get_disc_path(self, system: str) -> str:
+        return os.path.join(self.work_dir, "discs", f"{system}_{self.size}_{self.entropy:g}.iso")
+
+    def generate_discs(self) -> List[str]:
+        paths = []
+        for system in self.systems:
+            path = self.get_disc_path(system)
+            if not os.path.isfile(path):
+                logger.info(f"Writing {self.size / 2**20:.0f} MiB synthetic {system} disc to {path}")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if system == "wii":
+                    SyntheticDisc.write_wii(path + ".partial", self.size, self.entropy)
+                else:
+                    SyntheticDisc.write_gamecube(path + ".partial", self.size, self.entropy)
+                os.replace(path + ".partial", path)
+            paths.append(path)
+        return paths
+
+    def generate_artwork(self) -> List[str]:
+        art_dir = os.path.join(self.work_dir, "art")
+        os.makedirs(art_dir, exist_ok=True)
+        paths = []
+        for name, size in [("iconTex.png", (128, 128)), ("bootTvTex.png", (1280, 720))]:
+            path = os.path.join(art_dir, name)
+            if not os.path.isfile(path):
+                Image.linear_gradient("L").resize(size).convert("RGB").save(path)
+            paths.append(path)
+        return paths
+
+    def use_stand_ins(self) -> None:
+        for tool, name in self.STAND_INS:
+            tool.use_stand_in(os.path.join(self.STAND_IN_DIR, name))
+
+    def run_once(self, titles: List[Title], output_dir: str, icon_path: str,
+                 banner_path: str) -> Dict[str, StageResult]:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        # One title at a time, so stages of different titles don't compete for the same disk and cores
+        scheduler = BuildScheduler(max_titles=1)
+
+        async def build(title: Title) -> str:
+            return await title.build_async(output_dir, icon_path, banner_path, scheduler=scheduler)
+
+        for title, _, e in scheduler.run(titles, build):
+            if e is not None:
+                raise RuntimeError(f"Benchmark build of {title} failed") from e
+
+        systems = {title.log_name: title.SYSTEM_TYPE for title in titles}
+        results: Dict[str, StageResult] = {}
+        for timing in scheduler.timings:
+            key = f"{systems[timing.title]}:{timing.stage}"
+            seconds, size = results.get(key, (0.0, 0))
+            results[key] = StageResult(seconds + timing.duration, size + timing.size)
+        return results
+
+    def run(self) -> Dict[str, StageResult]:
+        tempfile.tempdir = os.path.join(self.work_dir, "tmp")
+        os.makedirs(tempfile.tempdir, exist_ok=True)
+        if self.fake_tools:
+            self.use_stand_ins()
+
+        titles = [create_title(path) for path in self.generate_discs()]
+        icon_path, banner_path = self.generate_artwork()
+
+        best: Dict[str, StageResult] = {}
+        for i in range(self.repeat):
+            results = self.run_once(titles, os.path.join(self.work_dir, "output"), icon_path, banner_path)
+            for key, result in results.items():
+                if key not in best or result.seconds < best[key].seconds:
+                    best[key] = result
+            logger.info(f"Run {i + 1}/{self.repeat} took {sum(r.seconds for r in results.values()):.1f}s")
+        return best
+
+    @staticmethod
+    def load_baseline(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_baseline(self, path: str, results: Dict[str, StageResult]) -> None:
+        with open(path, "w") as f:
+            json.dump({
+                "params": self.params,
+                "stages": {key: result._asdict() for key, result in sorted(results.items())},
+            }, f, indent=2)
+
+    def compare(self, results: Dict[str, StageResult], baseline: Dict[str, Any],
+                threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+        """The stages that got slower than in baseline, described for a report."""
+        regressions = []
+        for key, result in sorted(results.items()):
+            if key not in baseline["stages"]:
+                continue
+            base = StageResult(**baseline["stages"][key])
+            if result.seconds > base.seconds * (1 + threshold) and \
+                    result.seconds - base.seconds > self.MIN_REGRESSION_SECONDS:
+                regressions.append(f"{key}: {result.seconds:.2f}s, was {base.seconds:.2f}s "
+                                   f"({(result.seconds / max(base.seconds, 1e-9) - 1) * 100:+.0f}%)")
+        return regressions
+
+    @staticmethod
+    def format_report(results: Dict[str, StageResult], baseline: Optional[Dict[str, Any]] = None) -> str:
+        lines = [f"{'stage':<20} {'seconds':>9} {'MB/s':>9} {'baseline':>9} {'change':>8}"]
+        for key, result in sorted(results.items()):
+            line = f"{key:<20} {result.seconds:>9.2f} {result.throughput / 2**20:>9.1f}"
+            if baseline is not None and key in baseline["stages"]:
+                base = StageResult(**baseline["stages"][key])
+                line += f" {base.seconds:>9.2f} {(result.seconds / max(base.seconds, 1e-9) - 1) * 100:>+7.0f}%"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the build pipeline on synthetic disc images.")
+    parser.add_argument("--work-dir", type=str, default=os.path.abspath("benchmark_work"),
+                        help=f"Folder for the synthetic discs, temp files and outputs. "
+                             f"Default is {os.path.abspath('benchmark_work')}.")
+    parser.add_argument("--size", type=int, default=256, help="Size of every synthetic disc in MiB. Default is 256.")
+    parser.add_argument("--entropy", type=float, default=1.0,
+                        help="Fraction of the disc contents that is random rather than zeroes. Default is 1.")
+    parser.add_argument("--systems", type=str, nargs="+", choices=Benchmark.SYSTEMS, default=Benchmark.SYSTEMS)
+    parser.add_argument("--fake-tools", action="store_true",
+                        help="Run the stand-in scripts in benchmark_tools/ instead of wit and nfs2iso2nfs.")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of times to build every disc. The best time of each stage counts. Default is 1.")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON file with the results to compare against.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Write these results to the --baseline file instead of comparing against it.")
+    parser.add_argument("--threshold", type=float, default=Benchmark.DEFAULT_THRESHOLD,
+                        help=f"Fraction a stage may slow down before it counts as a regression. "
+                             f"Default is {Benchmark.DEFAULT_THRESHOLD}.")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.INFO)
+    logging.getLogger().addHandler(handler)
+
+    benchmark = Benchmark(args.work_dir, args.size << 20, args.entropy, args.systems, args.fake_tools, args.repeat)
+    results = benchmark.run()
+
+    baseline = None
+    if args.baseline and not args.save_baseline:
+        baseline = Benchmark.load_baseline(args.baseline)
+        if baseline is not None and baseline["params"] != benchmark.params:
+            print(f"Not comparing against {args.baseline}, which was run with {baseline['params']}")
+            baseline = None
+    print(Benchmark.format_report(results, baseline))
+
+    if args.baseline and args.save_baseline:
+        benchmark.save_baseline(args.baseline, results)
+        print(f"Saved baseline to {args.baseline}")
+    elif baseline is not None:
+        regressions = benchmark.compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions:")
+            print("\n".join(regressions))
+            sys.exit(1)
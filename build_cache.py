@@ -0,0 +1,246 @@
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from atomic_file import AtomicFile
+from config import Config
+from fast_copy import FastCopier
+from tools import Nfs2Iso2Nfs, WiimsISOTools
+
+if TYPE_CHECKING:
+    from game import Title
+
+logger = logging.getLogger(__name__)
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
+
+class BuildCache:
+    """Finished packages and NFS content of earlier builds, keyed by a hash of everything that went into them.
+
+    Once the cache grows past max_size bytes, the entries used longest ago are evicted. Entries share their files with
+    the builds they came from where the filesystem allows, so evicting them does not always free as much space as
+    they are counted as.
+    """
+    # Bump when a change to the build pipeline itself changes its output
+    VERSION = 3
+    DEFAULT_MAX_SIZE = 100 << 30
+
+    TEMPLATES = ["meta.xml.template", "app.xml.template"]
+    TOOLS = [WiimsISOTools, Nfs2Iso2Nfs]
+    # Written next to the NFS content by the disc stages. fw.img gets patched for some titles.
+    CODE_ARTIFACTS = [os.path.join("code", name) for name in ["rvlt.tmd", "rvlt.tik", "fw.img"]]
+
+    def __init__(self, directory: Optional[str] = None, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = os.path.abspath(directory or os.path.join(Config.get_cache_dir(), "builds"))
+        self.max_size = max_size
+
+    @property
+    def packages_dir(self) -> str:
+        return os.path.join(self.directory, "packages")
+
+    @property
+    def contents_dir(self) -> str:
+        return os.path.join(self.directory, "contents")
+
+    @property
+    def fingerprints_dir(self) -> str:
+        return os.path.join(self.directory, "fingerprints")
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        hash_obj = hashlib.sha256()
+        with open(path, "rb") as f:
+            while True:
+                buf = f.read(1 << 20)
+                if not buf:
+                    break
+                hash_obj.update(buf)
+        return hash_obj.hexdigest()
+
+    def fingerprint(self, path: Optional[str]) -> Optional[str]:
+        """Content hash of path, remembered for as long as the file's size, mtime and inode stay the same."""
+        if path is None or not os.path.isfile(path):
+            return None
+
+        st = os.stat(path)
+        stat_key = f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}:{st.st_dev}"
+        memo_path = os.path.join(self.fingerprints_dir, hashlib.sha256(stat_key.encode("utf-8")).hexdigest())
+        try:
+            with open(memo_path, "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+
+        digest = self.hash_file(path)
+        AtomicFile.write(memo_path, digest)
+        return digest
+
+    def get_content_inputs(self, title: "Title") -> Dict[str, Any]:
+        # Everything that ends up in content/ and the disc derived files in code/
+        assets_dir = os.path.join(project_root, "assets")
+        return {
+            "version": self.VERSION,
+            "class": type(title).__qualname__,
+            "options": title.build_options,
+            "nfs_flags": title.get_nfs_patch_flags(),
+            "inputs": [self.fingerprint(path) for path in title.input_paths],
+            "tools": {os.path.basename(tool.path): self.fingerprint(tool.path) for tool in self.TOOLS},
+            "assets": {os.path.relpath(os.path.join(dirpath, name), assets_dir):
+                       self.fingerprint(os.path.join(dirpath, name))
+                       for dirpath, _, filenames in os.walk(assets_dir) for name in filenames},
+        }
+
+    def get_inputs(self, title: "Title", icon_path: str, banner_path: str) -> Dict[str, Any]:
+        return {
+            **self.get_content_inputs(title),
+            "icon": self.fingerprint(icon_path),
+            "banner": self.fingerprint(banner_path),
+            "templates": {name: self.fingerprint(os.path.join(project_root, name)) for name in self.TEMPLATES},
+        }
+
+    @staticmethod
+    def _hash_inputs(inputs: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_key(self, title: "Title", icon_path: str, banner_path: str) -> str:
+        return self._hash_inputs(self.get_inputs(title, icon_path, banner_path))
+
+    def get_content_key(self, title: "Title") -> str:
+        return self._hash_inputs(self.get_content_inputs(title))
+
+    def get_entry_path(self, key: str) -> str:
+        return os.path.join(self.packages_dir, key[:2], key)
+
+    def get_content_entry_path(self, key: str) -> str:
+        return os.path.join(self.contents_dir, key[:2], key)
+
+    def fetch(self, key: str, output_path: str) -> bool:
+        entry_path = self.get_entry_path(key)
+        if not os.path.isdir(entry_path):
+            return False
+
+        logger.info(f"Build cache hit {key}, materializing {output_path}")
+        try:
+            FastCopier.link_tree(entry_path, output_path, allow_symlink=False)
+        except FileNotFoundError:
+            # Evicted while linking
+            shutil.rmtree(output_path, ignore_errors=True)
+            return False
+        self._touch(entry_path)
+        return True
+
+    def store(self, key: str, output_path: str) -> None:
+        self._publish(self.get_entry_path(key), [(output_path, "")])
+
+    def fetch_content(self, key: str, build_dir: str) -> bool:
+        """Link the NFS content and code/ files from an earlier build of the same disc into build_dir."""
+        entry_path = self.get_content_entry_path(key)
+        if not os.path.isdir(entry_path):
+            return False
+
+        logger.info(f"Content cache hit {key}, reusing NFS content")
+        try:
+            FastCopier.link_tree(entry_path, build_dir)
+        except FileNotFoundError:
+            # Evicted while linking. The disc stages overwrite whatever got linked.
+            return False
+        self._touch(entry_path)
+        return True
+
+    def store_content(self, key: str, build_dir: str) -> None:
+        files = [(os.path.join(build_dir, name), name) for name in self.CODE_ARTIFACTS]
+        content_dir = os.path.join(build_dir, "content")
+        files += [(os.path.join(content_dir, name), os.path.join("content", name))
+                  for name in os.listdir(content_dir) if name.startswith("hif_") and name.endswith(".nfs")]
+        self._publish(self.get_content_entry_path(key), files)
+
+    def _publish(self, entry_path: str, sources: List[Tuple[str, str]]) -> None:
+        if os.path.isdir(entry_path):
+            self._touch(entry_path)
+            return
+
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        staging_path = tempfile.mkdtemp(prefix=f".{os.path.basename(entry_path)}_", dir=os.path.dirname(entry_path))
+        try:
+            for src, rel_path in sources:
+                dst = os.path.join(staging_path, rel_path)
+                if os.path.isdir(src):
+                    FastCopier.link_tree(src, dst, allow_symlink=False)
+                else:
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    FastCopier.link(src, dst, allow_symlink=False)
+            # Publish atomically so concurrent builds never see a partial entry
+            os.rename(staging_path, entry_path)
+            logger.info(f"Stored {entry_path} in build cache")
+        except OSError:
+            if not os.path.isdir(entry_path):
+                raise
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+        self.evict(keep=entry_path)
+
+    @staticmethod
+    def _touch(entry_path: str) -> None:
+        # The mtime of an entry is when it was last used, which eviction goes by
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+
+    def get_entries(self) -> List[Tuple[float, str, Dict[Tuple[int, int], int]]]:
+        """Every entry as (last used, path, size of each file by (device, inode))."""
+        entries = []
+        for entries_dir in [self.packages_dir, self.contents_dir]:
+            for entry_path in glob.glob(os.path.join(glob.escape(entries_dir), "*", "*")):
+                # Skips the staging directories of entries being published or evicted
+                if os.path.basename(entry_path).startswith("."):
+                    continue
+                try:
+                    mtime = os.stat(entry_path).st_mtime
+                    files = {}
+                    for dirpath, _, filenames in os.walk(entry_path):
+                        for name in filenames:
+                            st = os.lstat(os.path.join(dirpath, name))
+                            files[(st.st_dev, st.st_ino)] = st.st_size
+                except FileNotFoundError:
+                    continue
+                entries.append((mtime, entry_path, files))
+        return sorted(entries)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Remove the least recently used entries until the cache fits in max_size, except for keep."""
+        entries = self.get_entries()
+        # Package entries share most of their files with the content entries they were built from
+        links: Dict[Tuple[int, int], int] = {}
+        sizes: Dict[Tuple[int, int], int] = {}
+        for _, _, files in entries:
+            for inode, size in files.items():
+                links[inode] = links.get(inode, 0) + 1
+                sizes[inode] = size
+        total = sum(sizes.values())
+
+        for _, entry_path, files in entries:
+            if total <= self.max_size:
+                break
+            if entry_path == keep:
+                continue
+            # Renamed out of the way first, so other processes either see the whole entry or none of it
+            evicted_path = os.path.join(os.path.dirname(entry_path), f".evicted_{os.path.basename(entry_path)}")
+            try:
+                os.rename(entry_path, evicted_path)
+            except OSError:
+                # Evicted by another process
+                continue
+            shutil.rmtree(evicted_path, ignore_errors=True)
+            logger.info(f"Evicted {entry_path} from build cache")
+            for inode in files:
+                links[inode] -= 1
+                if not links[inode]:
+                    total -= sizes[inode]
+
@@ -0,0 +1,159 @@
+from typing import Any, Dict, List
+import errno
+import glob
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from atomic_file import AtomicFile
+from file_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+class BuildJournal:
+    """Remembers which stages of a build have finished, so a build that dies part way resumes after the last one.
+
+    The journal lives in a per-build directory, named after the title and a fingerprint of its inputs, that also holds
+    the build's work files. Copies of a game in different folders therefore never share one. The directory is locked
+    for as long as the build runs and only removed once it succeeds. Directories left behind for the same title with
+    other inputs are thrown away when the next build of the title starts.
+    """
+    FILENAME = "journal.json"
+    # Bump when stages are renamed or what they leave behind changes
+    VERSION = 1
+    # Files modified this long before a stage started still get synced, in case of coarse filesystem timestamps
+    MTIME_SLACK_NS = 2 * 10**9
+
+    def __init__(self, builds_dir: str, name: str, fingerprint: str):
+        self.builds_dir = os.path.abspath(builds_dir)
+        self.name = name
+        self.fingerprint = fingerprint
+        self.directory = os.path.join(self.builds_dir, f"{name}_{fingerprint[:16]}")
+        self.lock = FileLock(self.directory + ".lock", blocking=False)
+        self.completed: List[str] = []
+        self.state: Dict[str, Any] = {}
+        self._stage_start_ns = 0
+
+    @staticmethod
+    def get_builds_dir() -> str:
+        return os.path.join(tempfile.gettempdir(), "builds")
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, self.FILENAME)
+
+    @property
+    def build_dir(self) -> str:
+        return os.path.join(self.directory, "build")
+
+    @property
+    def work_dir(self) -> str:
+        return os.path.join(self.directory, "work")
+
+    def open(self) -> bool:
+        """Lock the build directory and pick up the journal of an earlier attempt, or start a fresh one.
+
+        Returns whether there are completed stages to resume after. Raises BlockingIOError if the same build is already
+        running.
+        """
+        try:
+            self.lock.acquire()
+        except BlockingIOError:
+            raise BlockingIOError(errno.EBUSY, f"{self.name} is already being built from the same inputs "
+                                              f"in {self.directory}")
+        try:
+            self._remove_stale()
+            try:
+                with open(self.path, "r") as f:
+                    journal = json.load(f)
+            except (FileNotFoundError, ValueError):
+                journal = {}
+
+            if journal.get("version") == self.VERSION and journal.get("fingerprint") == self.fingerprint:
+                self.completed = journal["completed"]
+                self.state = journal["state"]
+            else:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.completed = []
+                self.state = {}
+
+            os.makedirs(self.build_dir, exist_ok=True)
+            os.makedirs(self.work_dir, exist_ok=True)
+            self._write()
+        except BaseException:
+            self.lock.release()
+            raise
+        return len(self.completed) > 0
+
+    def _remove_stale(self) -> None:
+        for directory in glob.glob(os.path.join(glob.escape(self.builds_dir), glob.escape(self.name) + "_*")):
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            lock = FileLock(directory + ".lock", blocking=False)
+            try:
+                lock.acquire()
+            except BlockingIOError:
+                # Another copy of the same game, building right now
+                continue
+            try:
+                logger.info(f"Discarding stale build files in {directory}")
+                shutil.rmtree(directory, ignore_errors=True)
+                os.unlink(lock.path)
+            finally:
+                lock.release()
+
+    def begin(self) -> None:
+        self._stage_start_ns = time.time_ns()
+
+    def complete(self, stage: str, state: Dict[str, Any]) -> None:
+        # The journal must not reach the disk before the files the stage wrote, or a reboot could lose them
+        self._sync_changed_files(self._stage_start_ns - self.MTIME_SLACK_NS)
+        self.completed.append(stage)
+        self.state = state
+        self._write()
+
+    def _sync_changed_files(self, since_ns: int) -> None:
+        for dirpath, _, filenames in os.walk(self.directory):
+            synced = False
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                # Links into the caches were not written by this build
+                if stat.S_ISREG(st.st_mode) and st.st_mtime_ns >= since_ns:
+                    self._sync_file(path)
+                    synced = True
+            if synced or os.stat(dirpath).st_mtime_ns >= since_ns:
+                AtomicFile.sync_directory(dirpath)
+
+    @staticmethod
+    def _sync_file(path: str) -> None:
+        # Windows can only flush files opened for writing
+        fd = os.open(path, os.O_RDONLY if os.name == "posix" else os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        # Only while still holding the lock, so nobody can be waiting on the file that goes away
+        os.unlink(self.lock.path)
+        self.close()
+
+    def close(self) -> None:
+        if self.lock.f is not None:
+            self.lock.release()
+
+    def _write(self) -> None:
+        with AtomicFile(self.path, "w", suffix=".json", sync=True) as f:
+            json.dump({
+                "version": self.VERSION,
+                "fingerprint": self.fingerprint,
+                "completed": self.completed,
+                "state": self.state,
+            }, f)
@@ -0,0 +1,294 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import asyncio
+import errno
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import time
+
+from metrics import Metrics
+from tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class Resource:
+    DISK = "disk"
+    CPU = "cpu"
+    NETWORK = "network"
+    # Small jobs, like filling in templates, that would only hold up the heavy stages if they shared their tokens
+    LIGHT = "light"
+
+
+class Stage(NamedTuple):
+    name: str
+    resource: str
+    # Takes the BuildContext. Plain functions are run in a worker thread, coroutine functions on the event loop.
+    run: Callable[["BuildContext"], Any]
+
+
+class BuildContext:
+    """Everything the stages of one build pass to each other, plus the shared cache and artwork fetcher."""
+    # What a build journal saves after every stage, so a resumed build picks up where the last attempt left off
+    STATE = ["icon_path", "banner_path", "iso_path", "cache_key", "content_key", "content_cached", "done"]
+
+    def __init__(self, output_dir: str, output_path: str, icon_path: Optional[str] = None,
+                 banner_path: Optional[str] = None, cache: Any = None, fetcher: Any = None):
+        self.output_dir = output_dir
+        self.output_path = output_path
+        self.icon_path = icon_path
+        self.banner_path = banner_path
+        self.cache = cache
+        self.fetcher = fetcher
+
+        self.work_dir: Optional[str] = None
+        self.build_dir: Optional[str] = None
+        self.iso_path: Optional[str] = None
+        self.cache_key: Optional[str] = None
+        self.content_key: Optional[str] = None
+        self.content_cached = False
+        # Set by a stage when there's nothing left to do, e.g. on a build cache hit
+        self.done = False
+
+    def get_state(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.STATE}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        for name in self.STATE:
+            if name in state:
+                setattr(self, name, state[name])
+
+
+class StageTiming(NamedTuple):
+    title: str
+    stage: str
+    resource: str
+    size: int
+    wait: float
+    duration: float
+    # The stage was (partly) skipped thanks to a cache hit, so its duration says nothing about its cost
+    cached: bool
+
+
+class DiskSpaceBudget:
+    """Admits a build only once its estimated peak disk usage fits in the free space of every volume it writes to.
+
+    Admitted builds keep their whole estimate reserved until they finish. Space they have already used is then
+    counted twice, which errs on the side of starting builds later rather than running a volume full.
+    """
+    # Always left free on every volume
+    RESERVE = 1 << 30
+
+    def __init__(self, reserve: int = RESERVE):
+        self.reserve = reserve
+        self._reserved: Dict[int, int] = {}
+        self._active = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @staticmethod
+    def get_volume(path: str) -> Tuple[int, str]:
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return os.stat(path).st_dev, path
+
+    def get_needs(self, usage: Dict[str, int]) -> Dict[int, Tuple[str, int]]:
+        """Bytes needed per volume, keyed by device, along with an existing path on it."""
+        needs = {}
+        for path, size in usage.items():
+            device, existing_path = self.get_volume(path)
+            needs[device] = (existing_path, needs.get(device, (existing_path, 0))[1] + size)
+        return needs
+
+    def fits(self, needs: Dict[int, Tuple[str, int]]) -> bool:
+        return all(shutil.disk_usage(path).free - self._reserved.get(device, 0) - self.reserve >= size
+                   for device, (path, size) in needs.items())
+
+    async def acquire(self, usage: Dict[str, int], name: str = "") -> None:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        needs = self.get_needs(usage)
+        async with self._condition:
+            while not self.fits(needs):
+                if not self._active:
+                    # Nothing is running that could free up space, so this will never fit
+                    required = ", ".join(f"{size / 2**30:.1f} GiB on {path}" for path, size in needs.values())
+                    raise OSError(errno.ENOSPC, f"Not enough free space to build {name}, which needs about {required}")
+                logger.info(f"{name}: waiting for disk space")
+                await self._condition.wait()
+            for device, (_, size) in needs.items():
+                self._reserved[device] = self._reserved.get(device, 0) + size
+            self._active += 1
+
+    async def release(self, usage: Dict[str, int]) -> None:
+        needs = self.get_needs(usage)
+        async with self._condition:
+            for device, (_, size) in needs.items():
+                self._reserved[device] -= size
+            self._active -= 1
+            self._condition.notify_all()
+
+
+class _PrioritySemaphore:
+    """Semaphore that hands out tokens lowest priority value first, rather than in the order they were asked for."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: int) -> None:
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        # The counter keeps waiters of equal priority in order, and futures out of the comparison
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The token was handed over right before the cancellation, so pass it on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class BuildScheduler:
+    """Runs the stages of many builds concurrently, limiting how many stages use each resource at once.
+
+    A title only holds a token while one of its stages runs, so the CPU heavy stages of one title overlap with the
+    disk heavy stages of the next. Tokens go to the title that started first, so titles that are further along are
+    never held up by the early stages of titles started after them.
+    """
+    DEFAULT_LIMITS = {
+        Resource.DISK: 1,
+        # The CPU heavy stages already spread their work over every core
+        Resource.CPU: 1,
+        Resource.NETWORK: 8,
+        Resource.LIGHT: 4,
+    }
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, max_titles: Optional[int] = None,
+                 disk_budget: Optional["DiskSpaceBudget"] = None):
+        self.limits = {**self.DEFAULT_LIMITS, **(limits or {})}
+        self.disk_budget = disk_budget
+        # Every title in flight keeps its work files around, so don't start many more than can make progress. One
+        # more than the disk and CPU stages running at once gets the network and light stages of the next title out
+        # of the way, so it is ready for the disk as soon as that frees up.
+        self.max_titles = max_titles or self.limits[Resource.DISK] + self.limits[Resource.CPU] + 1
+        self.timings: List[StageTiming] = []
+        self._semaphores: Dict[str, _PrioritySemaphore] = {}
+        self._title_order: Dict[str, int] = {}
+
+    def _semaphore(self, resource: str) -> _PrioritySemaphore:
+        if resource not in self._semaphores:
+            self._semaphores[resource] = _PrioritySemaphore(self.limits[resource])
+        return self._semaphores[resource]
+
+    async def run_stage(self, stage: Stage, context: BuildContext, title_name: str = "", size: int = 0) -> None:
+        queued_time = time.monotonic()
+        semaphore = self._semaphore(stage.resource)
+        await semaphore.acquire(self._title_order.setdefault(title_name, len(self._title_order)))
+        try:
+            start_time = time.monotonic()
+            if asyncio.iscoroutinefunction(stage.run):
+                # Shares its thread with every other coroutine, so per thread I/O counts would be meaningless
+                with Tracer.span(stage.name, "stage", track=title_name, measure_io=False, resource=stage.resource,
+                                 size=size):
+                    await stage.run(context)
+            else:
+                await asyncio.to_thread(self._run_traced, stage, context, title_name, size)
+            end_time = time.monotonic()
+        finally:
+            semaphore.release()
+
+        self.timings.append(StageTiming(title_name, stage.name, stage.resource, size, start_time - queued_time,
+                                        end_time - start_time, context.done or context.content_cached))
+        logger.info(f"{title_name}: {stage.name} took {end_time - start_time:.1f}s "
+                    f"(waited {start_time - queued_time:.1f}s for {stage.resource})")
+        Metrics.inc("stage_runs", stage=stage.name)
+        Metrics.inc("stage_bytes", size, stage=stage.name)
+        Metrics.inc("stage_seconds", end_time - start_time, stage=stage.name)
+        if end_time > start_time:
+            Metrics.set("stage_throughput_bytes_per_second", size / (end_time - start_time), stage=stage.name)
+        Metrics.progress()
+
+    @staticmethod
+    def _run_traced(stage: Stage, context: BuildContext, title_name: str, size: int) -> None:
+        # Entered in the worker thread, so the span counts the I/O of this stage alone
+        with Tracer.span(stage.name, "stage", track=title_name, resource=stage.resource, size=size):
+            stage.run(context)
+
+    async def run_all(self, titles: Iterable[Any], build: Callable[[Any], Awaitable[str]],
+                      get_disk_usage: Optional[Callable[[Any], Dict[str, int]]] = None
+                      ) -> List[Tuple[Any, Optional[str], Optional[Exception]]]:
+        """Build every title with build(title), returning (title, result, exception) for each.
+
+        With a disk budget, get_disk_usage(title) gives the estimated peak bytes the build writes, by path.
+        """
+        titles = list(titles)
+        title_semaphore = asyncio.Semaphore(self.max_titles)
+        self._semaphores = {}
+        self._title_order = {}
+        Metrics.inc("titles", len(titles), state="queued")
+
+        async def build_started(title: Any) -> str:
+            Metrics.inc("titles", -1, state="queued")
+            Metrics.inc("titles", 1, state="running")
+            try:
+                return await build(title)
+            finally:
+                Metrics.inc("titles", -1, state="running")
+
+        async def build_one(title: Any) -> Tuple[Any, Optional[str], Optional[Exception]]:
+            async with title_semaphore:
+                try:
+                    if self.disk_budget is None or get_disk_usage is None:
+                        result = await build_started(title)
+                    else:
+                        usage = get_disk_usage(title)
+                        await self.disk_budget.acquire(usage, str(title))
+                        try:
+                            result = await build_started(title)
+                        finally:
+                            await self.disk_budget.release(usage)
+                except Exception as e:
+                    logger.exception(f"Build of {title} failed")
+                    Metrics.inc("titles", 1, state="failed")
+                    return title, None, e
+                Metrics.inc("titles", 1, state="done")
+                return title, result, None
+
+        return list(await asyncio.gather(*(build_one(title) for title in titles)))
+
+    def simulate(self, jobs: Iterable[List[Tuple[str, float]]]) -> float:
+        """Predicted makespan of running jobs, each a list of (resource, seconds) stages, in the given order."""
+        resource_free = {resource: [0.0] * limit for resource, limit in self.limits.items()}
+        title_free = [0.0] * self.max_titles
+        makespan = 0.0
+        for stages in jobs:
+            slot = title_free.index(min(title_free))
+            finish = title_free[slot]
+            for resource, duration in stages:
+                free = resource_free[resource]
+                i = free.index(min(free))
+                finish = max(finish, free[i]) + duration
+                free[i] = finish
+            title_free[slot] = finish
+            makespan = max(makespan, finish)
+        return makespan
+
+    def run(self, titles: Iterable[Any], build: Callable[[Any], Awaitable[str]],
+            get_disk_usage: Optional[Callable[[Any], Dict[str, int]]] = None
+            ) -> List[Tuple[Any, Optional[str], Optional[Exception]]]:
+        return asyncio.run(self.run_all(titles, build, get_disk_usage))
@@ -1,9 +1,19 @@
 import json
+import os
 
 
 class Config:
     WiiUCommonKey = None
+    WiiCommonKey = None
     RhythmHeavenFeverTitleKey = None
+    CacheDir = None
+
+    @classmethod
+    def get_cache_dir(cls) -> str:
+        if cls.CacheDir:
+            return os.path.abspath(cls.CacheDir)
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "PyWiiUInjector")
 
 
 with open("config.json", "r") as f:
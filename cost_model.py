@@ -0,0 +1,105 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+import os
+import sqlite3
+import time
+
+from build_scheduler import StageTiming
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class StageCostModel:
+    """Predicts how long each build stage takes from the size of a title's input, fitted on past builds.
+
+    Every stage is modelled as seconds = intercept + slope * input bytes, by least squares over its most recent
+    uncached runs.
+    """
+    FILENAME = "stage_timings.sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stage_timings (
+            title TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            resource TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            duration REAL NOT NULL,
+            recorded_at REAL NOT NULL
+        )
+    """
+    # Runs per stage the model is fitted on, so it follows hardware and pipeline changes
+    HISTORY = 200
+
+    # Rough guesses for stages that have never run here, in (seconds, seconds per GiB)
+    DEFAULT_COSTS = {
+        "images": (1.0, 0.0),
+        "base": (1.0, 0.0),
+        "xml": (0.1, 0.0),
+        "art": (1.0, 0.0),
+        "prepare_iso": (1.0, 10.0),
+        "tickets": (1.0, 0.0),
+        "nfs": (1.0, 30.0),
+        "pack": (1.0, 20.0),
+    }
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = os.path.abspath(path or os.path.join(Config.get_cache_dir(), self.FILENAME))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute(self.SCHEMA)
+        self.connection.commit()
+        self._costs: Optional[Dict[str, Tuple[float, float]]] = None
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "StageCostModel":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def record(self, timings: Iterable[StageTiming]) -> None:
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO stage_timings VALUES (?, ?, ?, ?, ?, ?)",
+                [(t.title, t.stage, t.resource, t.size, t.duration, now) for t in timings if not t.cached])
+        self._costs = None
+
+    @staticmethod
+    def fit(samples: List[Tuple[int, float]]) -> Tuple[float, float]:
+        """Least squares (intercept, seconds per byte) through samples of (size, seconds)."""
+        n = len(samples)
+        mean_size = sum(size for size, _ in samples) / n
+        mean_duration = sum(duration for _, duration in samples) / n
+        variance = sum((size - mean_size) ** 2 for size, _ in samples)
+        if variance > 0:
+            slope = sum((size - mean_size) * (duration - mean_duration) for size, duration in samples) / variance
+            intercept = mean_duration - slope * mean_size
+            if slope >= 0 and intercept >= 0:
+                return intercept, slope
+            if slope >= 0:
+                # The line crosses below zero for small titles, so fit a line through the origin instead
+                return 0.0, sum(size * duration for size, duration in samples) / sum(size ** 2 for size, _ in samples)
+        elif mean_size > 0:
+            # Only one size seen so far, assume the time scales with it
+            return 0.0, mean_duration / mean_size
+        # Bigger titles were somehow faster, so all that's left is the average
+        return mean_duration, 0.0
+
+    def get_costs(self) -> Dict[str, Tuple[float, float]]:
+        if self._costs is None:
+            self._costs = {stage: (seconds, seconds_per_gib / 2**30)
+                           for stage, (seconds, seconds_per_gib) in self.DEFAULT_COSTS.items()}
+            stages = [row[0] for row in self.connection.execute("SELECT DISTINCT stage FROM stage_timings")]
+            for stage in stages:
+                samples = self.connection.execute(
+                    "SELECT size, duration FROM stage_timings WHERE stage = ? ORDER BY recorded_at DESC LIMIT ?",
+                    (stage, self.HISTORY)).fetchall()
+                self._costs[stage] = self.fit(samples)
+        return self._costs
+
+    def predict(self, stage: str, size: int) -> float:
+        intercept, slope = self.get_costs().get(stage, (0.0, 0.0))
+        return intercept + slope * size
@@ -0,0 +1,61 @@
+from typing import NamedTuple, Optional
+
+from disc_image import open_disc_image
+
+
+class DiscHeader(NamedTuple):
+    title_id: int
+    game_type: int
+    game_name: str
+    full_game_id: str
+    disc_number: int
+
+    # Game type values as read from 0x18, which holds the Wii magic followed by the GameCube magic
+    WII_GAME_TYPE = 2745048157
+    GAMECUBE_GAME_TYPE = 4440324665927270400
+    DOL_TITLE_ID = 65536
+
+    # Everything that gets parsed fits in the first 0x400 bytes, so read that in one go
+    SIZE = 0x400
+    DISC_NUMBER_OFFSET = 0x06
+    GAME_TYPE_OFFSET = 0x18
+    GAME_NAME_OFFSET = 0x20
+
+    @classmethod
+    def read(cls, path: str) -> "DiscHeader":
+        with open_disc_image(path) as f:
+            data = f.read(cls.SIZE)
+
+        if int.from_bytes(data[:4], byteorder="little") == cls.DOL_TITLE_ID:
+            # This is a DOL file (aka homebrew)
+            # TODO: Unimplemented
+            raise NotImplementedError(f"{path} is a DOL file, which is not supported yet")
+
+        return cls.parse(data)
+
+    @classmethod
+    def parse(cls, data: bytes) -> "DiscHeader":
+        return cls(
+            title_id=int.from_bytes(data[:4], byteorder="little"),
+            game_type=int.from_bytes(data[cls.GAME_TYPE_OFFSET:cls.GAME_TYPE_OFFSET + 8], byteorder="little"),
+            game_name=cls._read_string(data, cls.GAME_NAME_OFFSET),
+            full_game_id=cls._read_string(data, 0, 6),
+            disc_number=data[cls.DISC_NUMBER_OFFSET],
+        )
+
+    @staticmethod
+    def _read_string(data: bytes, offset: int, max_length: Optional[int] = None) -> str:
+        end = data.find(b"\x00", offset)
+        if end == -1:
+            end = len(data)
+        if max_length is not None:
+            end = min(end, offset + max_length)
+        return data[offset:end].decode("utf-8", errors="replace")
+
+    @property
+    def is_wii(self) -> bool:
+        return self.game_type == self.WII_GAME_TYPE
+
+    @property
+    def is_gamecube(self) -> bool:
+        return self.game_type == self.GAMECUBE_GAME_TYPE
@@ -0,0 +1,346 @@
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+import array
+import io
+import os
+import struct
+
+
+class DiscImage(io.RawIOBase):
+    """Read only, seekable view of a disc image as a plain ISO, whatever container it is stored in.
+
+    Subclasses implement read_at(), and data_ranges() if the container knows which parts of the disc are unused, so
+    copies can leave those as holes.
+    """
+
+    def __init__(self, path: str, size: int):
+        super().__init__()
+        self.path = path
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def readinto(self, b) -> int:
+        size = max(min(len(b), self.size - self.position), 0)
+        if size:
+            data = self.read_at(self.position, size)
+            b[:len(data)] = data
+            size = len(data)
+            self.position += size
+        return size
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        raise NotImplementedError
+
+    def data_ranges(self, offset: int, size: int) -> Iterator[Tuple[int, int]]:
+        """Yield the (offset, size) ranges within [offset, offset + size) that may hold data."""
+        yield offset, size
+
+
+class IsoImage(DiscImage):
+    def __init__(self, path: str):
+        super().__init__(path, os.path.getsize(path))
+        self.f = open(path, "rb")
+
+    def fileno(self) -> int:
+        # Plain images can be handed to copy_file_range and friends directly
+        return self.f.fileno()
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        return os.pread(self.f.fileno(), size, offset) if hasattr(os, "pread") else self._read(offset, size)
+
+    def _read(self, offset: int, size: int) -> bytes:
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def close(self) -> None:
+        self.f.close()
+        super().close()
+
+
+class WbfsImage(DiscImage):
+    """The first disc of a WBFS file, with its unused blocks read back as zeros.
+
+    WBFS files split to fit on FAT32 (game.wbfs, game.wbf1, game.wbf2, ...) are read as the one file they add up to.
+    """
+    MAGIC = b"WBFS"
+    WII_SECTOR_SIZE = 0x8000
+    WII_SECTORS_SINGLE_LAYER = 143432
+    WII_SECTORS_DOUBLE_LAYER = WII_SECTORS_SINGLE_LAYER * 2
+    DISC_HEADER_COPY_SIZE = 0x100
+
+    def __init__(self, path: str):
+        self.f = open(path, "rb")
+        # (offset in the whole WBFS file, size, file) of every part
+        self.parts: List[Tuple[int, int, BinaryIO]] = []
+        try:
+            part_offset = 0
+            for part_path in self.get_part_paths(path):
+                f = self.f if part_path == path else open(part_path, "rb")
+                size = os.fstat(f.fileno()).st_size
+                self.parts.append((part_offset, size, f))
+                part_offset += size
+
+            magic, _, hd_sector_shift, wbfs_sector_shift = struct.unpack(">4sIBB", self.f.read(10))
+            if magic != self.MAGIC:
+                raise ValueError(f"{path} is not a WBFS file")
+
+            hd_sector_size = 1 << hd_sector_shift
+            self.block_size = 1 << wbfs_sector_shift
+            blocks_per_disc = self.WII_SECTORS_DOUBLE_LAYER * self.WII_SECTOR_SIZE // self.block_size
+
+            # The disc info of the first disc is in the second HD sector: a copy of the disc header, then the WBFS
+            # block of every block of the disc (0 for unused ones)
+            self.f.seek(hd_sector_size + self.DISC_HEADER_COPY_SIZE)
+            self.block_map: List[int] = list(struct.unpack(f">{blocks_per_disc}H", self.f.read(blocks_per_disc * 2)))
+        except BaseException:
+            self.close_parts()
+            raise
+
+        used = [i for i, block in enumerate(self.block_map) if block]
+        end = (used[-1] + 1) * self.block_size if used else 0
+        single_layer_size = self.WII_SECTORS_SINGLE_LAYER * self.WII_SECTOR_SIZE
+        super().__init__(path, single_layer_size if end <= single_layer_size else
+                         self.WII_SECTORS_DOUBLE_LAYER * self.WII_SECTOR_SIZE)
+
+    @staticmethod
+    def get_part_paths(path: str) -> List[str]:
+        base, extension = os.path.splitext(path)
+        paths = [path]
+        while True:
+            # .wbfs is followed by .wbf1, .wbf2 and so on
+            part_path = f"{base}{extension[:-1]}{len(paths)}"
+            if not os.path.isfile(part_path):
+                return paths
+            paths.append(part_path)
+
+    def _read(self, offset: int, size: int) -> bytes:
+        out = bytearray()
+        for part_offset, part_size, f in self.parts:
+            if len(out) == size:
+                break
+            if offset >= part_offset + part_size:
+                continue
+            f.seek(offset - part_offset)
+            data = f.read(min(size - len(out), part_offset + part_size - offset))
+            out += data
+            offset += len(data)
+            if offset < part_offset + part_size:
+                break
+        return bytes(out)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        out = bytearray()
+        end = offset + size
+        while offset < end:
+            index, block_offset = divmod(offset, self.block_size)
+            length = min(self.block_size - block_offset, end - offset)
+            block = self.block_map[index]
+            if block:
+                data = self._read(block * self.block_size + block_offset, length)
+                if len(data) < length:
+                    raise EOFError(f"{self.path} ends before WBFS block {block}, which holds disc offset "
+                                   f"{offset:#x}. It is truncated or missing its .wbf1, .wbf2, ... parts.")
+                out += data
+            else:
+                out += bytes(length)
+            offset += length
+        return bytes(out)
+
+    def data_ranges(self, offset: int, size: int) -> Iterator[Tuple[int, int]]:
+        end = offset + size
+        range_start = None
+        position = offset
+        while position < end:
+            index, block_offset = divmod(position, self.block_size)
+            next_position = min(position - block_offset + self.block_size, end)
+            if self.block_map[index]:
+                if range_start is None:
+                    range_start = position
+            elif range_start is not None:
+                yield range_start, position - range_start
+                range_start = None
+            position = next_position
+        if range_start is not None:
+            yield range_start, end - range_start
+
+    def close_parts(self) -> None:
+        self.f.close()
+        for _, _, f in self.parts:
+            f.close()
+
+    def close(self) -> None:
+        self.close_parts()
+        super().close()
+
+
+class NasosImage(DiscImage):
+    """A NASOS image (WII5 for single layer, WII9 for dual layer discs).
+
+    The header ends in a table with a 32-bit entry for every 0x400 byte block of the disc, 0 for the blocks a trimmed
+    image leaves out. The blocks that are kept follow the table in disc order, and left out ones read back as zeros.
+    """
+    BLOCK_SIZE = 0x400
+    WII_SECTOR_SIZE = 0x8000
+    BLOCKS_PER_SECTOR = WII_SECTOR_SIZE // BLOCK_SIZE
+    FULL_MASK = (1 << BLOCKS_PER_SECTOR) - 1
+    # (start offset of the disc data, number of Wii sectors on the disc). The block table ends at the start offset.
+    FORMATS = {
+        b"WII5": (0x1182800, 143432),
+        b"WII9": (0x1FB5000, 259740),
+    }
+
+    def __init__(self, path: str):
+        self.f = open(path, "rb")
+        try:
+            magic = self.f.read(4)
+            if magic not in self.FORMATS:
+                raise ValueError(f"{path} is not a NASOS image")
+            self.start_offset, sectors = self.FORMATS[magic]
+            size = sectors * self.WII_SECTOR_SIZE
+
+            # Per sector: index of its first stored block among all stored blocks, and a mask of its stored blocks.
+            # Images that store every block don't need the table.
+            self.first_blocks: Optional[array.array] = None
+            self.block_masks: Optional[array.array] = None
+            if os.fstat(self.f.fileno()).st_size != self.start_offset + size:
+                self.read_block_table(sectors)
+        except BaseException:
+            self.f.close()
+            raise
+        super().__init__(path, size)
+
+    def read_block_table(self, sectors: int) -> None:
+        entry_size = self.BLOCKS_PER_SECTOR * 4
+        self.f.seek(self.start_offset - sectors * entry_size)
+        table = self.f.read(sectors * entry_size)
+        if len(table) < sectors * entry_size:
+            raise EOFError(f"{self.f.name} ends inside its NASOS block table")
+
+        self.first_blocks = array.array("Q")
+        self.block_masks = array.array("L")
+        stored = 0
+        empty_entry = bytes(entry_size)
+        for offset in range(0, len(table), entry_size):
+            entry = table[offset:offset + entry_size]
+            if entry == empty_entry:
+                mask = 0
+            elif b"\x00\x00\x00\x00" not in entry:
+                mask = self.FULL_MASK
+            else:
+                blocks = struct.unpack_from(f">{self.BLOCKS_PER_SECTOR}I", entry)
+                mask = sum(1 << i for i, block in enumerate(blocks) if block)
+            self.first_blocks.append(stored)
+            self.block_masks.append(mask)
+            stored += mask.bit_count()
+
+    def locate(self, offset: int) -> Tuple[Optional[int], int]:
+        """Offset in the file of the disc data at offset (None if it was left out), and for how many bytes from there
+        the disc data stays stored in one piece or left out."""
+        if self.block_masks is None:
+            return self.start_offset + offset, self.size - offset
+        sector, sector_offset = divmod(offset, self.WII_SECTOR_SIZE)
+        mask = self.block_masks[sector]
+        if mask in (0, self.FULL_MASK):
+            length = self.WII_SECTOR_SIZE - sector_offset
+            block = sector_offset // self.BLOCK_SIZE
+        else:
+            block, block_offset = divmod(sector_offset, self.BLOCK_SIZE)
+            length = self.BLOCK_SIZE - block_offset
+        if not mask >> block & 1:
+            return None, length
+        index = self.first_blocks[sector] + (mask & ((1 << block) - 1)).bit_count()
+        return self.start_offset + index * self.BLOCK_SIZE + sector_offset % self.BLOCK_SIZE, length
+
+    def runs(self, offset: int, size: int) -> Iterator[Tuple[int, int, Optional[int]]]:
+        """Yield (offset, size, offset in the file or None) of the stored and left out runs within
+        [offset, offset + size)."""
+        end = offset + size
+        run_offset, run_size, run_file_offset = offset, 0, None
+        position = offset
+        while position < end:
+            file_offset, length = self.locate(position)
+            length = min(length, end - position)
+            # Stored blocks that follow each other on the disc follow each other in the file too
+            if run_size and (file_offset is None) == (run_file_offset is None) and \
+                    (file_offset is None or file_offset == run_file_offset + run_size):
+                run_size += length
+            else:
+                if run_size:
+                    yield run_offset, run_size, run_file_offset
+                run_offset, run_size, run_file_offset = position, length, file_offset
+            position += length
+        if run_size:
+            yield run_offset, run_size, run_file_offset
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        out = bytearray()
+        for run_offset, run_size, file_offset in self.runs(offset, min(size, self.size - offset)):
+            if file_offset is None:
+                out += bytes(run_size)
+                continue
+            self.f.seek(file_offset)
+            data = self.f.read(run_size)
+            if len(data) < run_size:
+                raise EOFError(f"{self.path} ended while reading disc offset {run_offset:#x}")
+            out += data
+        return bytes(out)
+
+    def data_ranges(self, offset: int, size: int) -> Iterator[Tuple[int, int]]:
+        for run_offset, run_size, file_offset in self.runs(offset, size):
+            if file_offset is not None:
+                yield run_offset, run_size
+
+    def close(self) -> None:
+        self.f.close()
+        super().close()
+
+
+def open_disc_image(path: str) -> DiscImage:
+    """Open a Wii or GameCube disc image in any supported container format as a plain ISO stream."""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        f.seek(0x200)
+        nkit_magic = f.read(4)
+
+    if magic == WbfsImage.MAGIC:
+        return WbfsImage(path)
+    elif nkit_magic == b"NKIT":
+        # TODO: Unimplemented
+        raise NotImplementedError(f"{path} is an NKit image, which is not supported yet")
+    elif magic in NasosImage.FORMATS:
+        return NasosImage(path)
+    return IsoImage(path)
+
+
+def copy_disc_range(src: DiscImage, dst: BinaryIO, offset: int, size: int, chunk_size: int = 1 << 24) -> int:
+    """Copy [offset, offset + size) of src to the same offset in dst, leaving unused parts of src as holes."""
+    copied = 0
+    for range_offset, range_size in src.data_ranges(offset, size):
+        dst.seek(range_offset)
+        remaining = range_size
+        while remaining > 0:
+            buf = src.read_at(range_offset + range_size - remaining, min(remaining, chunk_size))
+            if not buf:
+                break
+            dst.write(buf)
+            remaining -= len(buf)
+        copied += range_size - remaining
+    return copied
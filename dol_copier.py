@@ -1,16 +1,14 @@
 import os
-import shutil
+from fast_copy import FastCopier
 
 
 class DolCopier:
     @staticmethod
     def copy_dol(name: str, output_path: str) -> str:
         src = os.path.join(os.path.dirname(__file__), "assets", "DOL", name)
-        shutil.copyfile(src, output_path)
-        return output_path
+        return FastCopier.link(src, output_path)
 
     @staticmethod
     def copy_base(output_path: str) -> str:
         src = os.path.join(os.path.dirname(__file__), "assets", "BASE")
-        shutil.copytree(src, output_path, dirs_exist_ok=True)
-        return output_path
+        return FastCopier.link_tree(src, output_path)
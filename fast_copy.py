@@ -0,0 +1,116 @@
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class FastCopier:
+    # From linux/fs.h
+    FICLONE = 0x40049409
+
+    @classmethod
+    def link(cls, src: str, dst: str, allow_symlink: bool = True) -> str:
+        """Stage src at dst for reading only, without copying any data if the filesystem allows it.
+
+        Symlinks are only suitable while src outlives dst, so callers that keep dst around longer pass
+        allow_symlink=False.
+        """
+        cls._remove_existing(dst)
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+        if cls.reflink(src, dst):
+            return dst
+        if not allow_symlink:
+            return cls.copy_file_range(src, dst)
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return dst
+        except OSError:
+            pass
+        return cls.copy_file_range(src, dst)
+
+    @classmethod
+    def clone(cls, src: str, dst: str) -> str:
+        """Copy src to dst as an independent, writable file. Uses a copy-on-write clone where possible."""
+        cls._remove_existing(dst)
+        if cls.reflink(src, dst):
+            return dst
+        return cls.copy_file_range(src, dst)
+
+    @classmethod
+    def materialize(cls, path: str) -> str:
+        """Turn a linked file into a private copy, so it can be modified in place without changing the source."""
+        try:
+            if not os.path.islink(path) and os.stat(path).st_nlink == 1:
+                return path
+        except FileNotFoundError:
+            return path
+
+        temp_path = path + ".materialize"
+        cls.clone(os.path.realpath(path), temp_path)
+        os.replace(temp_path, path)
+        return path
+
+    @classmethod
+    def reflink(cls, src: str, dst: str) -> bool:
+        if fcntl is None:
+            return False
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), cls.FICLONE, fsrc.fileno())
+            except OSError:
+                success = False
+            else:
+                success = True
+        if not success:
+            os.unlink(dst)
+        else:
+            shutil.copymode(src, dst)
+        return success
+
+    @staticmethod
+    def copy_file_range(src: str, dst: str) -> str:
+        if not hasattr(os, "copy_file_range"):
+            return shutil.copyfile(src, dst)
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                # Let the kernel move the data without bouncing it through userspace
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                logger.debug(f"copy_file_range unsupported for {src} -> {dst}, copying normally")
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, 1 << 20)
+        shutil.copymode(src, dst)
+        return dst
+
+    @classmethod
+    def link_tree(cls, src: str, dst: str, allow_symlink: bool = True) -> str:
+        for dirpath, _, filenames in os.walk(src):
+            dst_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+            os.makedirs(dst_dir, exist_ok=True)
+            for filename in filenames:
+                cls.link(os.path.join(dirpath, filename), os.path.join(dst_dir, filename), allow_symlink)
+        return dst
+
+    @staticmethod
+    def _remove_existing(path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,59 @@
+import errno
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, shared between processes. Blocks until the lock is acquired.
+
+    With blocking=False, acquiring a lock that is already held raises BlockingIOError instead. The lock is per open
+    file, so it also keeps out other holders within the same process.
+    """
+
+    def __init__(self, path: str, blocking: bool = True):
+        self.path = path
+        self.blocking = blocking
+        self.f = None
+
+    def acquire(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.f = open(self.path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            while True:
+                try:
+                    self.f.seek(0)
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK if self.blocking else msvcrt.LK_NBLCK, 1)
+                    return
+                except OSError:
+                    if not self.blocking:
+                        raise BlockingIOError(errno.EAGAIN, f"{self.path} is locked")
+                    # LK_LOCK gives up after 10 seconds
+                    continue
+        except BaseException:
+            self.f.close()
+            self.f = None
+            raise
+
+    def release(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
@@ -1,19 +1,29 @@
-import io
+import asyncio
+import contextvars
+import glob
+import hashlib
+import json
 import logging
 import os
 import shutil
 import tempfile
 from abc import ABC, abstractmethod
-from typing import Any, List, Optional, Literal, Tuple
-
-import requests
+from typing import Any, Dict, List, Optional, Literal, Tuple
 
+from artwork_fetcher import ArtworkFetcher
+from build_cache import BuildCache
+from build_journal import BuildJournal
+from build_scheduler import BuildContext, BuildScheduler, DiskSpaceBudget, Resource, Stage
 from config import Config
+from disc_header import DiscHeader
+from disc_image import open_disc_image
 from dol_copier import DolCopier
+from fast_copy import FastCopier
 from nfs_iso_converter import NfsIsoConverter
 from nus_downloader import NUSDownloader
 from nus_packer import NUSPackerWrapper
 from tga_converter import TgaConverter
+from wii_disc import WiiDisc
 from wit import WiimsISOToolsWrapper
 from xml_templater import XMLTemplate
 
@@ -21,98 +31,42 @@ root_logger = logging.getLogger()
 root_logger.setLevel(logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+_current_title_log: contextvars.ContextVar = contextvars.ContextVar("current_title_log", default=None)
 
-def create_title(iso_path: str, iso_path_2: Optional[str] = None, **kwargs: Any) -> "Title":
-    with open(iso_path, "rb") as f:
-        magic_header = f.read(4)
-        title_id = int.from_bytes(magic_header, byteorder="little")
-
-        if title_id == 65536:
-            # This is a DOL file (aka homebrew)
-            f.seek(0x2A0)
-            title_id = int.from_bytes(f.read(4), byteorder="little")
-            internal_game_name = "N/A"
-            # TODO: Unimplemented
-            raise NotImplementedError
-        elif magic_header == b"WBFS":
-            # TODO: Unimplemented
-            """
-            FlagWBFS = true;
-            reader.BaseStream.Position = 0x200;
-            TitleIDInt = reader.ReadInt32();
-            reader.BaseStream.Position = 0x218;
-            GameType = reader.ReadInt64();
-            TempString = "";
-            reader.BaseStream.Position = 0x220;
-            while ((int)(TempChar = reader.ReadChar()) != 0) TempString = TempString + TempChar;
-            InternalGameName = TempString;
-            TempString = "";
-            reader.BaseStream.Position = 0x200;
-            while ((int)(TempChar = reader.ReadChar()) != 0) TempString = TempString + TempChar;
-            CucholixRepoID = TempString;
-            """
-            raise NotImplementedError
-        else:
-            start_offset = 0
-
-            if f.read(4) == b"NKIT":
-                # TODO: Unimplemented
-                raise NotImplementedError
-            elif magic_header == b"WII5":
-                # TODO: Unimplemented
-                """
-                if (idString == "WII5")
-                {
-                    FlagNASOS = true;
-                    startOffset = 0x1182800;
-                }
-                """
-                raise NotImplementedError
-            elif magic_header == b"WII9":
-                # TODO: Unimplemented
-                """
-                else if (idString == "WII9")
-                {
-                    FlagNASOS = true;
-                    startOffset = 0x1FB5000;
-                }
-                """
-                raise NotImplementedError
-
-            f.seek(start_offset)
-            title_id = int.from_bytes(f.read(4), byteorder="little")
-
-            f.seek(start_offset + 0x18)
-            game_type = int.from_bytes(f.read(8), byteorder="little")
-
-            bio = io.BytesIO()
-            while True:
-                ch = f.read(1)
-                if ch == b'\x00':
-                    break
-                bio.write(ch)
-            game_name = bio.getvalue().decode("utf-8")
-
-            f.seek(start_offset)
-            bio = io.BytesIO()
-            while True:
-                ch = f.read(1)
-                if ch == b'\x00':
-                    break
-                bio.write(ch)
-            full_game_id = bio.getvalue().decode("utf-8")
 
-            if game_type == 2745048157:
-                return WiiRetailTitle(iso_path, title_id, game_name, full_game_id, **kwargs)
-            elif game_type == 4440324665927270400:
-                return GamecubeRetailTitle(iso_path, iso_path_2, title_id, game_name, full_game_id, **kwargs)
+class _TitleLogFilter(logging.Filter):
+    def __init__(self, log_path: str):
+        super().__init__()
+        self.log_path = log_path
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return _current_title_log.get() == self.log_path
+
 
-            raise NotImplementedError
+def create_title(iso_path: str, iso_path_2: Optional[str] = None, header: Optional[DiscHeader] = None,
+                 **kwargs: Any) -> "Title":
+    if header is None:
+        header = DiscHeader.read(iso_path)
+
+    if header.is_wii:
+        return WiiRetailTitle(iso_path, header.title_id, header.game_name, header.full_game_id, **kwargs)
+    elif header.is_gamecube:
+        return GamecubeRetailTitle(iso_path, iso_path_2, header.title_id, header.game_name, header.full_game_id,
+                                   **kwargs)
+
+    raise NotImplementedError
 
 
 class Title(ABC):
     BASE_URL = "https://raw.githubusercontent.com/cucholix/wiivc-bis/master/"
     SYSTEM_TYPE = None
+    # The prepared ISO and the NFS content made from it are both about as big as the disc
+    TEMP_SPACE_FACTOR = 2
+    # Base files that the build overwrites or, like fw.img with -passthrough, patches in place
+    REWRITTEN_FILES = [os.path.join("code", "app.xml"), os.path.join("code", "fw.img"),
+                       os.path.join("meta", "meta.xml"), os.path.join("meta", "iconTex.tga"),
+                       os.path.join("meta", "bootTvTex.tga"), os.path.join("meta", "bootDrcTex.tga"),
+                       os.path.join("meta", "bootLogoTex.tga"), os.path.join("meta", "bootSound.btsnd")]
 
     def __init__(self, iso_path: str, title_id: int, game_name: str, full_game_id: str):
         self.iso_path = iso_path
@@ -120,6 +74,9 @@ class Title(ABC):
         self.game_name = game_name
         self.full_game_id = full_game_id
 
+    def __str__(self) -> str:
+        return os.path.basename(self.iso_path)
+
     @staticmethod
     @abstractmethod
     def get_possible_image_ids(game_id) -> List[str]:
@@ -129,20 +86,12 @@ class Title(ABC):
         possible_ids = self.get_possible_image_ids(self.full_game_id)
         return [self.BASE_URL + self.SYSTEM_TYPE + "/image/" + pid + "/" for pid in possible_ids]
 
-    def fetch_images(self) -> Tuple[bytes, bytes]:
-        icon = None
-        banner = None
-        urls = self.get_candidate_urls()
-        for url in urls:
-            r1 = requests.get(url + "iconTex.png")
-            r2 = requests.get(url + "bootTvTex.png")
-            if r1.status_code == 200:
-                icon = r1.content
-            if r2.status_code == 200:
-                banner = r2.content
-
-            if icon is not None and banner is not None:
-                break
+    def fetch_images(self, fetcher: Optional[ArtworkFetcher] = None) -> Tuple[bytes, bytes]:
+        if fetcher is None:
+            with ArtworkFetcher() as fetcher:
+                return self.fetch_images(fetcher)
+
+        icon, banner = fetcher.fetch_images(self.get_candidate_urls())
 
         if icon is None:
             raise ValueError("Unable to retrieve icon")
@@ -152,131 +101,259 @@ class Title(ABC):
 
         return icon, banner
 
-    def build(self, output_dir: str, icon_path: Optional[str] = None, banner_path: Optional[str] = None) -> str:
-        root_logger.handlers = []
-        fh = logging.FileHandler(os.path.join(output_dir, f"WUP-N-{self.title_id_text}_00050002{self.title_id_hex}.log"))
-        fh.setLevel(logging.DEBUG)
-        root_logger.addHandler(fh)
-
-        output_path = os.path.join(output_dir, f"WUP-N-{self.title_id_text}_00050002{self.title_id_hex}")
+    @property
+    def log_name(self) -> str:
+        return f"WUP-N-{self.title_id_text}_00050002{self.title_id_hex}"
+
+    def build(self, output_dir: str, icon_path: Optional[str] = None, banner_path: Optional[str] = None,
+              cache: Optional[BuildCache] = None, fetcher: Optional[ArtworkFetcher] = None) -> str:
+        return asyncio.run(self.build_async(output_dir, icon_path, banner_path, cache, fetcher=fetcher))
+
+    async def build_async(self, output_dir: str, icon_path: Optional[str] = None, banner_path: Optional[str] = None,
+                          cache: Optional[BuildCache] = None, scheduler: Optional[BuildScheduler] = None,
+                          fetcher: Optional[ArtworkFetcher] = None) -> str:
+        """Build the package of this title. Batches pass the same scheduler and artwork fetcher to every build."""
+        scheduler = scheduler or BuildScheduler()
+        output_path = os.path.join(output_dir, self.log_name)
         if os.path.isdir(output_path):
             logger.warning(f"Refusing to write to existing path {output_path}, exiting")
             return output_path
 
-        with tempfile.TemporaryDirectory(
-                prefix=f"build_{self.title_id_text}_") as temp_build_dir,\
-            tempfile.TemporaryDirectory(
-                prefix=f"work_{self.title_id_text}_") as temp_work_dir:
-            build_meta_dir = os.path.join(temp_build_dir, "meta")
-            build_code_dir = os.path.join(temp_build_dir, "code")
-
-            logger.info("Getting files from NUS/cache")
-            base_file_path = os.path.join(temp_work_dir, "base_files")
-            NUSDownloader.copy_files(base_file_path)
-
-            logger.info("Copying base files to build directory")
-            shutil.copytree(os.path.join(base_file_path, NUSDownloader.RhythmHeavenFeverName), temp_build_dir,
-                            dirs_exist_ok=True)
-
-            logger.info("Generating app.xml")
-            with open(os.path.join(build_code_dir, "app.xml"), "w") as f:
-                xml = self.build_app_xml()
-                f.write(xml)
+        # Several titles can be building in this process, so only log records from this build go to its log file
+        log_path = os.path.join(output_dir, f"{self.log_name}.log")
+        token = _current_title_log.set(log_path)
+        fh = logging.FileHandler(log_path)
+        fh.setLevel(logging.DEBUG)
+        fh.addFilter(_TitleLogFilter(log_path))
+        root_logger.addHandler(fh)
 
-            logger.info("Generating meta.xml")
-            with open(os.path.join(build_meta_dir, "meta.xml"), "w") as f:
-                xml = self.build_meta_xml(self.drcuse, self.game_name, self.game_name)
-                f.write(xml)
+        context = BuildContext(output_dir, output_path, icon_path, banner_path, cache, fetcher)
+        journal = BuildJournal(BuildJournal.get_builds_dir(), self.log_name,
+                               self.get_journal_fingerprint(output_path, icon_path, banner_path))
+        opened = False
+        try:
+            if journal.open():
+                context.set_state(journal.state)
+                logger.info(f"Resuming build after stage {journal.completed[-1]}")
+            opened = True
+            context.build_dir = journal.build_dir
+            context.work_dir = journal.work_dir
+
+            for stage in self.get_stages():
+                if context.done:
+                    break
+                if stage.name in journal.completed:
+                    continue
+                journal.begin()
+                await scheduler.run_stage(stage, context, self.log_name, self.input_size)
+                # Flushes what the stage wrote, which can take a while after writing a whole disc
+                await asyncio.to_thread(journal.complete, stage.name, context.get_state())
+        except BaseException:
+            if opened:
+                logger.error(f"Build stopped, the next run resumes it from {journal.directory}")
+                journal.close()
+            raise
+        else:
+            journal.remove()
+            return output_path
+        finally:
+            root_logger.removeHandler(fh)
+            fh.close()
+            _current_title_log.reset(token)
+
+    def get_journal_fingerprint(self, output_path: str, icon_path: Optional[str] = None,
+                                banner_path: Optional[str] = None) -> str:
+        """Identifies the inputs of a build cheaply, by path, size and mtime, so a rerun only resumes the same build."""
+        def stat(path: Optional[str]) -> Optional[List[Any]]:
+            if path is None or not os.path.isfile(path):
+                return None
+            st = os.stat(path)
+            return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+        inputs = {
+            "class": type(self).__qualname__,
+            "options": self.build_options,
+            "nfs_flags": self.get_nfs_patch_flags(),
+            "inputs": [stat(path) for path in self.input_paths],
+            "icon": stat(icon_path),
+            "banner": stat(banner_path),
+            "output": os.path.abspath(output_path),
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_stages(self) -> List[Stage]:
+        return [
+            Stage("images", Resource.NETWORK, self.stage_images),
+            Stage("base", Resource.DISK, self.stage_base),
+            Stage("xml", Resource.LIGHT, self.stage_xml),
+            Stage("art", Resource.LIGHT, self.stage_art),
+            Stage("prepare_iso", Resource.DISK, self.stage_prepare_iso),
+            Stage("tickets", Resource.DISK, self.stage_tickets),
+            Stage("nfs", Resource.CPU, self.stage_nfs),
+            Stage("pack", Resource.CPU, self.stage_pack),
+        ]
+
+    def stage_images(self, context: BuildContext) -> None:
+        temp_image_dir = os.path.join(context.work_dir, "imgs")
+        context.icon_path, context.banner_path = self.resolve_images(temp_image_dir, context.icon_path,
+                                                                     context.banner_path, context.fetcher)
+
+        if context.cache is not None:
+            context.cache_key = context.cache.get_key(self, context.icon_path, context.banner_path)
+            context.done = context.cache.fetch(context.cache_key, context.output_path)
+
+    def stage_base(self, context: BuildContext) -> None:
+        logger.info("Linking base files from NUS/cache into build directory")
+        NUSDownloader.link_files(NUSDownloader.RhythmHeavenFeverName, context.build_dir)
+        # The build tree shares its files with the cache, so anything modified in place needs its own copy first
+        for rel_path in self.REWRITTEN_FILES:
+            FastCopier.materialize(os.path.join(context.build_dir, rel_path))
+
+    def stage_xml(self, context: BuildContext) -> None:
+        build_meta_dir = os.path.join(context.build_dir, "meta")
+        build_code_dir = os.path.join(context.build_dir, "code")
+
+        logger.info("Generating app.xml")
+        with open(os.path.join(build_code_dir, "app.xml"), "w") as f:
+            xml = self.build_app_xml()
+            f.write(xml)
+
+        logger.info("Generating meta.xml")
+        with open(os.path.join(build_meta_dir, "meta.xml"), "w") as f:
+            xml = self.build_meta_xml(self.drcuse, self.game_name, self.game_name)
+            f.write(xml)
+
+    def stage_art(self, context: BuildContext) -> None:
+        build_meta_dir = os.path.join(context.build_dir, "meta")
+
+        # Convert PNG to TGA
+        logger.info("Converting icon/banner to TGA")
+        TgaConverter.convert_all(context.icon_path, [TgaConverter.ICON], build_meta_dir)
+        # For gamepad, use existing banner if separate image not provided
+        TgaConverter.convert_all(context.banner_path, [TgaConverter.TV_BANNER, TgaConverter.DRC_BANNER],
+                                 build_meta_dir)
+
+        # Boot logo. Not mandatory
+        # TODO: Plumb this path
+        """
+        logger.info("Converting boot logo to TGA")
+        TgaConverter.convert_all(logo_path, [TgaConverter.LOGO], build_meta_dir)
+        """
+
+        # Convert boot sound if provided
+        # TODO: Implement
+        """
+        logger.info("Converting boot sound to BTSND")
+        //Convert Boot Sound if provided by user
+        if (FlagBootSoundSpecified)
+        {
+            BuildStatus.Text = "Converting user-provided sound to btsnd format...";
+            BuildStatus.Refresh();
+            LauncherExeFile = TempToolsPath + "SOX\\sox.exe";
+            LauncherExeArgs = 
+                "\"" + OpenBootSound.FileName + "\" -b 16 \"" + TempSoundPath + "\" channels 2 rate 48k trim 0 6";
+            LaunchProgram();
+            File.Delete(TempBuildPath + "meta\\bootSound.btsnd");
+            LauncherExeFile = TempToolsPath + "JAR\\wav2btsnd.exe";
+            LauncherExeArgs = 
+                "-in \"" + TempSoundPath + "\" -out \"" + TempBuildPath + "meta\\bootSound.btsnd\"" + LoopString;
+            LaunchProgram();
+            File.Delete(TempSoundPath);
+        }
+        """
+
+    def stage_prepare_iso(self, context: BuildContext) -> None:
+        if context.cache is not None:
+            context.content_key = context.cache.get_content_key(self)
+            context.content_cached = context.cache.fetch_content(context.content_key, context.build_dir)
+            if context.content_cached:
+                logger.info("Only meta inputs changed, skipping ISO and NFS conversion")
+                return
+
+        # Build ISO
+        logger.info("Building ISO from extracted files")
+        context.iso_path = self.prepare_iso(context.work_dir)
+
+    def stage_tickets(self, context: BuildContext) -> None:
+        if context.content_cached:
+            return
+
+        WiimsISOToolsWrapper.extract_tickets(context.iso_path, os.path.join(context.build_dir, "code"))
+
+    def stage_nfs(self, context: BuildContext) -> None:
+        if context.content_cached:
+            return
+
+        # An earlier attempt may have died half way, after patching fw.img or writing some of the NFS parts
+        content_path = os.path.join(context.build_dir, "content")
+        FastCopier.clone(os.path.join(NUSDownloader.get_cache_dir(), NUSDownloader.RhythmHeavenFeverName, "code",
+                                      "fw.img"), os.path.join(context.build_dir, "code", "fw.img"))
+        for path in glob.glob(os.path.join(glob.escape(content_path), "hif_*.nfs")):
+            os.unlink(path)
+
+        if not os.path.isfile(context.iso_path):
+            # Died after freeing the ISO below but before the journal caught up
+            logger.info("Rebuilding ISO for NFS conversion")
+            context.iso_path = self.prepare_iso(context.work_dir)
+
+        # Convert ISO to NFS
+        # TODO: Handle LR patch (L & R -> ZL & ZR) by adding -lrpatch flag
+        NfsIsoConverter.convert_iso_to_nfs(context.iso_path, content_path, self.get_nfs_patch_flags())
+        # The ISO is only needed for the conversion, so free the space before the next stage
+        os.unlink(context.iso_path)
+
+        if context.cache is not None:
+            context.cache.store_content(context.content_key, context.build_dir)
+
+    def stage_pack(self, context: BuildContext) -> None:
+        # Pack next to the output and only move it into place once complete, so a rerun never sees half a package
+        partial_path = context.output_path + ".partial"
+        shutil.rmtree(partial_path, ignore_errors=True)
+
+        # Encrypt with NUSPacker
+        logger.info("Encrypting contents into installable WUP package")
+        NUSPackerWrapper.pack(context.build_dir, partial_path, Config.WiiUCommonKey)
+        os.rename(partial_path, context.output_path)
+
+        if context.cache is not None:
+            context.cache.store(context.cache_key, context.output_path)
+
+    def resolve_images(self, temp_image_dir: str, icon_path: Optional[str] = None, banner_path: Optional[str] = None,
+                       fetcher: Optional[ArtworkFetcher] = None) -> Tuple[str, str]:
+        os.makedirs(temp_image_dir, exist_ok=True)
+
+        if icon_path is None:
+            fname = os.path.splitext(os.path.basename(self.iso_path))[0] + ".png"
+            alt_icon_path = os.path.join(os.path.dirname(self.iso_path), "icons", fname)
+            if not os.path.isfile(alt_icon_path):
+                icon_path = None
+            else:
+                icon_path = os.path.join(temp_image_dir, "iconTex.png")
+                shutil.copyfile(alt_icon_path, icon_path)
+
+        if banner_path is None:
+            fname = os.path.splitext(os.path.basename(self.iso_path))[0] + ".png"
+            alt_banner_path = os.path.join(os.path.dirname(self.iso_path), "banners", fname)
+            if not os.path.isfile(alt_banner_path):
+                banner_path = None
+            else:
+                banner_path = os.path.join(temp_image_dir, "bootTvTex.png")
+                shutil.copyfile(alt_banner_path, banner_path)
 
-            # Convert PNG to TGA
-            logger.info("Converting icon/banner to TGA")
-            temp_image_dir = os.path.join(temp_work_dir, "imgs")
-            os.makedirs(temp_image_dir, exist_ok=True)
+        if icon_path is None or banner_path is None:
+            icon, banner = self.fetch_images(fetcher)
 
             if icon_path is None:
-                fname = os.path.splitext(os.path.basename(self.iso_path))[0] + ".png"
-                alt_icon_path = os.path.join(os.path.dirname(self.iso_path), "icons", fname)
-                if not os.path.isfile(alt_icon_path):
-                    icon_path = None
-                else:
-                    icon_path = os.path.join(temp_image_dir, "iconTex.png")
-                    shutil.copyfile(alt_icon_path, icon_path)
+                icon_path = os.path.join(temp_image_dir, "iconTex.png")
+                with open(icon_path, "wb") as f:
+                    f.write(icon)
 
             if banner_path is None:
-                fname = os.path.splitext(os.path.basename(self.iso_path))[0] + ".png"
-                alt_banner_path = os.path.join(os.path.dirname(self.iso_path), "banners", fname)
-                if not os.path.isfile(alt_banner_path):
-                    banner_path = None
-                else:
-                    banner_path = os.path.join(temp_image_dir, "bootTvTex.png")
-                    shutil.copyfile(alt_banner_path, banner_path)
-
-            if icon_path is None or banner_path is None:
-                icon, banner = self.fetch_images()
-
-                if icon_path is None:
-                    icon_path = os.path.join(temp_image_dir, "iconTex.png")
-                    with open(icon_path, "wb") as f:
-                        f.write(icon)
-
-                if banner_path is None:
-                    banner_path = os.path.join(temp_image_dir, "bootTvTex.png")
-                    with open(banner_path, "wb") as f:
-                        f.write(banner)
-
-            TgaConverter.convert(icon_path, "iconTex.tga", build_meta_dir, width=128, height=128, bits_per_pixel=32)
-            TgaConverter.convert(banner_path, "bootTvTex.tga", build_meta_dir, width=1280, height=720, bits_per_pixel=24)
-
-            # For gamepad, use existing banner if separate image not provided
-            logger.info("Converting gamepad banner to TGA")
-            gamepad_banner_path = os.path.join(os.path.dirname(banner_path), "bootDrcTex.png")
-            shutil.copyfile(banner_path, gamepad_banner_path)
-            TgaConverter.convert(gamepad_banner_path, "bootDrcTex.tga", build_meta_dir, width=854, height=480, bits_per_pixel=24)
-
-            # Boot logo. Not mandatory
-            # TODO: Plumb this path
-            """
-            logger.info("Converting boot logo to TGA")
-            TgaConverter.convert(logo_path, "bootLogoTex.tga", build_meta_dir, width=170, height=42, bits_per_pixel=32)
-            """
+                banner_path = os.path.join(temp_image_dir, "bootTvTex.png")
+                with open(banner_path, "wb") as f:
+                    f.write(banner)
 
-            # Convert boot sound if provided
-            # TODO: Implement
-            """
-            logger.info("Converting boot sound to BTSND")
-            //Convert Boot Sound if provided by user
-            if (FlagBootSoundSpecified)
-            {
-                BuildStatus.Text = "Converting user-provided sound to btsnd format...";
-                BuildStatus.Refresh();
-                LauncherExeFile = TempToolsPath + "SOX\\sox.exe";
-                LauncherExeArgs = 
-                    "\"" + OpenBootSound.FileName + "\" -b 16 \"" + TempSoundPath + "\" channels 2 rate 48k trim 0 6";
-                LaunchProgram();
-                File.Delete(TempBuildPath + "meta\\bootSound.btsnd");
-                LauncherExeFile = TempToolsPath + "JAR\\wav2btsnd.exe";
-                LauncherExeArgs = 
-                    "-in \"" + TempSoundPath + "\" -out \"" + TempBuildPath + "meta\\bootSound.btsnd\"" + LoopString;
-                LaunchProgram();
-                File.Delete(TempSoundPath);
-            }
-            """
-
-            # Build ISO
-            logger.info("Building ISO from extracted files")
-            iso_path = self.prepare_iso(temp_work_dir)
-            WiimsISOToolsWrapper.extract_tickets(iso_path, build_code_dir)
-
-            # Convert ISO to NFS
-            # TODO: Handle LR patch (L & R -> ZL & ZR) by adding -lrpatch flag
-            content_path = os.path.join(temp_build_dir, "content")
-            NfsIsoConverter.convert_iso_to_nfs(iso_path, content_path, self.get_nfs_patch_flags())
-
-            # Encrypt with NUSPacker
-            logger.info("Encrypting contents into installable WUP package")
-            NUSPackerWrapper.pack(temp_build_dir, output_path, Config.WiiUCommonKey)
-
-            return output_path
+        return icon_path, banner_path
 
     @abstractmethod
     def prepare_iso(self, temp_work_dir: str) -> str:
@@ -286,6 +363,45 @@ class Title(ABC):
     def get_nfs_patch_flags(self) -> List[str]:
         raise NotImplementedError
 
+    @property
+    def build_options(self) -> Dict[str, Any]:
+        return {}
+
+    @property
+    def input_paths(self) -> List[str]:
+        return [self.iso_path]
+
+    @property
+    def input_size(self) -> int:
+        return sum(os.path.getsize(path) for path in self.input_paths if path is not None and os.path.isfile(path))
+
+    @property
+    def disc_paths(self) -> List[str]:
+        return [self.iso_path]
+
+    @property
+    def disc_size(self) -> int:
+        """Size of the discs once unpacked from their container (WBFS, NASOS, ...)."""
+        size = 0
+        for path in self.disc_paths:
+            with open_disc_image(path) as f:
+                size += f.size
+        return size
+
+    def get_disk_usage(self, output_dir: str, cache: Optional[BuildCache] = None) -> Dict[str, int]:
+        """Estimated peak bytes a build writes to the temp and output folders, and to the build cache if given."""
+        usage = {
+            tempfile.gettempdir(): self.TEMP_SPACE_FACTOR * self.disc_size,
+            output_dir: self.disc_size,
+        }
+        if cache is not None:
+            # The NFS content is stored from the temp folder and the package from the output folder. Each is only
+            # hard linked when it is on the same volume as the cache, and copied otherwise.
+            cache_volume = DiskSpaceBudget.get_volume(cache.directory)[0]
+            usage[cache.directory] = sum(self.disc_size for path in [tempfile.gettempdir(), output_dir]
+                                         if DiskSpaceBudget.get_volume(path)[0] != cache_volume)
+        return usage
+
     @property
     def drcuse(self) -> Literal[1, 65537]:
         return 65537
@@ -350,6 +466,11 @@ class WiiRetailTitle(Title):
         return bytes.fromhex(self.title_id_hex).decode("ascii")
 
     def prepare_iso(self, temp_work_dir: str) -> str:
+        output_iso = os.path.join(temp_work_dir, "game.iso")
+        if not self.needs_patching:
+            logger.info("Copying data partition for NFS conversion")
+            return WiiDisc.rewrite(self.iso_path, output_iso)
+
         # TODO: if trimming disabled, skip everything
         logger.info("Extracting game for NFS conversion")
         with tempfile.TemporaryDirectory(dir=temp_work_dir) as temp_dir_name:
@@ -367,8 +488,23 @@ class WiiRetailTitle(Title):
             LauncherExeArgs = "\"" + TempSourcePath + "ISOEXTRACT\\sys\\main.dol\"";
             """
 
-            return WiimsISOToolsWrapper.rebuild_iso(temp_dir_name, os.path.join(temp_work_dir, "game.iso"),
-                                                    self.use_wiimmfi)
+            return WiimsISOToolsWrapper.rebuild_iso(temp_dir_name, output_iso, self.use_wiimmfi)
+
+    @property
+    def build_options(self) -> Dict[str, Any]:
+        return {"use_wiimmfi": self.use_wiimmfi}
+
+    @property
+    def needs_patching(self) -> bool:
+        # Only these need the partition decrypted and its files rewritten
+        return self.use_wiimmfi
+
+    def get_disk_usage(self, output_dir: str, cache: Optional[BuildCache] = None) -> Dict[str, int]:
+        usage = super().get_disk_usage(output_dir, cache)
+        if self.needs_patching:
+            # The extracted partition sits next to the ISO rebuilt from it
+            usage[tempfile.gettempdir()] += self.disc_size
+        return usage
 
     def get_nfs_patch_flags(self) -> List[str]:
         # TODO: Handle gamepad patches (nfspatchflag)
@@ -402,22 +538,39 @@ class GamecubeRetailTitle(Title):
             if self.force_43:
                 DolCopier.copy_dol("FIX94_nintendont_force43_autoboot.dol", main_dol_path)
             elif self.custom_forwarder:
-                shutil.copyfile(self.custom_forwarder, main_dol_path)
+                FastCopier.link(self.custom_forwarder, main_dol_path)
             elif self.disable_autoboot:
                 DolCopier.copy_dol("FIX94_nintendont_forwarder.dol", main_dol_path)
             else:
                 DolCopier.copy_dol("FIX94_nintendont_default_autoboot.dol", main_dol_path)
 
+            # wit only reads the staged images, so link them in instead of copying gigabytes around
             os.makedirs(dest_iso_path, exist_ok=True)
-            shutil.copyfile(self.iso_path, os.path.join(dest_iso_path, "game.iso"))
+            FastCopier.link(self.iso_path, os.path.join(dest_iso_path, "game.iso"))
             if self.iso_path_2:
-                shutil.copyfile(self.iso_path_2, os.path.join(dest_iso_path, "disc2.iso"))
+                FastCopier.link(self.iso_path_2, os.path.join(dest_iso_path, "disc2.iso"))
 
             return WiimsISOToolsWrapper.rebuild_iso(temp_dir, os.path.join(temp_work_dir, "game.iso"), False)
 
     def get_nfs_patch_flags(self) -> List[str]:
         return ["-enc", "-homebrew", "-passthrough"]
 
+    @property
+    def build_options(self) -> Dict[str, Any]:
+        return {
+            "force_43": self.force_43,
+            "custom_forwarder": self.custom_forwarder is not None,
+            "disable_autoboot": self.disable_autoboot
+        }
+
+    @property
+    def input_paths(self) -> List[str]:
+        return [self.iso_path, self.iso_path_2, self.custom_forwarder]
+
+    @property
+    def disc_paths(self) -> List[str]:
+        return [path for path in [self.iso_path, self.iso_path_2] if path is not None]
+
 
 class WiiWareTitle(Title, ABC):
     SYSTEM_TYPE = "wiiware"
@@ -0,0 +1,188 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import threading
+
+from config import Config
+from disc_header import DiscHeader
+
+logger = logging.getLogger(__name__)
+
+
+class IndexedDisc(NamedTuple):
+    path: str
+    header: DiscHeader
+
+
+class LibraryIndex:
+    """SQLite index of the disc images found under the input folders.
+
+    Headers are only parsed again when a file's size or mtime changes, so rescanning a large library mostly costs a
+    directory walk.
+    """
+    FILENAME = "library.sqlite"
+    EXTENSIONS = {".iso", ".gcm", ".wbfs"}
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS discs (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            title_id INTEGER,
+            game_type INTEGER,
+            game_name TEXT,
+            full_game_id TEXT,
+            disc_number INTEGER,
+            error TEXT
+        )
+    """
+
+    def __init__(self, path: Optional[str] = None, max_workers: int = 16):
+        self.path = os.path.abspath(path or os.path.join(Config.get_cache_dir(), self.FILENAME))
+        self.max_workers = max_workers
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Several build processes may scan at the same time, so wait for the database lock instead of failing
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(self.SCHEMA)
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "LibraryIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @classmethod
+    def is_candidate(cls, name: str) -> bool:
+        return not name.startswith(".") and os.path.splitext(name)[-1].lower() in cls.EXTENSIONS
+
+    def walk(self, roots: Iterable[str]) -> List[Tuple[str, os.stat_result]]:
+        """Find all candidate files under roots, listing directories in parallel."""
+        found = []
+        lock = threading.Lock()
+
+        def scan_dir(directory: str) -> List[str]:
+            subdirs = []
+            files = []
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                        elif entry.is_file() and self.is_candidate(entry.name):
+                            files.append((os.path.abspath(entry.path), entry.stat()))
+            except OSError as e:
+                logger.warning(f"Could not scan {directory}: {e}")
+            with lock:
+                found.extend(files)
+            return subdirs
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = set()
+            for root in roots:
+                if os.path.isfile(root):
+                    found.append((os.path.abspath(root), os.stat(root)))
+                else:
+                    pending.add(executor.submit(scan_dir, root))
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.update(executor.submit(scan_dir, subdir) for subdir in future.result())
+
+        return sorted(found)
+
+    @staticmethod
+    def probe(path: str) -> Tuple[Optional[DiscHeader], Optional[str]]:
+        try:
+            header = DiscHeader.read(path)
+        except Exception as e:
+            # Anything with a matching extension gets here, including truncated and corrupt images
+            return None, str(e) or type(e).__name__
+        if not header.is_wii and not header.is_gamecube:
+            return None, "not a Wii or GameCube disc"
+        return header, None
+
+    @staticmethod
+    def _to_column(header: DiscHeader) -> tuple:
+        # SQLite integers are signed 64 bit, game types are read as unsigned
+        return header._replace(game_type=header.game_type - (1 << 64) if header.game_type >= 1 << 63
+                               else header.game_type)
+
+    @staticmethod
+    def _from_column(row: tuple) -> DiscHeader:
+        header = DiscHeader(*row)
+        return header._replace(game_type=header.game_type & ((1 << 64) - 1))
+
+    def scan(self, roots: Iterable[str]) -> List[IndexedDisc]:
+        files = self.walk(roots)
+
+        rows = {row[0]: row[1:] for row in self.connection.execute(
+            "SELECT path, size, mtime_ns, title_id, game_type, game_name, full_game_id, disc_number, error "
+            "FROM discs")}
+
+        discs = []
+        stale = []
+        for path, st in files:
+            row = rows.get(path)
+            # Files that failed before are probed again, since newer versions may support their format
+            if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns and row[7] is None:
+                header = self._from_column(row[2:7])
+                # Indexes written by older versions also kept headers of files that are not discs
+                if header.is_wii or header.is_gamecube:
+                    discs.append(IndexedDisc(path, header))
+                    continue
+            stale.append((path, st))
+
+        if stale:
+            logger.info(f"Reading headers of {len(stale)} new or changed files")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(self.probe, [path for path, _ in stale]))
+
+            with self.connection:
+                for (path, st), (header, error) in zip(stale, results):
+                    if header is not None:
+                        discs.append(IndexedDisc(path, header))
+                    else:
+                        logger.warning(f"Skipping {path}: {error}")
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO discs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (path, st.st_size, st.st_mtime_ns,
+                         *(self._to_column(header) if header else (None,) * len(DiscHeader._fields)), error))
+
+        logger.info(f"Found {len(discs)} discs in {len(files)} files")
+        return sorted(discs)
+
+    @staticmethod
+    def group_discs(discs: Iterable[IndexedDisc]) -> List[Tuple[IndexedDisc, Optional[IndexedDisc]]]:
+        """Pair up the discs of multi-disc GameCube games using the disc number from their headers.
+
+        Discs are only paired within the same folder, so copies of a game in different folders stay separate. Wii
+        titles are built from a single disc, so every Wii disc becomes a title of its own.
+        """
+        titles = []
+        groups: Dict[Tuple[str, str], List[IndexedDisc]] = {}
+        for disc in discs:
+            if disc.header.is_gamecube:
+                groups.setdefault((os.path.dirname(disc.path), disc.header.full_game_id), []).append(disc)
+            else:
+                titles.append((disc, None))
+
+        for group in groups.values():
+            first_discs = [disc for disc in group if disc.header.disc_number == 0]
+            second_discs = [disc for disc in group if disc.header.disc_number == 1]
+            paired = set()
+            for i, disc in enumerate(first_discs):
+                second_disc = second_discs[i] if i < len(second_discs) else None
+                titles.append((disc, second_disc))
+                paired.update(d.path for d in (disc, second_disc) if d is not None)
+            for disc in group:
+                if disc.path not in paired:
+                    logger.warning(f"Skipping {disc.path}: disc {disc.header.disc_number + 1} without a first disc")
+        return sorted(titles)
@@ -1,10 +1,18 @@
 import os
 import tempfile
 from game import create_title
-import concurrent.futures
+from artwork_fetcher import ArtworkFetcher
+from build_cache import BuildCache
+from build_scheduler import BuildScheduler, DiskSpaceBudget, Resource
+from config import Config
+from cost_model import StageCostModel
+from library_index import LibraryIndex
+from metrics import Metrics, MetricsExporter
 from nus_downloader import NUSDownloader
+from tracing import Tracer
 import logging
 import shutil
+import time
 import argparse
 
 
@@ -13,57 +21,81 @@ logger = logging.getLogger(__name__)
 project_root = os.path.dirname(os.path.abspath(__file__))
 
 
-def build_title(title, output_dir, work_dir):
-    tempfile.tempdir = os.path.normpath(work_dir)
-    print(f"Starting {os.path.basename(title.iso_path)}")
-    return title.build(output_dir)
-
-
-def main(in_dirs, out_dir, work_dir, processes):
+def main(in_dirs, out_dir, work_dir, processes=None, cache_dir=None, use_cache=True, disk_jobs=None, cpu_jobs=None,
+         network_jobs=None, trace_path=None, metrics_port=None, metrics_textfile=None,
+         cache_size=BuildCache.DEFAULT_MAX_SIZE):
     tempfile.tempdir = os.path.normpath(work_dir)
+    Config.CacheDir = cache_dir or Config.CacheDir
     os.makedirs(tempfile.tempdir, exist_ok=True)
     os.makedirs(out_dir, exist_ok=True)
+    NUSDownloader.copy_files()
+
+    with LibraryIndex() as index:
+        discs = index.scan(in_dirs)
+    titles = [create_title(disc.path, disc_2.path if disc_2 else None, header=disc.header)
+              for disc, disc_2 in LibraryIndex.group_discs(discs)]
+
+    # One fetcher for the whole batch, so every build shares its connections
+    fetcher = ArtworkFetcher()
+    # Warm the artwork cache for the whole library up front, so builds don't wait on downloads one by one
+    fetcher.prefetch([title.get_candidate_urls() for title in titles])
+
+    failed_titles = []
+    print(f"Converting {len(titles)} titles")
+
+    limits = {resource: jobs for resource, jobs in [(Resource.DISK, disk_jobs), (Resource.CPU, cpu_jobs),
+                                                     (Resource.NETWORK, network_jobs)] if jobs}
+    scheduler = BuildScheduler(limits, max_titles=processes, disk_budget=DiskSpaceBudget())
+    cache = BuildCache(max_size=cache_size) if use_cache else None
+
+    # Start the longest builds first, so a big dual layer disc doesn't end up running alone at the end
+    with StageCostModel() as cost_model:
+        predictions = {id(title): [(stage.resource, cost_model.predict(stage.name, title.input_size))
+                                   for stage in title.get_stages()] for title in titles}
+    titles.sort(key=lambda title: sum(duration for _, duration in predictions[id(title)]), reverse=True)
+    predicted_makespan = scheduler.simulate(predictions[id(title)] for title in titles)
+
+    async def build(title):
+        print(f"Starting {os.path.basename(title.iso_path)}")
+        return await title.build_async(out_dir, cache=cache, scheduler=scheduler, fetcher=fetcher)
+
+    if trace_path:
+        trace_dir = tempfile.mkdtemp(prefix="trace_")
+        Tracer.enable(trace_dir)
+
+    exporter = None
+    if metrics_port is not None or metrics_textfile:
+        metrics_dir = tempfile.mkdtemp(prefix="metrics_")
+        Metrics.enable(metrics_dir)
+        exporter = MetricsExporter(metrics_dir, metrics_port, metrics_textfile)
+        exporter.start()
+
+    start_time = time.monotonic()
     try:
-        NUSDownloader.copy_files()
-
-        titles = []
-        for in_path in in_dirs:
-            if os.path.isfile(in_path):
-                titles.append(create_title(os.path.normpath(in_path)))
-            else:
-                with os.scandir(in_path) as it:
-                    for entry in it:
-                        if (not entry.name.startswith(".")) and entry.is_file() and os.path.splitext(entry.name)[-1] == ".iso":
-                            if "(Disc 2)" in entry.name:
-                                continue
-                            elif "(Disc 1)" in entry.name:
-                                disc_1_path = os.path.normpath(entry.path)
-                                disc_2_path = disc_1_path.replace("(Disc 1)", "(Disc 2)")
-                                titles.append(create_title(disc_1_path, disc_2_path))
-                            else:
-                                titles.append(create_title(os.path.normpath(entry.path)))
-
-        failed_titles = []
-        print(f"Converting {len(titles)} titles")
-
-        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
-            # Start the load operations and mark each future with its URL
-            future_to_title = {executor.submit(build_title, title, out_dir, work_dir): title for title in titles}
-            for future in concurrent.futures.as_completed(future_to_title):
-                title = future_to_title[future]
-                try:
-                    output_path = future.result()
-                    print(f"{os.path.basename(title.iso_path)} -> {output_path}")
-                except Exception as e:
-                    print('%r generated an exception: %s' % (title.iso_path, e))
-                    failed_titles.append(title)
-
-        print([title.iso_path for title in failed_titles])
+        results = scheduler.run(titles, build, lambda title: title.get_disk_usage(out_dir, cache))
     finally:
-        try:
-            shutil.rmtree(tempfile.tempdir)
-        except Exception:
-            pass
+        fetcher.close()
+        if trace_path:
+            Tracer.export(trace_path, trace_dir)
+            Tracer.disable()
+            shutil.rmtree(trace_dir, ignore_errors=True)
+        if exporter is not None:
+            exporter.stop()
+            Metrics.disable()
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+    makespan = time.monotonic() - start_time
+    with StageCostModel() as cost_model:
+        cost_model.record(scheduler.timings)
+    print(f"Built {len(titles)} titles in {makespan:.0f}s (predicted {predicted_makespan:.0f}s)")
+
+    for title, output_path, e in results:
+        if e is None:
+            print(f"{os.path.basename(title.iso_path)} -> {output_path}")
+        else:
+            print('%r generated an exception: %s' % (title.iso_path, e))
+            failed_titles.append(title)
+
+    print([title.iso_path for title in failed_titles])
 
 
 if __name__ == '__main__':
@@ -73,9 +105,38 @@ if __name__ == '__main__':
     parser.add_argument('--output', type=str, nargs='?', default=os.path.abspath("output"),
                         help=f'Path to output folder. Default output folder is {os.path.abspath("output")}.')
     parser.add_argument('--temp', type=str, nargs='?', default=tempfile.gettempdir(),
-                        help='Path to folder to use for temp storage. Default folder is the system temp directory.')
-    parser.add_argument('--processes', type=int, nargs='?', default=1,
-                        help='Number of concurrent processes. Default is 1')
+                        help='Path to folder to use for temp storage. Unfinished builds are kept here and resumed on '
+                             'the next run. Default folder is the system temp directory.')
+    parser.add_argument('--processes', type=int, nargs='?', default=None,
+                        help='Maximum number of titles to build concurrently. '
+                             'Default is one more than the number of disk and CPU jobs combined.')
+    parser.add_argument('--disk-jobs', type=int, nargs='?', default=None,
+                        help=f'Number of disk heavy build stages to run at once. '
+                             f'Default is {BuildScheduler.DEFAULT_LIMITS[Resource.DISK]}')
+    parser.add_argument('--cpu-jobs', type=int, nargs='?', default=None,
+                        help=f'Number of CPU heavy build stages to run at once. Each one uses every core. '
+                             f'Default is {BuildScheduler.DEFAULT_LIMITS[Resource.CPU]}')
+    parser.add_argument('--network-jobs', type=int, nargs='?', default=None,
+                        help=f'Number of network bound build stages to run at once. '
+                             f'Default is {BuildScheduler.DEFAULT_LIMITS[Resource.NETWORK]}')
+    parser.add_argument('--cache-dir', type=str, nargs='?', default=None,
+                        help='Path to folder to cache downloaded base files and finished packages in. '
+                             'Default is a folder in the user cache directory.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always build packages from scratch instead of reusing cached builds.')
+    parser.add_argument('--cache-size', type=float, nargs='?', default=BuildCache.DEFAULT_MAX_SIZE / 2**30,
+                        help=f'Size in GiB the build cache is kept under by evicting the builds used longest ago. '
+                             f'Default is {BuildCache.DEFAULT_MAX_SIZE / 2**30:g}.')
+    parser.add_argument('--trace', type=str, nargs='?', default=None,
+                        help='Write a Chrome trace_event JSON file of every build stage, tool run and worker to this '
+                             'path, for viewing in chrome://tracing or Perfetto.')
+    parser.add_argument('--metrics-port', type=int, nargs='?', default=None,
+                        help='Serve OpenMetrics on http://127.0.0.1:PORT/metrics while the batch runs.')
+    parser.add_argument('--metrics-textfile', type=str, nargs='?', default=None,
+                        help='Rewrite OpenMetrics to this file every 15 seconds while the batch runs, e.g. for the '
+                             'node_exporter textfile collector.')
     args = parser.parse_args()
 
-    main(args.input, args.output, args.temp, args.processes)
+    main(args.input, args.output, args.temp, args.processes, args.cache_dir, not args.no_cache, args.disk_jobs,
+         args.cpu_jobs, args.network_jobs, args.trace, args.metrics_port, args.metrics_textfile,
+         int(args.cache_size * 2**30))
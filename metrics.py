@@ -0,0 +1,309 @@
+from typing import Any, Dict, List, Optional, Tuple
+import glob
+import http.server
+import json
+import logging
+import multiprocessing.util
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from atomic_file import AtomicFile
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Counters, gauges and histograms shared by every process of a batch.
+
+    Each process keeps its own totals in memory and writes them to its own file in a metrics directory at most every
+    FLUSH_INTERVAL seconds and when it exits. Worker processes find the directory through an environment variable.
+    Collecting sums the files of all processes, so worker processes never need to talk to the parent. Updates are free
+    when metrics are off.
+    """
+    ENV_VAR = "PYWIIUINJECTOR_METRICS_DIR"
+    PREFIX = "pywiiuinjector_"
+
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+    FAMILIES = {
+        "titles": (GAUGE, "Titles in the batch, by state."),
+        "stage_runs": (COUNTER, "Build stages run."),
+        "stage_bytes": (COUNTER, "Input bytes of the titles that went through each build stage."),
+        "stage_seconds": (COUNTER, "Time spent running each build stage."),
+        "stage_throughput_bytes_per_second": (GAUGE, "Input bytes per second of the latest run of each build stage."),
+        "worker_bytes": (COUNTER, "Bytes processed by worker processes, by the stage they work for."),
+        "tool_duration_seconds": (HISTOGRAM, "Wall time of external tool runs."),
+        "last_progress_timestamp_seconds": (GAUGE, "Unix time of the latest finished stage, tool run or worker task."),
+        "temp_bytes": (GAUGE, "Bytes used by files in the temp folder."),
+        "temp_free_bytes": (GAUGE, "Free bytes on the volume of the temp folder."),
+    }
+    BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+    FLUSH_INTERVAL = 1.0
+
+    _lock = threading.Lock()
+    # Only held while writing, so updates never wait on the disk
+    _flush_lock = threading.Lock()
+    _flush_timer: Optional[threading.Timer] = None
+    _values: Dict[Tuple[str, Labels], float] = {}
+    # Per bucket counts (not cumulative), then sum, then count
+    _histograms: Dict[Tuple[str, Labels], List[float]] = {}
+    _pid: Optional[int] = None
+
+    @classmethod
+    def enable(cls, metrics_dir: str) -> None:
+        os.makedirs(metrics_dir, exist_ok=True)
+        # Inherited by every process started from here on
+        os.environ[cls.ENV_VAR] = os.path.abspath(metrics_dir)
+
+    @classmethod
+    def disable(cls) -> None:
+        os.environ.pop(cls.ENV_VAR, None)
+
+    @classmethod
+    def get_metrics_dir(cls) -> Optional[str]:
+        return os.environ.get(cls.ENV_VAR)
+
+    @classmethod
+    def _update(cls, name: str, labels: Dict[str, Any], value: float, mode: str) -> None:
+        metrics_dir = cls.get_metrics_dir()
+        if metrics_dir is None:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with cls._lock:
+            # A forked worker inherits the parent's totals, which the parent already reports
+            if cls._pid != os.getpid():
+                cls._values = {}
+                cls._histograms = {}
+                cls._flush_timer = None
+                cls._pid = os.getpid()
+                # Worker processes leave through os._exit, which skips atexit handlers but not multiprocessing's
+                # finalizers, and the main process runs those at exit too
+                multiprocessing.util.Finalize(None, cls.flush, exitpriority=0)
+
+            if mode == cls.HISTOGRAM:
+                histogram = cls._histograms.setdefault(key, [0.0] * (len(cls.BUCKETS) + 3))
+                bucket = next((i for i, bound in enumerate(cls.BUCKETS) if value <= bound), len(cls.BUCKETS))
+                histogram[bucket] += 1
+                histogram[-2] += value
+                histogram[-1] += 1
+            elif mode == "set":
+                cls._values[key] = value
+            else:
+                cls._values[key] = cls._values.get(key, 0.0) + value
+
+            if cls._flush_timer is None:
+                cls._flush_timer = threading.Timer(cls.FLUSH_INTERVAL, cls.flush)
+                cls._flush_timer.daemon = True
+                cls._flush_timer.start()
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels: Any) -> None:
+        """Add to a counter, or to a gauge that several processes contribute to."""
+        cls._update(name, labels, value, "add")
+
+    @classmethod
+    def set(cls, name: str, value: float, **labels: Any) -> None:
+        cls._update(name, labels, value, "set")
+
+    @classmethod
+    def observe(cls, name: str, value: float, **labels: Any) -> None:
+        cls._update(name, labels, value, cls.HISTOGRAM)
+
+    @classmethod
+    def progress(cls) -> None:
+        cls.set("last_progress_timestamp_seconds", time.time())
+
+    @classmethod
+    def flush(cls) -> None:
+        """Write this process' totals now, instead of when the next flush is due."""
+        metrics_dir = cls.get_metrics_dir()
+        with cls._flush_lock:
+            with cls._lock:
+                if cls._flush_timer is None or cls._pid != os.getpid():
+                    return
+                cls._flush_timer.cancel()
+                cls._flush_timer = None
+                data = {
+                    "values": [[name, dict(labels), value] for (name, labels), value in cls._values.items()],
+                    "histograms": [[name, dict(labels), list(histogram)]
+                                   for (name, labels), histogram in cls._histograms.items()],
+                }
+            if metrics_dir is None:
+                return
+            # Not named *.json until complete, so collect() skips it
+            with AtomicFile(os.path.join(metrics_dir, f"{os.getpid()}.json"), "w", suffix=".tmp") as f:
+                json.dump(data, f)
+
+    @classmethod
+    def collect(cls, metrics_dir: Optional[str] = None) -> Tuple[Dict[Tuple[str, Labels], float],
+                                                                 Dict[Tuple[str, Labels], List[float]]]:
+        """Totals of every process, as (values, histograms)."""
+        metrics_dir = metrics_dir or cls.get_metrics_dir()
+        values: Dict[Tuple[str, Labels], float] = {}
+        histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        for path in glob.glob(os.path.join(glob.escape(metrics_dir), "*.json")):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for name, labels, value in data["values"]:
+                key = (name, tuple(sorted(labels.items())))
+                if name == "last_progress_timestamp_seconds":
+                    values[key] = max(values.get(key, 0.0), value)
+                else:
+                    values[key] = values.get(key, 0.0) + value
+            for name, labels, histogram in data["histograms"]:
+                key = (name, tuple(sorted(labels.items())))
+                total = histograms.setdefault(key, [0.0] * len(histogram))
+                histograms[key] = [a + b for a, b in zip(total, histogram)]
+        return values, histograms
+
+    @staticmethod
+    def _format_labels(labels: Labels) -> str:
+        if not labels:
+            return ""
+        escaped = [(k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        return str(int(value)) if value == int(value) and abs(value) < 2**53 else repr(value)
+
+    @classmethod
+    def render(cls, values: Dict[Tuple[str, Labels], float], histograms: Dict[Tuple[str, Labels], List[float]]) -> str:
+        """OpenMetrics text exposition of collected totals."""
+        lines = []
+        for family, (metric_type, help_text) in cls.FAMILIES.items():
+            name = cls.PREFIX + family
+            samples = []
+            for (sample_family, labels), value in sorted(values.items()):
+                if sample_family == family:
+                    suffix = "_total" if metric_type == cls.COUNTER else ""
+                    samples.append(f"{name}{suffix}{cls._format_labels(labels)} {cls._format_value(value)}")
+            for (sample_family, labels), histogram in sorted(histograms.items()):
+                if sample_family == family:
+                    cumulative = 0.0
+                    for bound, count in zip([*map(str, cls.BUCKETS), "+Inf"], histogram):
+                        cumulative += count
+                        samples.append(f"{name}_bucket{cls._format_labels(labels + (('le', bound),))} {cls._format_value(cumulative)}")
+                    samples.append(f"{name}_sum{cls._format_labels(labels)} {cls._format_value(histogram[-2])}")
+                    samples.append(f"{name}_count{cls._format_labels(labels)} {cls._format_value(histogram[-1])}")
+            if samples:
+                lines += [f"# TYPE {name} {metric_type}", f"# HELP {name} {help_text}", *samples]
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Serves the metrics of a batch over HTTP and/or rewrites them to a textfile every interval seconds.
+
+    Collecting reads the file of every process and walks the temp folder, so the result is reused for max_age seconds
+    and scrapes in between are answered from memory.
+    """
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, metrics_dir: str, port: Optional[int] = None, textfile: Optional[str] = None,
+                 interval: float = 15, host: str = "127.0.0.1", max_age: float = 5):
+        self.metrics_dir = metrics_dir
+        self.port = port
+        self.textfile = textfile
+        self.interval = interval
+        self.host = host
+        self.max_age = max_age
+        self.server: Optional[http.server.ThreadingHTTPServer] = None
+        self._lock = threading.Lock()
+        self._rendered: Optional[Tuple[float, str]] = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def get_temp_usage(self) -> Tuple[int, int]:
+        temp_dir = tempfile.gettempdir()
+        used = 0
+        for dirpath, _, filenames in os.walk(temp_dir):
+            for name in filenames:
+                try:
+                    used += os.lstat(os.path.join(dirpath, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return used, shutil.disk_usage(temp_dir).free
+
+    def collect(self) -> str:
+        values, histograms = Metrics.collect(self.metrics_dir)
+        used, free = self.get_temp_usage()
+        values[("temp_bytes", ())] = used
+        values[("temp_free_bytes", ())] = free
+        return Metrics.render(values, histograms)
+
+    def render(self, max_age: Optional[float] = None) -> str:
+        max_age = self.max_age if max_age is None else max_age
+        # Scrapes that arrive together wait for one collection instead of each starting their own
+        with self._lock:
+            if self._rendered is None or time.monotonic() - self._rendered[0] >= max_age:
+                self._rendered = (time.monotonic(), self.collect())
+            return self._rendered[1]
+
+    def write_textfile(self, max_age: Optional[float] = None) -> None:
+        AtomicFile.write(self.textfile, self.render(max_age), suffix=".tmp")
+
+    def _textfile_loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write_textfile()
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {self.textfile}: {e}")
+
+    def start(self) -> None:
+        if self.port is not None:
+            exporter = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    if self.path.split("?")[0] not in ["/", "/metrics"]:
+                        self.send_error(404)
+                        return
+                    body = exporter.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", MetricsExporter.CONTENT_TYPE)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format: str, *args: Any) -> None:
+                    logger.debug(f"Metrics request: {format % args}")
+
+            self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+            self._threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+            logger.info(f"Serving metrics on http://{self.host}:{self.server.server_port}/metrics")
+
+        if self.textfile is not None:
+            self._threads.append(threading.Thread(target=self._textfile_loop, daemon=True))
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.textfile is not None:
+            # Leave the final totals behind
+            Metrics.flush()
+            self.write_textfile(max_age=0)
+
+    def __enter__(self) -> "MetricsExporter":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
@@ -1,26 +1,363 @@
-from typing import List
+from typing import BinaryIO, List, Optional, Tuple
 from tools import Nfs2Iso2Nfs
+from config import Config
+from disc_image import open_disc_image
+from metrics import Metrics
+from tracing import Tracer
+from wii_disc import WiiDisc, WiiPartition
+import bisect
+import concurrent.futures
+import glob
+import io
+import logging
+import mmap
+import multiprocessing
 import os
-from contextlib import contextmanager
+import struct
+import tempfile
+import time
+from Crypto.Cipher import AES
 
+logger = logging.getLogger(__name__)
 
-@contextmanager
-def chdir(directory):
-    cwd = os.getcwd()
-    try:
-        os.chdir(directory)
-        yield directory
-    except FileNotFoundError:
-        yield
-    finally:
-        os.chdir(cwd)
+# (data start, data end, decrypted title key) for every encrypted Wii partition on the disc
+PartitionKeys = List[Tuple[int, int, bytes]]
+
+
+@Tracer.traced("worker")
+def _encrypt_blocks(key: bytes, first_block: int, data: bytes, partitions: PartitionKeys) -> bytes:
+    # Runs in a worker process, so everything it needs is passed in explicitly
+    block_size = NfsIsoConverter.BLOCK_SIZE
+    out = bytearray(len(data))
+    for i in range(0, len(data), block_size):
+        block = first_block + i // block_size
+        buf = data[i:i + block_size]
+        offset = block * block_size
+        for start, end, title_key in partitions:
+            if start <= offset < end:
+                # Wii U VC discs store Wii partitions decrypted but with their hash blocks intact
+                hashes = AES.new(title_key, AES.MODE_CBC, iv=bytes(16)).decrypt(buf[:0x400])
+                body = AES.new(title_key, AES.MODE_CBC, iv=buf[0x3D0:0x3E0]).decrypt(buf[0x400:])
+                buf = hashes + body
+                break
+        iv = bytes(8) + block.to_bytes(8, byteorder="big")
+        out[i:i + block_size] = AES.new(key, AES.MODE_CBC, iv=iv).encrypt(buf)
+    Metrics.inc("worker_bytes", len(data), stage="nfs")
+    Metrics.progress()
+    return bytes(out)
 
 
 class NfsIsoConverter:
-    @staticmethod
-    def convert_iso_to_nfs(source_iso: str, output_path: str, flags: List[str]):
-        with chdir(output_path):
-            p = Nfs2Iso2Nfs.run([*flags, "-iso", source_iso])
+    """Converts ISOs to the NFS format of Wii U virtual console titles, natively where possible.
+
+    The native writer produces the same hif_*.nfs parts as nfs2iso2nfs: one range header, then every 0x8000 byte
+    block of the ISO encrypted with the htk.bin key, with Wii partitions decrypted first and byte 0x61 of the disc
+    header set. Whatever nfs2iso2nfs patches into code/fw.img is still left to nfs2iso2nfs itself, which runs on a
+    small placeholder cut from the real disc instead of the whole of it. Flags the native writer doesn't know fall
+    back to running nfs2iso2nfs on the whole ISO.
+    """
+    BLOCK_SIZE = 0x8000
+    HEADER_SIZE = 0x200
+    MAX_FILE_SIZE = 0xFA00000
+    HEADER_MAGIC = b"EGGS"
+    HEADER_END_MAGIC = b"SGGE"
+    HEADER_VERSION = 0x00011011
+
+    # Blocks handed to a worker per task (8 MiB)
+    CHUNK_BLOCKS = 0x100
+    # Clusters of the data partition kept in the placeholder that nfs2iso2nfs patches fw.img with
+    WII_PLACEHOLDER_CLUSTERS = 16
+
+    WII_MAGIC = 0x5D1C9EA3
+    # Flags that only patch code/fw.img and have no effect on the NFS contents
+    FIRMWARE_PATCH_FLAGS = {"-lrpatch", "-wiimote", "-horizontal", "-passthrough", "-instantcc", "-nocc"}
+
+    @classmethod
+    def convert_iso_to_nfs(cls, source_iso: str, output_path: str, flags: List[str],
+                           processes: Optional[int] = None) -> str:
+        if not cls.can_convert_natively(source_iso, flags):
+            os.makedirs(output_path, exist_ok=True)
+            p = Nfs2Iso2Nfs.run([*flags, "-iso", source_iso], cwd=output_path)
             p.check_returncode()
+            return output_path
+
+        key = cls.read_key(output_path)
+        with open_disc_image(source_iso) as f:
+            cls.patch_firmware_with_tool(output_path, flags, f)
+            partitions = [] if "-homebrew" in flags else cls.get_partition_keys(f)
+            cls.write_nfs(f, f.size, output_path, key, partitions, processes)
 
         return output_path
+
+    @classmethod
+    def can_convert_natively(cls, source_iso: str, flags: List[str]) -> bool:
+        if "-enc" not in flags or set(flags) - cls.FIRMWARE_PATCH_FLAGS - {"-enc", "-homebrew"}:
+            return False
+        if "-homebrew" in flags:
+            return True
+
+        # Retail Wii discs have their partitions decrypted, which needs the Wii common key
+        if Config.WiiCommonKey is None:
+            logger.info("WiiCommonKey is not set in config.json, converting with nfs2iso2nfs")
+            return False
+        with open_disc_image(source_iso) as f:
+            f.seek(0x18)
+            return int.from_bytes(f.read(4), byteorder="big") == cls.WII_MAGIC
+
+    @staticmethod
+    def read_key(output_path: str) -> bytes:
+        # Same default as nfs2iso2nfs, which is always run from inside content/
+        with open(os.path.join(output_path, os.pardir, "code", "htk.bin"), "rb") as f:
+            return f.read(16)
+
+    @staticmethod
+    def get_partition_keys(f: BinaryIO) -> PartitionKeys:
+        common_key = bytes.fromhex(Config.WiiCommonKey)
+        partitions = []
+        for partition in WiiDisc.get_partitions(f):
+            f.seek(partition.offset)
+            ticket = f.read(0x2A4)
+            title_key = AES.new(common_key, AES.MODE_CBC, iv=ticket[0x1DC:0x1E4] + bytes(8)).decrypt(
+                ticket[0x1BF:0x1CF])
+            partitions.append((partition.offset + partition.data_offset, partition.end, title_key))
+        return partitions
+
+    @classmethod
+    def build_header(cls, num_blocks: int) -> bytes:
+        header = struct.pack(">4sIIII", cls.HEADER_MAGIC, cls.HEADER_VERSION, 0, 0, 1)
+        header += struct.pack(">II", 0, num_blocks)
+        return header.ljust(cls.HEADER_SIZE - len(cls.HEADER_END_MAGIC), b"\x00") + cls.HEADER_END_MAGIC
+
+    @classmethod
+    def write_nfs(cls, f: BinaryIO, size: int, output_path: str, key: bytes, partitions: PartitionKeys,
+                  processes: Optional[int] = None) -> None:
+        os.makedirs(output_path, exist_ok=True)
+        num_blocks = (size + cls.BLOCK_SIZE - 1) // cls.BLOCK_SIZE
+        chunk_size = cls.CHUNK_BLOCKS * cls.BLOCK_SIZE
+        processes = processes or os.cpu_count() or 1
+        start_time = time.monotonic()
+
+        # Builds run their stages in threads, and forking while another thread holds a lock (logging, metrics,
+        # tracing) would leave it locked forever in the worker, so workers start as fresh processes
+        with _NfsPartWriter(output_path, cls.MAX_FILE_SIZE) as writer,\
+                concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                       mp_context=multiprocessing.get_context("spawn")) as executor:
+            writer.write(cls.build_header(num_blocks))
+
+            pending = []
+            f.seek(0)
+            for first_block in range(0, num_blocks, cls.CHUNK_BLOCKS):
+                data = f.read(chunk_size)
+                if len(data) % cls.BLOCK_SIZE:
+                    data = data.ljust(len(data) + cls.BLOCK_SIZE - len(data) % cls.BLOCK_SIZE, b"\x00")
+                if first_block == 0 and partitions:
+                    # Tell the loader the partitions are no longer encrypted
+                    data = data[:0x61] + b"\x01" + data[0x62:]
+                pending.append(executor.submit(_encrypt_blocks, key, first_block, data, partitions))
+
+                # Keep a bounded number of chunks in flight and write them out in order
+                while len(pending) >= processes * 2:
+                    writer.write(pending.pop(0).result())
+            for future in pending:
+                writer.write(future.result())
+
+        elapsed = max(time.monotonic() - start_time, 1e-9)
+        logger.info(f"Wrote {num_blocks * cls.BLOCK_SIZE / 2**20:.1f} MiB of NFS data in {elapsed:.1f}s "
+                    f"({num_blocks * cls.BLOCK_SIZE / 2**20 / elapsed:.1f} MB/s)")
+
+    @classmethod
+    def patch_firmware_with_tool(cls, output_path: str, flags: List[str], f: BinaryIO) -> None:
+        """Patch ../code/fw.img by running nfs2iso2nfs, without having it convert the whole of disc f.
+
+        nfs2iso2nfs patches fw.img in place as a side effect of a conversion, so run it on a placeholder cut from f
+        with code/ linked in and throw the resulting NFS away.
+        """
+        code_dir = os.path.abspath(os.path.join(output_path, os.pardir, "code"))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            scratch_content_dir = os.path.join(temp_dir, "content")
+            os.makedirs(scratch_content_dir)
+            os.symlink(code_dir, os.path.join(temp_dir, "code"), target_is_directory=True)
+            placeholder_iso = os.path.join(temp_dir, "placeholder.iso")
+            cls.write_placeholder(f, placeholder_iso, "-homebrew" in flags)
+
+            p = Nfs2Iso2Nfs.run([*flags, "-iso", placeholder_iso], cwd=scratch_content_dir)
+            p.check_returncode()
+
+    @classmethod
+    def write_placeholder(cls, f: BinaryIO, path: str, homebrew: bool) -> None:
+        """Write a small disc of the same kind as f: the first block of homebrew and GameCube discs, and for retail
+        Wii discs the header area and the first data partition, moved right after it and cut down to a few clusters.
+        """
+        f.seek(0)
+        if homebrew:
+            with open(path, "wb") as out:
+                out.write(f.read(cls.BLOCK_SIZE).ljust(cls.BLOCK_SIZE, b"\x00"))
+            return
+
+        partitions = [p for p in WiiDisc.get_partitions(f) if p.type == WiiDisc.PARTITION_TYPE_DATA]
+        if not partitions:
+            raise ValueError(f"{getattr(f, 'path', f)} does not contain a data partition")
+        partition = partitions[0]
+        data_size = min(partition.data_size, cls.WII_PLACEHOLDER_CLUSTERS * cls.BLOCK_SIZE)
+        placeholder = WiiPartition(WiiDisc.HEADER_AREA_SIZE, partition.type, partition.data_offset, data_size)
+
+        f.seek(0)
+        header = bytearray(f.read(WiiDisc.HEADER_AREA_SIZE))
+        table = WiiDisc.build_partition_table([placeholder])
+        header[WiiDisc.PARTITION_TABLE_OFFSET:WiiDisc.PARTITION_TABLE_OFFSET + 0x100] = table.ljust(0x100, b"\x00")
+        f.seek(partition.offset)
+        partition_header = bytearray(f.read(partition.data_offset))
+        partition_header[0x2B8:0x2C0] = struct.pack(">II", partition.data_offset >> 2, data_size >> 2)
+        f.seek(partition.offset + partition.data_offset)
+        with open(path, "wb") as out:
+            out.write(header)
+            out.write(partition_header)
+            out.write(f.read(data_size))
+
+
+class _NfsPartWriter:
+    """Writes a continuous stream across hif_XXXXXX.nfs files of at most max_file_size bytes each."""
+
+    def __init__(self, output_path: str, max_file_size: int):
+        self.output_path = output_path
+        self.max_file_size = max_file_size
+        self.index = 0
+        self.remaining = 0
+        self.f = None
+
+    def __enter__(self) -> "_NfsPartWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.f is not None:
+            self.f.close()
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            if self.remaining == 0:
+                if self.f is not None:
+                    self.f.close()
+                self.f = open(os.path.join(self.output_path, f"hif_{self.index:06d}.nfs"), "wb")
+                self.index += 1
+                self.remaining = self.max_file_size
+            n = min(self.remaining, len(view))
+            self.f.write(view[:n])
+            self.remaining -= n
+            view = view[n:]
+
+
+class NfsReader(io.RawIOBase):
+    """Read-only, seekable view of the ISO stored in a folder of hif_XXXXXX.nfs files.
+
+    The parts are memory-mapped and only the blocks that are actually read get decrypted, so single structures
+    (disc header, partition table, ...) can be pulled out of a package without converting it back to an ISO.
+    Wii partitions are returned the way they are stored, i.e. already decrypted.
+    """
+
+    def __init__(self, content_path: str, key: Optional[bytes] = None):
+        super().__init__()
+        if key is None:
+            key = NfsIsoConverter.read_key(content_path)
+        self.key = key
+
+        paths = sorted(glob.glob(os.path.join(glob.escape(content_path), "hif_*.nfs")))
+        if not paths:
+            raise FileNotFoundError(f"No NFS files found in {content_path}")
+        self._files = [open(path, "rb") for path in paths]
+        self._maps = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) for f in self._files]
+
+        header = self._maps[0][:NfsIsoConverter.HEADER_SIZE]
+        magic, _, _, _, range_count = struct.unpack(">4sIIII", header[:20])
+        if magic != NfsIsoConverter.HEADER_MAGIC or not header.endswith(NfsIsoConverter.HEADER_END_MAGIC):
+            raise ValueError(f"{paths[0]} is not an NFS file")
+
+        # Logical start block, physical start block and length of every stored range
+        self._ranges = []
+        physical_block = 0
+        for i in range(range_count):
+            start, length = struct.unpack_from(">II", header, 20 + i * 8)
+            self._ranges.append((start, physical_block, length))
+            physical_block += length
+        self._ranges.sort()
+        self._range_starts = [start for start, _, _ in self._ranges]
+        self.size = max((start + length for start, _, length in self._ranges), default=0) * NfsIsoConverter.BLOCK_SIZE
+
+        self._position = 0
+        self._cached_block = None
+
+    @classmethod
+    def from_build_dir(cls, build_dir: str) -> "NfsReader":
+        return cls(os.path.join(build_dir, "content"))
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        block_size = NfsIsoConverter.BLOCK_SIZE
+        n = max(min(len(view), self.size - self._position), 0)
+        written = 0
+        while written < n:
+            block, offset = divmod(self._position, block_size)
+            count = min(block_size - offset, n - written)
+            view[written:written + count] = self.read_block(block)[offset:offset + count]
+            written += count
+            self._position += count
+        return written
+
+    def read_block(self, block: int) -> bytes:
+        if self._cached_block is not None and self._cached_block[0] == block:
+            return self._cached_block[1]
+
+        block_size = NfsIsoConverter.BLOCK_SIZE
+        i = bisect.bisect_right(self._range_starts, block) - 1
+        if i < 0 or block >= self._ranges[i][0] + self._ranges[i][2]:
+            # Blocks outside of the stored ranges were never written
+            data = bytes(block_size)
+        else:
+            start, physical_start, _ = self._ranges[i]
+            encrypted = self._read_physical(NfsIsoConverter.HEADER_SIZE + (physical_start + block - start) * block_size,
+                                            block_size)
+            iv = bytes(8) + block.to_bytes(8, byteorder="big")
+            data = AES.new(self.key, AES.MODE_CBC, iv=iv).decrypt(encrypted)
+
+        self._cached_block = (block, data)
+        return data
+
+    def _read_physical(self, offset: int, size: int) -> bytes:
+        # The header shifts every block by 0x200 bytes, so blocks can straddle two parts
+        chunks = []
+        while size > 0:
+            index, file_offset = divmod(offset, NfsIsoConverter.MAX_FILE_SIZE)
+            chunk = self._maps[index][file_offset:file_offset + size]
+            if not chunk:
+                raise EOFError(f"NFS data ends before offset {offset:#x}")
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        if not self.closed:
+            for m in self._maps:
+                m.close()
+            for f in self._files:
+                f.close()
+        super().close()
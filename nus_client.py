@@ -0,0 +1,308 @@
+from typing import Dict, Iterator, NamedTuple, Optional
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from Crypto.Cipher import AES
+
+from atomic_file import AtomicFile
+
+logger = logging.getLogger(__name__)
+
+
+class TmdContent(NamedTuple):
+    id: int
+    index: int
+    type: int
+    size: int
+    hash: bytes
+
+    @property
+    def hashed(self) -> bool:
+        return bool(self.type & 0x2)
+
+
+class FstContent(NamedTuple):
+    offset: int
+    size: int
+    owner_title_id: int
+    group_id: int
+    hash_mode: int
+
+
+class FstEntry(NamedTuple):
+    path: str
+    offset: int
+    size: int
+    content_index: int
+
+
+class Tmd:
+    CONTENT_COUNT_OFFSET = 0x1DE
+    CONTENT_RECORDS_OFFSET = 0xB04
+    CONTENT_RECORD_SIZE = 0x30
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.title_id = data[0x18C:0x194]
+        num_contents = struct.unpack_from(">H", data, self.CONTENT_COUNT_OFFSET)[0]
+        self.contents = []
+        for i in range(num_contents):
+            offset = self.CONTENT_RECORDS_OFFSET + i * self.CONTENT_RECORD_SIZE
+            content_id, index, content_type, size = struct.unpack_from(">IHHQ", data, offset)
+            self.contents.append(TmdContent(content_id, index, content_type, size, data[offset + 0x10:offset + 0x24]))
+
+    @property
+    def size(self) -> int:
+        return self.CONTENT_RECORDS_OFFSET + len(self.contents) * self.CONTENT_RECORD_SIZE
+
+    @property
+    def certificates(self) -> bytes:
+        # NUS appends the certificate chain needed to verify the TMD
+        return self.data[self.size:]
+
+
+def split_certificates(data: bytes) -> Dict[str, bytes]:
+    """Splits a concatenated certificate chain into its certificates, keyed by name."""
+    signature_sizes = {0x10000: 0x23C, 0x10001: 0x13C, 0x10002: 0x7C, 0x10003: 0x23C, 0x10004: 0x13C, 0x10005: 0x7C}
+    key_sizes = {0: 0x238, 1: 0x138, 2: 0x78}
+
+    certificates = {}
+    offset = 0
+    while offset + 4 <= len(data):
+        signature_type = struct.unpack_from(">I", data, offset)[0]
+        if signature_type not in signature_sizes:
+            break
+        header_offset = offset + 4 + signature_sizes[signature_type]
+        key_type = struct.unpack_from(">I", data, header_offset + 0x40)[0]
+        name = data[header_offset + 0x44:header_offset + 0x84].rstrip(b"\x00").decode("ascii")
+        end = header_offset + 0x88 + key_sizes[key_type]
+        certificates[name] = data[offset:end]
+        offset = end
+    return certificates
+
+
+class Fst:
+    MAGIC = b"FST\x00"
+
+    def __init__(self, data: bytes):
+        if data[:4] != self.MAGIC:
+            raise ValueError("Not a Wii U FST")
+        offset_factor, cluster_count = struct.unpack_from(">II", data, 4)
+
+        self.contents = [FstContent(*struct.unpack_from(">IIQIB", data, 0x20 + i * 0x20))
+                         for i in range(cluster_count)]
+
+        entries_offset = 0x20 + cluster_count * 0x20
+        total_entries = struct.unpack_from(">I", data, entries_offset + 8)[0]
+        names_offset = entries_offset + total_entries * 0x10
+
+        self.files = {}
+        # (directory path, index of the first entry after the directory)
+        dirs = [("", total_entries)]
+        for i in range(1, total_entries):
+            while i >= dirs[-1][1]:
+                dirs.pop()
+
+            type_name, offset, size, flags, content_index = struct.unpack_from(">IIIHH", data, entries_offset + i * 0x10)
+            name_start = names_offset + (type_name & 0xFFFFFF)
+            name = data[name_start:data.index(b"\x00", name_start)].decode("utf-8")
+            path = dirs[-1][0] + "/" + name
+
+            if type_name >> 24 & 0x1:
+                dirs.append((path, size))
+            else:
+                if not flags & 0x4:
+                    offset *= offset_factor
+                self.files[path] = FstEntry(path, offset, size, content_index)
+
+
+class NUSClient:
+    """Downloads individual files out of titles on NUS (or anything that serves the same URL layout).
+
+    The TMD, title key and FST are fetched once per title. Only the byte ranges of content files that hold the
+    requested files are downloaded, and they are decrypted as they stream in.
+    """
+    HASHED_BLOCK_SIZE = 0x10000
+    HASHED_HEADER_SIZE = 0x400
+    HASHED_DATA_SIZE = HASHED_BLOCK_SIZE - HASHED_HEADER_SIZE
+
+    TICKET_SIZE = 0x350
+
+    CHUNK_SIZE = 1 << 16
+    RETRIES = 5
+
+    def __init__(self, base_url: str, common_key: str, max_connections: int = 16, timeout: float = 30):
+        self.base_url = base_url.rstrip("/")
+        self.common_key = bytes.fromhex(common_key)
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._title_locks: Dict[str, threading.Lock] = {}
+        self._tmds: Dict[str, Tmd] = {}
+        self._title_keys: Dict[str, bytes] = {}
+        self._fsts: Dict[str, Fst] = {}
+
+    def _title_lock(self, title_id: str) -> threading.Lock:
+        with self._lock:
+            return self._title_locks.setdefault(title_id, threading.Lock())
+
+    def get(self, path: str) -> bytes:
+        return b"".join(self._iter_range(path))
+
+    def _iter_range(self, path: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yields the bytes [start, end) of path, resuming with a Range request if the connection drops."""
+        url = f"{self.base_url}/{path}"
+        position = start
+        attempt = 0
+        while end is None or position < end:
+            headers = {}
+            if position or end is not None:
+                headers["Range"] = f"bytes={position}-" + ("" if end is None else str(end - 1))
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    if "Range" in headers and r.status_code != 206:
+                        # The whole file instead of the range asked for, which retrying won't change
+                        raise requests.HTTPError(f"{url} does not support range requests", response=r)
+                    for chunk in r.iter_content(self.CHUNK_SIZE):
+                        position += len(chunk)
+                        yield chunk
+                if end is None or position >= end:
+                    return
+                raise IOError(f"{url} ended early at {position}")
+            except (requests.ConnectionError, requests.Timeout, IOError) as e:
+                attempt += 1
+                if attempt > self.RETRIES or isinstance(e, requests.HTTPError):
+                    raise
+                logger.warning(f"Download of {url} interrupted at {position} ({e}), resuming")
+                time.sleep(min(2 ** attempt, 30))
+
+    def get_tmd(self, title_id: str) -> Tmd:
+        with self._title_lock(title_id):
+            if title_id not in self._tmds:
+                self._tmds[title_id] = Tmd(self.get(f"{title_id}/tmd"))
+            return self._tmds[title_id]
+
+    def get_certificates(self, title_id: str) -> Dict[str, bytes]:
+        """The CA, CP (TMD signer) and XS (ticket signer) certificates NUS sends along with a title."""
+        certificates = split_certificates(self.get_tmd(title_id).certificates)
+        certificates.update(split_certificates(self.get_ticket(title_id)[self.TICKET_SIZE:]))
+        return certificates
+
+    def get_ticket(self, title_id: str) -> bytes:
+        return self.get(f"{title_id}/cetk")
+
+    def get_title_key(self, title_id: str, encrypted_title_key: Optional[str] = None) -> bytes:
+        with self._title_lock(title_id):
+            if title_id not in self._title_keys:
+                if encrypted_title_key is None:
+                    encrypted_key = self.get_ticket(title_id)[0x1BF:0x1CF]
+                else:
+                    encrypted_key = bytes.fromhex(encrypted_title_key)
+                iv = bytes.fromhex(title_id) + bytes(8)
+                self._title_keys[title_id] = AES.new(self.common_key, AES.MODE_CBC, iv=iv).decrypt(encrypted_key)
+            return self._title_keys[title_id]
+
+    def get_fst(self, title_id: str, encrypted_title_key: Optional[str] = None) -> Fst:
+        tmd = self.get_tmd(title_id)
+        title_key = self.get_title_key(title_id, encrypted_title_key)
+        with self._title_lock(title_id):
+            if title_id not in self._fsts:
+                content = tmd.contents[0]
+                data = self.get(f"{title_id}/{content.id:08x}")
+                self._fsts[title_id] = Fst(AES.new(title_key, AES.MODE_CBC, iv=bytes(16)).decrypt(data))
+            return self._fsts[title_id]
+
+    def download_file(self, title_id: str, filename: str, output_path: str,
+                      encrypted_title_key: Optional[str] = None) -> str:
+        fst = self.get_fst(title_id, encrypted_title_key)
+        entry = fst.files.get(filename)
+        if entry is None:
+            raise FileNotFoundError(f"{filename} is not in title {title_id}")
+
+        content = self.get_tmd(title_id).contents[entry.content_index]
+        title_key = self.get_title_key(title_id, encrypted_title_key)
+
+        with AtomicFile(output_path, prefix=".download_") as f:
+            if content.hashed:
+                chunks = self._read_hashed(title_id, content, title_key, entry.offset, entry.size)
+            else:
+                chunks = self._read_unhashed(title_id, content, title_key, entry.offset, entry.size)
+            for chunk in chunks:
+                f.write(chunk)
+
+        logger.info(f"Downloaded {title_id}{filename} ({entry.size} bytes)")
+        return output_path
+
+    def _read_unhashed(self, title_id: str, content: TmdContent, title_key: bytes, offset: int,
+                       size: int) -> Iterator[bytes]:
+        # CBC only needs the previous ciphertext block as IV, so start one block early instead of at 0
+        aligned_start = offset & ~0xF
+        aligned_end = (offset + size + 0xF) & ~0xF
+        if aligned_start:
+            fetch_start = aligned_start - 0x10
+            iv = None
+        else:
+            fetch_start = 0
+            iv = content.index.to_bytes(2, byteorder="big") + bytes(14)
+
+        skip = offset - aligned_start
+        remaining = size
+        pending = b""
+        cipher = None if iv is None else AES.new(title_key, AES.MODE_CBC, iv=iv)
+        for chunk in self._iter_range(f"{title_id}/{content.id:08x}", fetch_start, aligned_end):
+            pending += chunk
+            if cipher is None:
+                if len(pending) < 0x10:
+                    continue
+                cipher = AES.new(title_key, AES.MODE_CBC, iv=pending[:0x10])
+                pending = pending[0x10:]
+
+            usable = len(pending) & ~0xF
+            data = cipher.decrypt(pending[:usable])
+            pending = pending[usable:]
+            data = data[skip:]
+            skip = max(skip - usable, 0)
+            data = data[:remaining]
+            remaining -= len(data)
+            if data:
+                yield data
+
+    def _read_hashed(self, title_id: str, content: TmdContent, title_key: bytes, offset: int,
+                     size: int) -> Iterator[bytes]:
+        first_block = offset // self.HASHED_DATA_SIZE
+        last_block = (offset + size - 1) // self.HASHED_DATA_SIZE
+        skip = offset - first_block * self.HASHED_DATA_SIZE
+        remaining = size
+
+        block = first_block
+        pending = b""
+        for chunk in self._iter_range(f"{title_id}/{content.id:08x}", first_block * self.HASHED_BLOCK_SIZE,
+                                      (last_block + 1) * self.HASHED_BLOCK_SIZE):
+            pending += chunk
+            while len(pending) >= self.HASHED_BLOCK_SIZE:
+                encrypted, pending = pending[:self.HASHED_BLOCK_SIZE], pending[self.HASHED_BLOCK_SIZE:]
+                hashes = AES.new(title_key, AES.MODE_CBC, iv=bytes(16)).decrypt(encrypted[:self.HASHED_HEADER_SIZE])
+                iv = hashes[(block % 16) * 0x14:(block % 16) * 0x14 + 0x10]
+                data = AES.new(title_key, AES.MODE_CBC, iv=iv).decrypt(encrypted[self.HASHED_HEADER_SIZE:])
+
+                # The header holds the H0 hashes of all 16 blocks in this group, one of which is this block's
+                if hashlib.sha1(data).digest() != hashes[(block % 16) * 0x14:(block % 16 + 1) * 0x14]:
+                    raise ValueError(f"H0 hash mismatch in block {block} of content {content.id:08x}")
+
+                data = data[skip:skip + remaining]
+                skip = 0
+                remaining -= len(data)
+                block += 1
+                yield data
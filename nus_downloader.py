@@ -1,18 +1,25 @@
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 import os.path
-from tools import JNUSTool
+from nus_client import NUSClient
 import concurrent.futures
 import hashlib
 import shutil
 import tempfile
 import json
+from atomic_file import AtomicFile
 from config import Config
+from fast_copy import FastCopier
+from file_lock import FileLock
 
 
 # if (WiiUCommonKeyHash == "35-AC-59-94-97-22-79-33-1D-97-09-4F-A2-FB-97-FC")
 # if (TitleKeyHash == "F9-4B-D8-8E-BB-7A-A9-38-67-E6-30-61-5F-27-1C-9F")
 class NUSDownloader:
     NUSUrl = "http://ccs.cdn.wup.shop.nintendo.net/ccs/download"
+    # Sidecar recording which downloaded files have already been verified
+    ManifestName = ".manifest.json"
+    LockName = ".lock"
+    CertificateChainName = "title.cert"
 
     OSv0TitleId = "0005001010004000"
     OSv0Name = OSv0TitleId
@@ -46,57 +53,87 @@ class NUSDownloader:
     }
 
     @classmethod
-    def write_config(cls, path: str) -> None:
-        config = [
-            cls.NUSUrl,
-            Config.WiiUCommonKey
-        ]
-        with open(os.path.join(path, "config"), "w") as f:
-            f.write('\n'.join(config))
+    def get_client(cls) -> NUSClient:
+        return NUSClient(cls.NUSUrl, Config.WiiUCommonKey)
 
     @classmethod
     def download_file(cls, title_id: str, filename: str, output_dir: str, md5_hash: str,
-                      title_key: Optional[str] = None) -> str:
+                      title_key: Optional[str] = None, download_dir: str = ".",
+                      client: Optional[NUSClient] = None) -> str:
         rel_path = os.path.normpath(os.path.join(output_dir, filename[1:]))
-        output_path = os.path.abspath(os.path.join(JNUSTool.directory, rel_path))
+        output_path = os.path.abspath(os.path.join(download_dir, rel_path))
 
         if not os.path.exists(output_path):
-            args = [title_id]
-            if title_key:
-                args.append(title_key)
-            args += ["-file", filename]
-            p = JNUSTool.run(args, cwd=JNUSTool.directory)
-            p.check_returncode()
+            client = client or cls.get_client()
+            client.download_file(title_id, filename, output_path, title_key)
 
             assert os.path.exists(output_path), f"{output_path} does not exist"
-            assert cls.verify_md5_hash(output_path, md5_hash)
+            assert cls.verify_md5_hash(output_path, md5_hash), f"{output_path} has the wrong MD5 hash"
 
         return rel_path
 
+    @classmethod
+    def get_expected_files(cls) -> List[Tuple[str, str]]:
+        files = []
+        for directory, file_list in [(cls.OSv0Name, cls.OSv0FileList), (cls.OSv1Name, cls.OSv1FileList),
+                                     (cls.RhythmHeavenFeverName, cls.RhythmHeavenFeverFileList)]:
+            files += [(directory + name, md5_hash) for name, md5_hash in file_list.items()]
+        return files
+
     @classmethod
     def check_if_files_exist(cls, directory: str) -> bool:
+        return not cls.get_missing_files(directory)
+
+    @classmethod
+    def get_missing_files(cls, directory: str) -> List[str]:
         directory = os.path.abspath(directory)
-        for name, md5_hash in cls.OSv0FileList.items():
-            path = os.path.join(directory, cls.OSv0Name, name[1:])
-            if not (os.path.exists(path) and cls.verify_md5_hash(path, md5_hash)):
-                return False
-        for name, md5_hash in cls.OSv1FileList.items():
-            path = os.path.join(directory, cls.OSv1Name, name[1:])
-            if not (os.path.exists(path) and cls.verify_md5_hash(path, md5_hash)):
-                return False
-        for name, md5_hash in cls.RhythmHeavenFeverFileList.items():
-            path = os.path.join(directory, cls.RhythmHeavenFeverName, name[1:])
-            if not (os.path.exists(path) and cls.verify_md5_hash(path, md5_hash)):
-                return False
-
-        return True
+        manifest = cls.read_manifest(directory)
+        missing = []
+        changed = False
+        for rel_path, md5_hash in cls.get_expected_files():
+            path = os.path.join(directory, os.path.normpath(rel_path))
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                missing.append(rel_path)
+                continue
+
+            # Files that haven't changed since they were last verified are trusted without rehashing
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "md5": md5_hash.lower()}
+            if manifest.get(rel_path) == entry:
+                continue
+            if not cls.verify_md5_hash(path, md5_hash):
+                missing.append(rel_path)
+                continue
+            manifest[rel_path] = entry
+            changed = True
+
+        if changed:
+            cls.write_manifest(directory, manifest)
+        return missing
+
+    @classmethod
+    def read_manifest(cls, directory: str) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(os.path.join(directory, cls.ManifestName), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @classmethod
+    def write_manifest(cls, directory: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+        with AtomicFile(os.path.join(directory, cls.ManifestName), "w", prefix=cls.ManifestName) as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
 
     @staticmethod
     def verify_md5_hash(filename: str, md5_hash: str) -> bool:
         hash_obj = hashlib.md5()
         with open(filename, "rb") as f:
-            buf = f.read()
-            hash_obj.update(buf)
+            while True:
+                buf = f.read(1 << 20)
+                if not buf:
+                    break
+                hash_obj.update(buf)
         return hash_obj.hexdigest().lower() == md5_hash.lower()
 
     @classmethod
@@ -105,45 +142,78 @@ class NUSDownloader:
             return
 
         output_directory = os.path.abspath(output_directory)
-        cls.write_config(JNUSTool.directory)
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for name, md5_hash in cls.OSv0FileList.items():
-                futures.append(executor.submit(cls.download_file, cls.OSv0TitleId, name, cls.OSv0Name, md5_hash))
-            for name, md5_hash in cls.OSv1FileList.items():
-                futures.append(executor.submit(cls.download_file, cls.OSv1TitleId, name, cls.OSv1Name, md5_hash))
-            for name, md5_hash in cls.RhythmHeavenFeverFileList.items():
-                futures.append(
-                    executor.submit(cls.download_file, cls.RhythmHeavenFeverTitleId, name, cls.RhythmHeavenFeverName,
-                                    md5_hash, Config.RhythmHeavenFeverTitleKey))
-
-        assert all(f.result() is not None for f in futures)
-        os.unlink(os.path.join(JNUSTool.directory, "config"))
-
-        os.makedirs(output_directory, exist_ok=True)
-        for d in [cls.OSv0Name, cls.OSv1Name, cls.RhythmHeavenFeverName]:
-            dst_d = os.path.join(output_directory, d)
-            src_d = os.path.join(JNUSTool.directory, d)
-            shutil.rmtree(dst_d, ignore_errors=True)
-            shutil.copytree(src_d, dst_d)
-            shutil.rmtree(src_d)
+        with FileLock(os.path.join(output_directory, cls.LockName)):
+            # Only one process downloads, everyone else waiting on the lock finds the files already there
+            missing = set(cls.get_missing_files(output_directory))
+            if not missing:
+                return
+
+            # Download into a private directory and only move verified files into the cache
+            staging_dir = tempfile.mkdtemp(prefix=".download_", dir=output_directory)
+            try:
+                client = cls.get_client()
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    futures = []
+                    for title_id, name_dir, file_list, title_key in [
+                            (cls.OSv0TitleId, cls.OSv0Name, cls.OSv0FileList, None),
+                            (cls.OSv1TitleId, cls.OSv1Name, cls.OSv1FileList, None),
+                            (cls.RhythmHeavenFeverTitleId, cls.RhythmHeavenFeverName, cls.RhythmHeavenFeverFileList,
+                             Config.RhythmHeavenFeverTitleKey)]:
+                        for name, md5_hash in file_list.items():
+                            if name_dir + name in missing:
+                                futures.append(executor.submit(cls.download_file, title_id, name, name_dir, md5_hash,
+                                                               title_key, staging_dir, client))
+
+                for f in futures:
+                    rel_path = f.result()
+                    dst = os.path.join(output_directory, rel_path)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(os.path.join(staging_dir, rel_path), dst)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    @classmethod
+    def get_certificate_chain(cls) -> str:
+        """Path to a title.cert with the certificates needed to install a package, fetched from NUS once."""
+        cache_dir = cls.get_cache_dir()
+        cert_path = os.path.join(cache_dir, cls.CertificateChainName)
+        if os.path.exists(cert_path):
+            return cert_path
+
+        with FileLock(os.path.join(cache_dir, cls.LockName)):
+            if not os.path.exists(cert_path):
+                certificates = cls.get_client().get_certificates(cls.OSv0TitleId)
+                chain = b""
+                for prefix in ["CA", "CP", "XS"]:
+                    names = [name for name in certificates if name.startswith(prefix)]
+                    assert names, f"NUS did not return a {prefix} certificate"
+                    chain += certificates[names[0]]
+
+                AtomicFile.write(cert_path, chain, prefix=cls.CertificateChainName)
+
+        return cert_path
 
     @classmethod
-    def get_tempdir(cls) -> str:
-        sys_tempdir = tempfile.gettempdir()
-        return os.path.normpath(os.path.join(sys_tempdir, cls.__name__))
+    def get_cache_dir(cls) -> str:
+        return os.path.join(Config.get_cache_dir(), cls.__name__)
 
     @classmethod
     def copy_files(cls, output_dir: Optional[str] = None) -> str:
-        tempdir = cls.get_tempdir()
-        cls.download_all_files(tempdir)
+        cache_dir = cls.get_cache_dir()
+        cls.download_all_files(cache_dir)
         if output_dir is not None:
-            download_dir = os.path.normpath(os.path.join(tempdir, output_dir))
-            shutil.copytree(tempdir, download_dir, dirs_exist_ok=True)
+            download_dir = os.path.normpath(os.path.join(cache_dir, output_dir))
+            shutil.copytree(cache_dir, download_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns(".*"))
             return download_dir
         else:
-            return tempdir
+            return cache_dir
+
+    @classmethod
+    def link_files(cls, name: str, output_dir: str) -> str:
+        """Populate output_dir with links to the cached files of one title instead of copying them."""
+        cache_dir = cls.get_cache_dir()
+        cls.download_all_files(cache_dir)
+        return FastCopier.link_tree(os.path.join(cache_dir, name), output_dir)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,335 @@
-from tools import NUSPacker
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+import concurrent.futures
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import time
+import xml.etree.ElementTree as ElementTree
+
+from Crypto.Cipher import AES
+
+from metrics import Metrics
+from tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class PackedFile(NamedTuple):
+    path: str
+    source: str
+    size: int
+    offset: int
+
+
+class PackedContent(NamedTuple):
+    index: int
+    hashed: bool
+    group_id: int
+    entry_flags: int
+    owner_title_id: int
+    files: List[PackedFile]
+    data_size: int
+
+
+def _iter_content_data(files: List[PackedFile], data_size: int, chunk_size: int) -> Iterator[bytes]:
+    # Yields the plaintext content in chunk_size pieces, with the padding between files zero filled
+    buf = bytearray()
+    position = 0
+    for packed_file in files:
+        buf += bytes(packed_file.offset - position)
+        with open(packed_file.source, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                buf += data
+                while len(buf) >= chunk_size:
+                    yield bytes(buf[:chunk_size])
+                    del buf[:chunk_size]
+        position = packed_file.offset + packed_file.size
+
+    buf += bytes(data_size - position)
+    while buf:
+        yield bytes(buf[:chunk_size]).ljust(chunk_size, b"\x00")
+        del buf[:chunk_size]
+
+
+def _hash_table(hashes: List[bytes], index: int) -> bytes:
+    # Tables always hold 16 hashes, zero filled past the end of the content
+    return b"".join(hashes[index * 16:index * 16 + 16]).ljust(NUSPacker.HASH_TABLE_SIZE, b"\x00")
+
+
+def _hash_tables(hashes: List[bytes]) -> List[bytes]:
+    """The next level of the hash tree: the hash of every (padded) table of 16 hashes."""
+    return [hashlib.sha1(_hash_table(hashes, i)).digest() for i in range((len(hashes) + 15) // 16)]
+
+
+@Tracer.traced("worker")
+def _pack_content(content: PackedContent, title_key: bytes, output_folder: str) -> Tuple[int, bytes, float]:
+    # Runs in a worker process. Returns the encrypted size, TMD hash and time taken.
+    start_time = time.monotonic()
+    app_path = os.path.join(output_folder, f"{content.index:08X}.app")
+
+    if not content.hashed:
+        hash_obj = hashlib.sha1()
+        iv = content.index.to_bytes(2, byteorder="big") + bytes(14)
+        cipher = AES.new(title_key, AES.MODE_CBC, iv=iv)
+        size = 0
+        with open(app_path, "wb") as f:
+            for chunk in _iter_content_data(content.files, content.data_size, NUSPacker.SECTOR_SIZE):
+                hash_obj.update(chunk)
+                f.write(cipher.encrypt(chunk))
+                size += len(chunk)
+        Metrics.inc("worker_bytes", size, stage="pack")
+        Metrics.progress()
+        return size, hash_obj.digest(), time.monotonic() - start_time
+
+    # Hashed contents need the full hash tree before the first block can be written, so read the data twice
+    block_size = NUSPacker.HASHED_DATA_SIZE
+    h0 = [hashlib.sha1(block).digest() for block in _iter_content_data(content.files, content.data_size, block_size)]
+    h1 = _hash_tables(h0)
+    h2 = _hash_tables(h1)
+    h3 = _hash_tables(h2)
+
+    with open(app_path, "wb") as f:
+        for block, data in enumerate(_iter_content_data(content.files, content.data_size, block_size)):
+            hashes = (_hash_table(h0, block // 16) + _hash_table(h1, block // 256) + _hash_table(h2, block // 4096))
+            hashes = hashes.ljust(NUSPacker.HASHED_HEADER_SIZE, b"\x00")
+            f.write(AES.new(title_key, AES.MODE_CBC, iv=bytes(16)).encrypt(hashes))
+            f.write(AES.new(title_key, AES.MODE_CBC, iv=h0[block][:16]).encrypt(data))
+
+    h3_data = b"".join(h3)
+    with open(os.path.join(output_folder, f"{content.index:08X}.h3"), "wb") as f:
+        f.write(h3_data)
+    Metrics.inc("worker_bytes", content.data_size, stage="pack")
+    Metrics.progress()
+    return len(h0) * NUSPacker.HASHED_BLOCK_SIZE, hashlib.sha1(h3_data).digest(), time.monotonic() - start_time
+
+
+class NUSPacker:
+    """Builds an installable, fake-signed WUP package (TMD, ticket, certificates and encrypted contents)."""
+    SECTOR_SIZE = 0x8000
+    HASHED_BLOCK_SIZE = 0x10000
+    HASHED_HEADER_SIZE = 0x400
+    HASHED_DATA_SIZE = HASHED_BLOCK_SIZE - HASHED_HEADER_SIZE
+    HASH_TABLE_SIZE = 16 * 0x14
+    FILE_ALIGNMENT = 0x20
+
+    # Title key used for every package, the same default as NUSPacker
+    TITLE_KEY = bytes.fromhex("13371337133713371337133713371337")
+
+    TMD_ISSUER = b"Root-CA00000003-CP0000000b"
+    TICKET_ISSUER = b"Root-CA00000003-XS0000000c"
+    SIGNATURE_TYPE = 0x00010004
+
+    CONTENT_TYPE_UNHASHED = 0x2001
+    CONTENT_TYPE_HASHED = 0x2003
+
+    GROUP_ID_CODE = 0x0000
+    GROUP_ID_META = 0x0400
+    ENTRY_FLAGS_CODE = 0x0000
+    ENTRY_FLAGS_META = 0x0040
+    ENTRY_FLAGS_CONTENT = 0x0400
+
+    # (path pattern, name of the content group, hashed, group id, FST entry flags, one content per file)
+    CONTENT_RULES = [
+        (r"^/code/(app|cos)\.xml$", "code", False, GROUP_ID_CODE, ENTRY_FLAGS_CODE, False),
+        (r"^/code/.*\.(rpx|rpl)$", "code_rpx", True, GROUP_ID_CODE, ENTRY_FLAGS_CODE, True),
+        (r"^/code/", "code_other", False, GROUP_ID_CODE, ENTRY_FLAGS_CODE, False),
+        (r"^/meta/", "meta", True, GROUP_ID_META, ENTRY_FLAGS_META, False),
+        # The NFS parts are large, so giving every file its own content lets them be encrypted in parallel
+        (r"^/content/", "content", True, None, ENTRY_FLAGS_CONTENT, True),
+    ]
+
+    # Content-independent part of the version 1 ticket, which allows access to every content
+    TICKET_V1_SECTION = bytes.fromhex(
+        "00010014000000AC000000140001001400000000"
+        "00000028000000010000008400000084"
+        "0003000000000000"
+    ) + b"\xFF" * 0x80
+
+    def __init__(self, source_folder: str, common_key: str, title_key: bytes = TITLE_KEY):
+        self.source_folder = os.path.abspath(source_folder)
+        self.common_key = bytes.fromhex(common_key)
+        self.title_key = title_key
+
+        app = ElementTree.parse(os.path.join(self.source_folder, "code", "app.xml")).getroot()
+        self.title_id = int(app.findtext("title_id"), 16)
+        self.title_version = int(app.findtext("title_version"), 16)
+        self.os_version = int(app.findtext("os_version"), 16)
+        self.group_id = int(app.findtext("group_id"), 16) & 0xFFFF
+
+    def get_files(self) -> List[Tuple[str, str]]:
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.source_folder):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                source = os.path.join(dirpath, filename)
+                files.append(("/" + os.path.relpath(source, self.source_folder).replace(os.sep, "/"), source))
+        return files
+
+    def layout_contents(self) -> List[PackedContent]:
+        groups = {}
+        for path, source in self.get_files():
+            for pattern, name, hashed, group_id, entry_flags, per_file in self.CONTENT_RULES:
+                if re.match(pattern, path):
+                    key = (name, path) if per_file else (name,)
+                    groups.setdefault(key, (hashed, self.group_id if group_id is None else group_id,
+                                            entry_flags, []))[3].append((path, source))
+                    break
+            else:
+                raise ValueError(f"Don't know which content {path} belongs in")
+
+        # Content 0 is the FST
+        contents = []
+        for hashed, group_id, entry_flags, group_files in groups.values():
+            files = []
+            offset = 0
+            for path, source in group_files:
+                size = os.path.getsize(source)
+                files.append(PackedFile(path, source, size, offset))
+                offset = (offset + size + self.FILE_ALIGNMENT - 1) & ~(self.FILE_ALIGNMENT - 1)
+            alignment = self.HASHED_DATA_SIZE if hashed else self.SECTOR_SIZE
+            data_size = max((offset + alignment - 1) // alignment, 1) * alignment
+            contents.append(PackedContent(len(contents) + 1, hashed, group_id, entry_flags, self.title_id, files,
+                                          data_size))
+        return contents
+
+    @classmethod
+    def get_encrypted_size(cls, content: PackedContent) -> int:
+        if content.hashed:
+            return content.data_size // cls.HASHED_DATA_SIZE * cls.HASHED_BLOCK_SIZE
+        return content.data_size
+
+    def build_content_entries(self, contents: List[PackedContent], fst_size: int) -> bytes:
+        """The FST's table of contents, laid out like CNUSPACKER does: offset and size in sectors, owner title ID,
+        group ID and hash mode. Content 0 is the FST itself, and each content starts where the one before it ends."""
+        fst_sectors = fst_size // self.SECTOR_SIZE
+        entries = struct.pack(">IIQIB", 0, fst_sectors, self.title_id, self.GROUP_ID_CODE, 0).ljust(0x20, b"\x00")
+        offset = (0 if fst_sectors == 1 else fst_sectors) + 2
+        for content in contents:
+            sectors = self.get_encrypted_size(content) // self.SECTOR_SIZE
+            if content.hashed:
+                # Only counts the data, without the hash blocks
+                size = max(sectors - (sectors // 64 + 1) * 2, 0)
+            else:
+                size = sectors
+            entries += struct.pack(">IIQIB", offset, size, content.owner_title_id, content.group_id,
+                                   2 if content.hashed else 1).ljust(0x20, b"\x00")
+            offset += sectors
+        return entries
+
+    def build_fst(self, contents: List[PackedContent]) -> bytes:
+        # Build the directory tree, then flatten it depth first
+        tree = {}
+        for content in contents:
+            for packed_file in content.files:
+                node = tree
+                parts = packed_file.path.strip("/").split("/")
+                for part in parts[:-1]:
+                    node = node.setdefault(part, {})
+                node[parts[-1]] = (content, packed_file)
+
+        entries = []
+        names = bytearray(b"\x00")
+
+        def add_entries(node: dict, parent_index: int) -> None:
+            for name in sorted(node, key=str.lower):
+                name_offset = len(names)
+                names.extend(name.encode("utf-8") + b"\x00")
+                value = node[name]
+                if isinstance(value, dict):
+                    index = len(entries)
+                    entries.append(None)
+                    add_entries(value, index)
+                    entries[index] = struct.pack(">IIIHH", 0x01000000 | name_offset, parent_index, len(entries), 0, 0)
+                else:
+                    content, packed_file = value
+                    entries.append(struct.pack(">IIIHH", name_offset, packed_file.offset // self.FILE_ALIGNMENT,
+                                               packed_file.size, content.entry_flags, content.index))
+
+        entries.append(None)
+        add_entries(tree, 0)
+        entries[0] = struct.pack(">IIIHH", 0x01000000, 0, len(entries), 0, 0)
+
+        header = struct.pack(">4sII", b"FST\x00", self.FILE_ALIGNMENT, len(contents) + 1).ljust(0x20, b"\x00")
+        size = len(header) + 0x20 * (len(contents) + 1) + 0x10 * len(entries) + len(names)
+        size = (size + self.SECTOR_SIZE - 1) // self.SECTOR_SIZE * self.SECTOR_SIZE
+        fst = header + self.build_content_entries(contents, size) + b"".join(entries) + names
+        return fst.ljust(size, b"\x00")
+
+    def build_tmd(self, records: List[Tuple[int, int, int, bytes]]) -> bytes:
+        content_records = b"".join(struct.pack(">IHHQ", index, index, content_type, size) + sha1.ljust(0x20, b"\x00")
+                                   for index, content_type, size, sha1 in records)
+        content_info = struct.pack(">HH", 0, len(records)) + hashlib.sha256(content_records).digest()
+        content_info = content_info.ljust(0x24 * 64, b"\x00")
+
+        tmd = bytearray(0xB04)
+        struct.pack_into(">I", tmd, 0, self.SIGNATURE_TYPE)
+        tmd[0x140:0x140 + len(self.TMD_ISSUER)] = self.TMD_ISSUER
+        struct.pack_into(">BBBxQQIH", tmd, 0x180, 1, 0, 0, self.os_version, self.title_id, 0x100, self.group_id)
+        struct.pack_into(">IHHH", tmd, 0x1D8, 0, self.title_version, len(records), 0)
+        tmd[0x1E4:0x204] = hashlib.sha256(content_info).digest()
+        tmd[0x204:0xB04] = content_info
+        return bytes(tmd) + content_records
+
+    def build_ticket(self) -> bytes:
+        iv = self.title_id.to_bytes(8, byteorder="big") + bytes(8)
+        encrypted_title_key = AES.new(self.common_key, AES.MODE_CBC, iv=iv).encrypt(self.title_key)
+
+        ticket = bytearray(0x2A4)
+        struct.pack_into(">I", ticket, 0, self.SIGNATURE_TYPE)
+        ticket[0x140:0x140 + len(self.TICKET_ISSUER)] = self.TICKET_ISSUER
+        ticket[0x1BC] = 1
+        ticket[0x1BF:0x1CF] = encrypted_title_key
+        struct.pack_into(">Q", ticket, 0x1DC, self.title_id)
+        struct.pack_into(">H", ticket, 0x1E6, self.title_version)
+        return bytes(ticket) + self.TICKET_V1_SECTION
+
+    def pack(self, output_folder: str, certificate_chain: str, processes: Optional[int] = None) -> str:
+        start_time = time.monotonic()
+        os.makedirs(output_folder, exist_ok=True)
+        contents = self.layout_contents()
+
+        fst = self.build_fst(contents)
+        fst_cipher = AES.new(self.title_key, AES.MODE_CBC, iv=bytes(16))
+        with open(os.path.join(output_folder, f"{0:08X}.app"), "wb") as f:
+            f.write(fst_cipher.encrypt(fst))
+        records = [(0, self.CONTENT_TYPE_UNHASHED, len(fst), hashlib.sha1(fst).digest())]
+
+        total_size = 0
+        # Spawned rather than forked, since other build threads may hold locks that a fork would copy locked
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                                                    mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(_pack_content, content, self.title_key, output_folder) for content in contents]
+            for content, future in zip(contents, futures):
+                size, content_hash, elapsed = future.result()
+                total_size += size
+                content_type = self.CONTENT_TYPE_HASHED if content.hashed else self.CONTENT_TYPE_UNHASHED
+                records.append((content.index, content_type, size, content_hash))
+                logger.debug(f"Packed content {content.index:08X} ({len(content.files)} files, {size / 2**20:.1f} MiB) "
+                             f"in {elapsed:.1f}s ({size / 2**20 / max(elapsed, 1e-9):.1f} MB/s)")
+
+        with open(os.path.join(output_folder, "title.tmd"), "wb") as f:
+            f.write(self.build_tmd(records))
+        with open(os.path.join(output_folder, "title.tik"), "wb") as f:
+            f.write(self.build_ticket())
+        shutil.copyfile(certificate_chain, os.path.join(output_folder, "title.cert"))
+
+        elapsed = max(time.monotonic() - start_time, 1e-9)
+        logger.info(f"Packed {len(records)} contents ({total_size / 2**20:.1f} MiB) in {elapsed:.1f}s "
+                    f"({total_size / 2**20 / elapsed:.1f} MB/s)")
+        return output_folder
 
 
 class NUSPackerWrapper:
     @staticmethod
-    def pack(source_folder: str, output_folder: str, common_key: str) -> None:
-        NUSPacker.run(["-in", source_folder, "-out", output_folder, "-encryptKeyWith", common_key])
+    def pack(source_folder: str, output_folder: str, common_key: str, certificate_chain: Optional[str] = None) -> None:
+        if certificate_chain is None:
+            from nus_downloader import NUSDownloader
+            certificate_chain = NUSDownloader.get_certificate_chain()
+        NUSPacker(source_folder, common_key).pack(output_folder, certificate_chain)
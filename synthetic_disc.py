@@ -0,0 +1,102 @@
+from typing import BinaryIO, Optional
+import argparse
+import random
+import struct
+
+from disc_header import DiscHeader
+from wii_disc import WiiDisc, WiiPartition
+
+
+class SyntheticDisc:
+    """Writes disc images with valid headers and made up contents, for benchmarks, tests and placeholder images.
+
+    entropy is the fraction of every chunk that is random rather than zeroes, which sets how well the image would
+    compress and how much of it real tools would skip as unused. Images are reproducible for the same seed.
+    """
+    CHUNK_SIZE = 1 << 20
+    GAME_NAME_SIZE = 0x40
+
+    # Where the only (data) partition of a synthetic Wii disc goes, right after the header area
+    WII_PARTITION_OFFSET = WiiDisc.HEADER_AREA_SIZE
+    WII_PARTITION_DATA_OFFSET = 0x20000
+    WII_CLUSTER_SIZE = 0x8000
+    TICKET_SIZE = 0x2A4
+
+    @staticmethod
+    def build_header(game_id: str, game_name: str, game_type: int, disc_number: int = 0) -> bytes:
+        header = bytearray(DiscHeader.SIZE)
+        header[:6] = game_id.encode("ascii")[:6].ljust(6, b"\x00")
+        header[DiscHeader.DISC_NUMBER_OFFSET] = disc_number
+        header[DiscHeader.GAME_TYPE_OFFSET:DiscHeader.GAME_TYPE_OFFSET + 8] = game_type.to_bytes(8, byteorder="little")
+        name = game_name.encode("utf-8")[:SyntheticDisc.GAME_NAME_SIZE - 1]
+        header[DiscHeader.GAME_NAME_OFFSET:DiscHeader.GAME_NAME_OFFSET + len(name)] = name
+        return bytes(header)
+
+    @classmethod
+    def write_filler(cls, f: BinaryIO, size: int, entropy: float, rng: random.Random) -> None:
+        random_size = int(cls.CHUNK_SIZE * min(max(entropy, 0.0), 1.0))
+        zeroes = bytes(cls.CHUNK_SIZE - random_size)
+        while size > 0:
+            chunk = rng.randbytes(random_size) + zeroes
+            f.write(chunk[:size])
+            size -= len(chunk)
+
+    @classmethod
+    def write_gamecube(cls, path: str, size: int, entropy: float = 1.0, game_id: str = "GZZE01",
+                       game_name: str = "Synthetic GameCube Disc", disc_number: int = 0, seed: int = 0) -> str:
+        rng = random.Random(seed)
+        header = cls.build_header(game_id, game_name, DiscHeader.GAMECUBE_GAME_TYPE, disc_number)
+        with open(path, "wb") as f:
+            f.write(header)
+            cls.write_filler(f, size - len(header), entropy, rng)
+        return path
+
+    @classmethod
+    def write_wii(cls, path: str, size: int, entropy: float = 1.0, game_id: str = "RZZE01",
+                  game_name: str = "Synthetic Wii Disc", seed: int = 0, title_key: Optional[bytes] = None) -> str:
+        """A Wii disc with a single data partition filling everything after the header area.
+
+        The ticket holds title_key (random by default) where the encrypted title key goes, so the partition data
+        decrypts to noise with any common key. That is all the converters need.
+        """
+        rng = random.Random(seed)
+        data_offset = cls.WII_PARTITION_OFFSET + cls.WII_PARTITION_DATA_OFFSET
+        data_size = (size - data_offset) // cls.WII_CLUSTER_SIZE * cls.WII_CLUSTER_SIZE
+        if data_size <= 0:
+            raise ValueError(f"A synthetic Wii disc needs to be bigger than {data_offset} bytes")
+
+        header = bytearray(WiiDisc.HEADER_AREA_SIZE)
+        header[:DiscHeader.SIZE] = cls.build_header(game_id, game_name, DiscHeader.WII_GAME_TYPE)
+        partition = WiiPartition(cls.WII_PARTITION_OFFSET, WiiDisc.PARTITION_TYPE_DATA, cls.WII_PARTITION_DATA_OFFSET,
+                                 data_size)
+        table = WiiDisc.build_partition_table([partition])
+        header[WiiDisc.PARTITION_TABLE_OFFSET:WiiDisc.PARTITION_TABLE_OFFSET + len(table)] = table
+
+        partition_header = bytearray(cls.WII_PARTITION_DATA_OFFSET)
+        ticket = bytearray(cls.TICKET_SIZE)
+        ticket[0x1BF:0x1CF] = title_key or rng.randbytes(16)
+        ticket[0x1DC:0x1E4] = game_id.encode("ascii")[:4].rjust(8, b"\x00")
+        partition_header[:cls.TICKET_SIZE] = ticket
+        partition_header[0x2B8:0x2C0] = struct.pack(">II", cls.WII_PARTITION_DATA_OFFSET >> 2, data_size >> 2)
+
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(partition_header)
+            cls.write_filler(f, data_size, entropy, rng)
+        return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic Wii or GameCube disc image.")
+    parser.add_argument("system", choices=["wii", "gamecube"])
+    parser.add_argument("output", type=str, help="Path to write the image to.")
+    parser.add_argument("--size", type=int, default=64, help="Image size in MiB. Default is 64.")
+    parser.add_argument("--entropy", type=float, default=1.0,
+                        help="Fraction of the contents that is random rather than zeroes. Default is 1.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.system == "wii":
+        SyntheticDisc.write_wii(args.output, args.size << 20, args.entropy, seed=args.seed)
+    else:
+        SyntheticDisc.write_gamecube(args.output, args.size << 20, args.entropy, seed=args.seed)
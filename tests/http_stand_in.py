@@ -0,0 +1,124 @@
+from typing import Dict, List, NamedTuple, Optional
+import http.server
+import re
+import threading
+import time
+
+
+class StandInFile(NamedTuple):
+    body: bytes
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # Send the full Content-Length but hang up after this many bytes, once
+    drop_after: Optional[int] = None
+    # Answer Range requests with the whole file, like servers without range support
+    ignore_range: bool = False
+
+
+class StandInRequest(NamedTuple):
+    path: str
+    headers: Dict[str, str]
+
+
+class StandInServer:
+    """Local web server with canned files, in place of NUS or the artwork host. Records every request it gets.
+
+    Supports what the clients rely on: conditional requests, single Range requests and 404s for anything else.
+    """
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.files: Dict[str, StandInFile] = {}
+        self.requests: List[StandInRequest] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._dropped = set()
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                server.handle(self)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def get_requests(self, path: Optional[str] = None) -> List[StandInRequest]:
+        with self._lock:
+            return [request for request in self.requests if path is None or request.path == path]
+
+    def __enter__(self) -> "StandInServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def handle(self, handler: http.server.BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.requests.append(StandInRequest(handler.path, dict(handler.headers)))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            self._respond(handler)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _respond(self, handler: http.server.BaseHTTPRequestHandler) -> None:
+        f = self.files.get(handler.path)
+        if f is None:
+            self._send(handler, 404, b"")
+            return
+
+        headers = {}
+        if f.etag:
+            headers["ETag"] = f.etag
+        if f.last_modified:
+            headers["Last-Modified"] = f.last_modified
+        if (f.etag and handler.headers.get("If-None-Match") == f.etag) or \
+                (f.last_modified and handler.headers.get("If-Modified-Since") == f.last_modified):
+            self._send(handler, 304, b"", headers)
+            return
+
+        status, body = 200, f.body
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", handler.headers.get("Range", ""))
+        if match and not f.ignore_range:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(f.body)
+            status, body = 206, f.body[start:end]
+            headers["Content-Range"] = f"bytes {start}-{start + len(body) - 1}/{len(f.body)}"
+
+        if f.drop_after is not None and handler.path not in self._dropped:
+            self._dropped.add(handler.path)
+            self._send(handler, status, body, headers, body[:f.drop_after])
+            return
+        self._send(handler, status, body, headers)
+
+    @staticmethod
+    def _send(handler: http.server.BaseHTTPRequestHandler, status: int, body: bytes,
+              headers: Optional[Dict[str, str]] = None, sent: Optional[bytes] = None) -> None:
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        if status != 304:
+            handler.send_header("Content-Length", str(len(body)))
+        if sent is not None:
+            handler.send_header("Connection", "close")
+            handler.close_connection = True
+        handler.end_headers()
+        handler.wfile.write(body if sent is None else sent)
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+
+from artwork_fetcher import ArtworkFetcher
+from http_stand_in import StandInFile, StandInServer
+
+ICON = b"\x89PNG icon"
+LAST_MODIFIED = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+
+class ArtworkFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.server = StandInServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def fetch(self, path: str, **kwargs) -> bytes:
+        with ArtworkFetcher(os.path.join(self.temp_dir.name, "artwork"), **kwargs) as fetcher:
+            return fetcher.fetch(self.server.url + path)
+
+    def test_etag_revalidation(self):
+        self.server.files["/icon.png"] = StandInFile(ICON, etag='"v1"')
+        self.assertEqual(self.fetch("/icon.png"), ICON)
+        # Stale, so the cached copy is revalidated rather than downloaded again
+        self.assertEqual(self.fetch("/icon.png", max_age=0), ICON)
+        first, second = self.server.get_requests()
+        self.assertNotIn("If-None-Match", first.headers)
+        self.assertEqual(second.headers["If-None-Match"], '"v1"')
+
+        self.server.files["/icon.png"] = StandInFile(b"new icon", etag='"v2"')
+        self.assertEqual(self.fetch("/icon.png", max_age=0), b"new icon")
+
+    def test_last_modified_revalidation(self):
+        self.server.files["/icon.png"] = StandInFile(ICON, last_modified=LAST_MODIFIED)
+        self.assertEqual(self.fetch("/icon.png"), ICON)
+        self.assertEqual(self.fetch("/icon.png", max_age=0), ICON)
+        self.assertEqual(self.server.get_requests()[-1].headers["If-Modified-Since"], LAST_MODIFIED)
+
+    def test_fresh_copy_is_not_revalidated(self):
+        self.server.files["/icon.png"] = StandInFile(ICON, etag='"v1"')
+        self.fetch("/icon.png")
+        self.assertEqual(self.fetch("/icon.png"), ICON)
+        self.assertEqual(len(self.server.get_requests()), 1)
+
+    def test_negative_caching(self):
+        self.assertIsNone(self.fetch("/missing.png"))
+        self.assertIsNone(self.fetch("/missing.png"))
+        self.assertEqual(len(self.server.get_requests()), 1)
+
+        # Asked again once the 404 has expired
+        self.server.files["/missing.png"] = StandInFile(ICON)
+        self.assertEqual(self.fetch("/missing.png", negative_ttl=0), ICON)
+        self.assertEqual(len(self.server.get_requests()), 2)
+
+
+class FetchImagesTest(unittest.TestCase):
+    REGIONS = ["X", "E", "P", "J"]
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        # Slow enough that requests made one after the other could not overlap
+        self.server = StandInServer(delay=0.2)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.server.files["/E/iconTex.png"] = StandInFile(b"E icon", etag='"e-icon"')
+        self.server.files["/P/iconTex.png"] = StandInFile(b"P icon", etag='"p-icon"')
+        self.server.files["/P/bootTvTex.png"] = StandInFile(b"P banner", etag='"p-banner"')
+        self.base_urls = [f"{self.server.url}/{region}/" for region in self.REGIONS]
+
+    def fetch_images(self, **kwargs):
+        with ArtworkFetcher(os.path.join(self.temp_dir.name, "artwork"), **kwargs) as fetcher:
+            return fetcher.fetch_images(self.base_urls)
+
+    def test_candidates_are_requested_concurrently(self):
+        # Each image comes from the first region in the list that has it
+        self.assertEqual(self.fetch_images(), [b"E icon", b"P banner"])
+        requests = len(self.REGIONS) * len(ArtworkFetcher.IMAGE_NAMES)
+        self.assertEqual(len(self.server.get_requests()), requests)
+        self.assertEqual(self.server.max_in_flight, requests)
+
+    def test_second_fetch(self):
+        self.fetch_images()
+        first = len(self.server.get_requests())
+
+        # Found images are fresh and missing ones are cached as such, so nothing is asked again
+        self.assertEqual(self.fetch_images(), [b"E icon", b"P banner"])
+        self.assertEqual(len(self.server.get_requests()), first)
+
+        # Once stale, only the images that were found are revalidated, each with one conditional request
+        self.assertEqual(self.fetch_images(max_age=0), [b"E icon", b"P banner"])
+        revalidations = self.server.get_requests()[first:]
+        self.assertEqual(sorted(request.path for request in revalidations),
+                         ["/E/iconTex.png", "/P/bootTvTex.png", "/P/iconTex.png"])
+        self.assertTrue(all("If-None-Match" in request.headers for request in revalidations))
+
+
+if __name__ == "__main__":
+    unittest.main()
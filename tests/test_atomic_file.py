@@ -0,0 +1,33 @@
+import os
+import tempfile
+import unittest
+
+from atomic_file import AtomicFile
+
+
+class AtomicFileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, "sub", "file.json")
+
+    def test_write(self):
+        AtomicFile.write(self.path, b"old")
+        AtomicFile.write(self.path, "new", sync=True)
+        with open(self.path, "r") as f:
+            self.assertEqual(f.read(), "new")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.json"])
+
+    def test_failed_write_keeps_old_file(self):
+        AtomicFile.write(self.path, b"old")
+        with self.assertRaises(RuntimeError):
+            with AtomicFile(self.path) as f:
+                f.write(b"partial")
+                raise RuntimeError
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"old")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
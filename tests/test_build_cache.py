@@ -0,0 +1,42 @@
+import os
+import tempfile
+import time
+import unittest
+
+from build_cache import BuildCache
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.cache = BuildCache(os.path.join(self.temp_dir.name, "cache"), max_size=2500)
+
+    def store(self, key: str) -> None:
+        output_path = os.path.join(self.temp_dir.name, "output", key)
+        os.makedirs(output_path)
+        with open(os.path.join(output_path, "title.app"), "wb") as f:
+            f.write(os.urandom(1000))
+        self.cache.store(key, output_path)
+        # Entries are ordered by mtime, which may be coarse
+        time.sleep(0.01)
+
+    def test_least_recently_used_first(self):
+        self.store("aa1")
+        self.store("bb2")
+        self.assertTrue(self.cache.fetch("aa1", os.path.join(self.temp_dir.name, "fetched")))
+        self.store("cc3")
+        self.assertTrue(os.path.isdir(self.cache.get_entry_path("aa1")))
+        self.assertFalse(os.path.isdir(self.cache.get_entry_path("bb2")))
+        self.assertTrue(os.path.isdir(self.cache.get_entry_path("cc3")))
+
+    def test_shared_files_count_once(self):
+        self.store("aa1")
+        # A second entry of the same files doesn't take up any more space
+        self.cache.store("bb2", os.path.join(self.temp_dir.name, "output", "aa1"))
+        self.store("cc3")
+        self.assertEqual(len(self.cache.get_entries()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import asyncio
+import unittest
+
+from build_scheduler import _PrioritySemaphore
+
+
+class PrioritySemaphoreTest(unittest.TestCase):
+    def test_lowest_priority_first(self):
+        async def run():
+            semaphore = _PrioritySemaphore(1)
+            order = []
+
+            async def worker(priority: int) -> None:
+                await semaphore.acquire(priority)
+                order.append(priority)
+                await asyncio.sleep(0)
+                semaphore.release()
+
+            await semaphore.acquire(0)
+            tasks = [asyncio.create_task(worker(priority)) for priority in [3, 1, 2]]
+            await asyncio.sleep(0)
+            semaphore.release()
+            await asyncio.gather(*tasks)
+            return order
+
+        self.assertEqual(asyncio.run(run()), [1, 2, 3])
+
+    def test_cancelled_waiter(self):
+        async def run():
+            semaphore = _PrioritySemaphore(1)
+            await semaphore.acquire(0)
+            cancelled = asyncio.create_task(semaphore.acquire(1))
+            waiting = asyncio.create_task(semaphore.acquire(2))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            semaphore.release()
+            # The token skips the cancelled waiter
+            await asyncio.wait_for(waiting, 1)
+            semaphore.release()
+            await asyncio.wait_for(semaphore.acquire(3), 1)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from disc_image import NasosImage, WbfsImage, open_disc_image
+
+
+class WbfsImageTest(unittest.TestCase):
+    BLOCK_SHIFT = 20
+    BLOCK_SIZE = 1 << BLOCK_SHIFT
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, "game.wbfs")
+        # Disc blocks 0 and 2 are stored in WBFS blocks 1 and 2, disc block 1 is unused
+        self.blocks = [os.urandom(self.BLOCK_SIZE), os.urandom(self.BLOCK_SIZE)]
+        blocks_per_disc = WbfsImage.WII_SECTORS_DOUBLE_LAYER * WbfsImage.WII_SECTOR_SIZE // self.BLOCK_SIZE
+        block_map = [1, 0, 2] + [0] * (blocks_per_disc - 3)
+
+        header = bytearray(self.BLOCK_SIZE)
+        header[:10] = struct.pack(">4sIBB", WbfsImage.MAGIC, 0, 9, self.BLOCK_SHIFT)
+        table = struct.pack(f">{blocks_per_disc}H", *block_map)
+        header[0x200 + WbfsImage.DISC_HEADER_COPY_SIZE:0x200 + WbfsImage.DISC_HEADER_COPY_SIZE + len(table)] = table
+        self.data = bytes(header) + b"".join(self.blocks)
+
+    def write_parts(self, *sizes: int) -> None:
+        offset = 0
+        for i, size in enumerate(sizes):
+            with open(self.path if i == 0 else self.path[:-1] + str(i), "wb") as f:
+                f.write(self.data[offset:offset + size])
+            offset += size
+
+    def read_disc(self) -> bytes:
+        with open_disc_image(self.path) as image:
+            return image.read_at(0, 3 * self.BLOCK_SIZE)
+
+    def test_single_file(self):
+        self.write_parts(len(self.data))
+        self.assertEqual(self.read_disc(), self.blocks[0] + bytes(self.BLOCK_SIZE) + self.blocks[1])
+
+    def test_split_parts(self):
+        # Split in the middle of the second stored block
+        self.write_parts(2 * self.BLOCK_SIZE + 1000, self.BLOCK_SIZE - 1000)
+        self.assertEqual(self.read_disc(), self.blocks[0] + bytes(self.BLOCK_SIZE) + self.blocks[1])
+
+    def test_missing_part(self):
+        self.write_parts(2 * self.BLOCK_SIZE + 1000)
+        with self.assertRaises(EOFError):
+            self.read_disc()
+
+
+class NasosImageTest(unittest.TestCase):
+    SECTORS = NasosImage.FORMATS[b"WII5"][1]
+    SIZE = SECTORS * NasosImage.WII_SECTOR_SIZE
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, "game.iso")
+        self.start_offset = NasosImage.FORMATS[b"WII5"][0]
+
+    def write_trimmed(self, stored_blocks: dict) -> None:
+        """Write a WII5 image that only stores the given {disc block: data} blocks."""
+        blocks_per_disc = self.SECTORS * NasosImage.BLOCKS_PER_SECTOR
+        table = bytearray(blocks_per_disc * 4)
+        for i, block in enumerate(sorted(stored_blocks)):
+            struct.pack_into(">I", table, block * 4, i + 1)
+        with open(self.path, "wb") as f:
+            f.write(b"WII5")
+            f.seek(self.start_offset - len(table))
+            f.write(table)
+            for block in sorted(stored_blocks):
+                f.write(stored_blocks[block])
+
+    def expected(self, stored_blocks: dict, offset: int, size: int) -> bytes:
+        disc = bytearray(offset + size)
+        for block, data in stored_blocks.items():
+            if block * NasosImage.BLOCK_SIZE < len(disc):
+                disc[block * NasosImage.BLOCK_SIZE:(block + 1) * NasosImage.BLOCK_SIZE] = data
+        return bytes(disc[offset:])
+
+    def test_complete_image(self):
+        disc_header = os.urandom(0x100)
+        with open(self.path, "wb") as f:
+            f.write(b"WII5")
+            f.seek(self.start_offset)
+            f.write(disc_header)
+            # Sparse, so this costs no space
+            f.truncate(self.start_offset + self.SIZE)
+        with open_disc_image(self.path) as image:
+            self.assertEqual(image.read_at(0, 0x100), disc_header)
+            self.assertEqual(image.size, self.SIZE)
+            self.assertEqual(list(image.data_ranges(0, self.SIZE)), [(0, self.SIZE)])
+
+    def test_trimmed_image(self):
+        per_sector = NasosImage.BLOCKS_PER_SECTOR
+        # The whole first sector, two blocks of the third and all of the fifth and sixth, the rest left out
+        stored_blocks = {block: os.urandom(NasosImage.BLOCK_SIZE) for block in
+                         [*range(per_sector), 2 * per_sector + 3, 2 * per_sector + 7, *range(4 * per_sector,
+                                                                                             6 * per_sector)]}
+        self.write_trimmed(stored_blocks)
+        with open_disc_image(self.path) as image:
+            self.assertEqual(image.size, self.SIZE)
+            disc_size = 7 * NasosImage.WII_SECTOR_SIZE
+            self.assertEqual(image.read_at(0, disc_size), self.expected(stored_blocks, 0, disc_size))
+            # Starting and ending in the middle of blocks
+            self.assertEqual(image.read_at(0x10123, 0x20000), self.expected(stored_blocks, 0x10123, 0x20000))
+            self.assertEqual(image.read_at(self.SIZE - 0x100, 0x100), bytes(0x100))
+
+            block = NasosImage.BLOCK_SIZE
+            sector = NasosImage.WII_SECTOR_SIZE
+            self.assertEqual(list(image.data_ranges(0, self.SIZE)), [
+                (0, sector),
+                (2 * sector + 3 * block, block),
+                (2 * sector + 7 * block, block),
+                (4 * sector, 2 * sector),
+            ])
+
+    def test_truncated_image(self):
+        self.write_trimmed({0: os.urandom(NasosImage.BLOCK_SIZE), 1: os.urandom(NasosImage.BLOCK_SIZE)})
+        with open(self.path, "r+b") as f:
+            f.truncate(self.start_offset + NasosImage.BLOCK_SIZE + 10)
+        with open_disc_image(self.path) as image:
+            image.read_at(0, NasosImage.BLOCK_SIZE)
+            with self.assertRaises(EOFError):
+                image.read_at(0, 2 * NasosImage.BLOCK_SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()
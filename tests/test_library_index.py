@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+from disc_header import DiscHeader
+from library_index import IndexedDisc, LibraryIndex
+from synthetic_disc import SyntheticDisc
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_truncated_wbfs(self):
+        header, error = LibraryIndex.probe(self.write("game.wbfs", b"WBFS\x00"))
+        self.assertIsNone(header)
+        self.assertIsNotNone(error)
+
+    def test_not_a_disc(self):
+        # The game type of a random file can be anything, including values that do not fit a signed 64 bit integer
+        data = SyntheticDisc.build_header("ABCDEF", "Not a disc", (1 << 64) - 1)
+        header, error = LibraryIndex.probe(self.write("notes.iso", data))
+        self.assertIsNone(header)
+        self.assertIsNotNone(error)
+
+    def test_scan(self):
+        SyntheticDisc.write_gamecube(os.path.join(self.temp_dir.name, "gc.iso"), 1 << 20)
+        SyntheticDisc.write_wii(os.path.join(self.temp_dir.name, "wii.iso"), 1 << 20)
+        self.write("notes.iso", SyntheticDisc.build_header("ABCDEF", "Not a disc", (1 << 64) - 1))
+        self.write("short.gcm", b"\x00" * 4)
+
+        for _ in range(2):
+            # The second scan reads everything back from the index
+            with LibraryIndex(os.path.join(self.temp_dir.name, "library.sqlite")) as index:
+                discs = index.scan([self.temp_dir.name])
+            self.assertEqual([os.path.basename(disc.path) for disc in discs], ["gc.iso", "wii.iso"])
+            self.assertEqual(discs[0].header.game_type, DiscHeader.GAMECUBE_GAME_TYPE)
+            self.assertEqual(discs[1].header.game_type, DiscHeader.WII_GAME_TYPE)
+
+
+class GroupDiscsTest(unittest.TestCase):
+    @staticmethod
+    def disc(path: str, game_type: int, disc_number: int) -> IndexedDisc:
+        return IndexedDisc(path, DiscHeader(0, game_type, "Game", "ABCD01", disc_number))
+
+    def test_gamecube_discs_are_paired(self):
+        disc_1 = self.disc("/games/a/disc1.iso", DiscHeader.GAMECUBE_GAME_TYPE, 0)
+        disc_2 = self.disc("/games/a/disc2.iso", DiscHeader.GAMECUBE_GAME_TYPE, 1)
+        other_copy = self.disc("/games/b/disc1.iso", DiscHeader.GAMECUBE_GAME_TYPE, 0)
+        orphan = self.disc("/games/c/disc2.iso", DiscHeader.GAMECUBE_GAME_TYPE, 1)
+        with self.assertLogs("library_index", "WARNING") as logs:
+            titles = LibraryIndex.group_discs([disc_2, other_copy, orphan, disc_1])
+        self.assertEqual(titles, [(disc_1, disc_2), (other_copy, None)])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(orphan.path, logs.output[0])
+
+    def test_wii_discs_stand_alone(self):
+        disc_1 = self.disc("/games/a/disc1.iso", DiscHeader.WII_GAME_TYPE, 0)
+        disc_2 = self.disc("/games/a/disc2.iso", DiscHeader.WII_GAME_TYPE, 1)
+        with self.assertNoLogs("library_index", "WARNING"):
+            titles = LibraryIndex.group_discs([disc_2, disc_1])
+        self.assertEqual(titles, [(disc_1, None), (disc_2, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from metrics import Metrics, MetricsExporter
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        Metrics.enable(self.temp_dir.name)
+        self.addCleanup(Metrics.disable)
+        # Start from empty totals, as a fresh process would
+        Metrics._pid = None
+        self.path = os.path.join(self.temp_dir.name, f"{os.getpid()}.json")
+
+    def test_updates_are_written_in_batches(self):
+        with mock.patch.object(Metrics, "FLUSH_INTERVAL", 60):
+            for _ in range(100):
+                Metrics.inc("stage_runs", stage="nfs")
+            self.assertFalse(os.path.exists(self.path))
+            Metrics.flush()
+        values, _ = Metrics.collect()
+        self.assertEqual(values[("stage_runs", (("stage", "nfs"),))], 100)
+
+    def test_timer_flushes(self):
+        with mock.patch.object(Metrics, "FLUSH_INTERVAL", 0.05):
+            Metrics.inc("stage_runs", stage="nfs")
+            deadline = time.monotonic() + 5
+            while not os.path.exists(self.path) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_exporter_reuses_collected_metrics(self):
+        exporter = MetricsExporter(self.temp_dir.name, max_age=60)
+        Metrics.inc("stage_runs", stage="nfs")
+        Metrics.flush()
+        with mock.patch.object(Metrics, "collect", wraps=Metrics.collect) as collect:
+            first = exporter.render()
+            Metrics.inc("stage_runs", stage="nfs")
+            Metrics.flush()
+            self.assertEqual(exporter.render(), first)
+            self.assertEqual(collect.call_count, 1)
+            self.assertIn('pywiiuinjector_stage_runs_total{stage="nfs"} 2', exporter.render(max_age=0))
+            self.assertEqual(collect.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from Crypto.Cipher import AES
+
+from config import Config
+from disc_image import open_disc_image
+from nfs_iso_converter import NfsIsoConverter, NfsReader
+from nus_downloader import NUSDownloader
+from synthetic_disc import SyntheticDisc
+from tools import Nfs2Iso2Nfs
+from wii_disc import WiiDisc
+
+KEY = bytes(range(16))
+DISC_SIZE = 2 << 20
+STAND_IN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark_tools",
+                             "nfs2iso2nfs")
+# The retail Wii common key. The synthetic Wii disc's partition only decrypts to the golden data with this one.
+WII_COMMON_KEY = "EBE42A225E8593E448D9C5457381AAF7"
+# SHA-256 of the NFS parts of SyntheticDisc's default discs of DISC_SIZE, converted with KEY
+GOLDEN_NFS = {
+    "gamecube": {"hif_000000.nfs": "7a92265c0ab85d4f0c1e43f0cf6bfa4e9ad39e8655940fc8755ebe5002927e00"},
+    "wii": {"hif_000000.nfs": "254f5bbb43c6494e55e298ee0cd539fec39915cd1565bd1d39d446db4ecc2c59"},
+}
+FIRMWARE_PATH = os.path.join(NUSDownloader.get_cache_dir(), NUSDownloader.RhythmHeavenFeverName, "code", "fw.img")
+
+
+class NativeWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.iso_path = os.path.join(self.temp_dir.name, "game.iso")
+        self.content_path = os.path.join(self.temp_dir.name, "content")
+
+    def convert(self, homebrew: bool) -> bytes:
+        with open_disc_image(self.iso_path) as f:
+            partitions = [] if homebrew else NfsIsoConverter.get_partition_keys(f)
+            NfsIsoConverter.write_nfs(f, f.size, self.content_path, KEY, partitions, processes=2)
+        with NfsReader(self.content_path, KEY) as reader:
+            return reader.read()
+
+    def test_gamecube(self):
+        SyntheticDisc.write_gamecube(self.iso_path, DISC_SIZE)
+        with open(self.iso_path, "rb") as f:
+            self.assertEqual(self.convert(True), f.read())
+
+    def test_wii(self):
+        SyntheticDisc.write_wii(self.iso_path, DISC_SIZE)
+        with open(self.iso_path, "rb") as f:
+            original = f.read()
+        stored = self.convert(False)
+        self.assertEqual(len(stored), len(original))
+        self.assertEqual(stored[0x61], 1)
+
+        with open_disc_image(self.iso_path) as f:
+            (start, end, title_key), = NfsIsoConverter.get_partition_keys(f)
+        self.assertEqual(stored[:0x61] + stored[0x62:start], original[:0x61] + original[0x62:start])
+        # Encrypting the stored partition again gives back the original clusters
+        for offset in range(start, end, NfsIsoConverter.BLOCK_SIZE):
+            cluster = stored[offset:offset + NfsIsoConverter.BLOCK_SIZE]
+            hashes = AES.new(title_key, AES.MODE_CBC, iv=bytes(16)).encrypt(cluster[:0x400])
+            body = AES.new(title_key, AES.MODE_CBC, iv=hashes[0x3D0:0x3E0]).encrypt(cluster[0x400:])
+            self.assertEqual(hashes + body, original[offset:offset + NfsIsoConverter.BLOCK_SIZE])
+
+
+def hash_nfs_parts(content_path: str):
+    digests = {}
+    for path in glob.glob(os.path.join(glob.escape(content_path), "hif_*.nfs")):
+        with open(path, "rb") as f:
+            digests[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+@mock.patch.object(Config, "WiiCommonKey", WII_COMMON_KEY)
+class GoldenTest(unittest.TestCase):
+    """The NFS parts of the synthetic discs must not change. ToolComparisonTest checks nfs2iso2nfs against them."""
+
+    def convert(self, write_disc, homebrew: bool):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            iso_path = os.path.join(temp_dir, "game.iso")
+            content_path = os.path.join(temp_dir, "content")
+            write_disc(iso_path, DISC_SIZE)
+            with open_disc_image(iso_path) as f:
+                partitions = [] if homebrew else NfsIsoConverter.get_partition_keys(f)
+                NfsIsoConverter.write_nfs(f, f.size, content_path, KEY, partitions, processes=2)
+            return hash_nfs_parts(content_path)
+
+    def test_gamecube(self):
+        self.assertEqual(self.convert(SyntheticDisc.write_gamecube, True), GOLDEN_NFS["gamecube"])
+
+    def test_wii(self):
+        self.assertEqual(self.convert(SyntheticDisc.write_wii, False), GOLDEN_NFS["wii"])
+
+
+class PlaceholderTest(unittest.TestCase):
+    def test_wii(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            iso_path = os.path.join(temp_dir, "game.iso")
+            placeholder_path = os.path.join(temp_dir, "placeholder.iso")
+            SyntheticDisc.write_wii(iso_path, DISC_SIZE)
+            with open_disc_image(iso_path) as f:
+                NfsIsoConverter.write_placeholder(f, placeholder_path, False)
+                partition, = WiiDisc.get_partitions(f)
+                f.seek(0)
+                original = f.read()
+
+            with open(placeholder_path, "rb") as f:
+                placeholder = f.read()
+                (moved,) = WiiDisc.get_partitions(f)
+            data_size = NfsIsoConverter.WII_PLACEHOLDER_CLUSTERS * NfsIsoConverter.BLOCK_SIZE
+            self.assertEqual(moved, partition._replace(offset=WiiDisc.HEADER_AREA_SIZE, data_size=data_size))
+            self.assertEqual(len(placeholder), moved.end)
+            self.assertEqual(placeholder[:WiiDisc.PARTITION_TABLE_OFFSET], original[:WiiDisc.PARTITION_TABLE_OFFSET])
+            # Same ticket, and the first clusters of the real partition
+            self.assertEqual(placeholder[moved.offset:moved.offset + 0x2A4],
+                             original[partition.offset:partition.offset + 0x2A4])
+            data_start = partition.offset + partition.data_offset
+            self.assertEqual(placeholder[moved.offset + moved.data_offset:],
+                             original[data_start:data_start + data_size])
+
+    def test_homebrew(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            iso_path = os.path.join(temp_dir, "game.iso")
+            placeholder_path = os.path.join(temp_dir, "placeholder.iso")
+            SyntheticDisc.write_gamecube(iso_path, DISC_SIZE)
+            with open_disc_image(iso_path) as f:
+                NfsIsoConverter.write_placeholder(f, placeholder_path, True)
+            with open(iso_path, "rb") as f, open(placeholder_path, "rb") as placeholder:
+                self.assertEqual(placeholder.read(), f.read(NfsIsoConverter.BLOCK_SIZE))
+
+
+class StandInTest(unittest.TestCase):
+    def test_output_is_readable(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            iso_path = os.path.join(temp_dir, "game.iso")
+            content_path = os.path.join(temp_dir, "content")
+            os.makedirs(content_path)
+            os.makedirs(os.path.join(temp_dir, "code"))
+            with open(os.path.join(temp_dir, "code", "htk.bin"), "wb") as f:
+                f.write(KEY)
+            SyntheticDisc.write_gamecube(iso_path, DISC_SIZE)
+
+            subprocess.run([sys.executable, STAND_IN_PATH, "-enc", "-homebrew", "-iso", iso_path], cwd=content_path,
+                           check=True)
+            with NfsReader(content_path, KEY) as reader, open(iso_path, "rb") as f:
+                self.assertEqual(reader.read(), f.read())
+
+
+@unittest.skipUnless(os.path.isfile(Nfs2Iso2Nfs.path) and os.path.isfile(FIRMWARE_PATH),
+                     "needs nfs2iso2nfs in tool_bin and the downloaded base files")
+class ToolComparisonTest(unittest.TestCase):
+    """The native writer must produce the same NFS parts and fw.img as nfs2iso2nfs."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def prepare(self, name: str, write_disc) -> str:
+        build_dir = os.path.join(self.temp_dir.name, name)
+        os.makedirs(os.path.join(build_dir, "content"))
+        os.makedirs(os.path.join(build_dir, "code"))
+        with open(os.path.join(build_dir, "code", "htk.bin"), "wb") as f:
+            f.write(KEY)
+        shutil.copyfile(FIRMWARE_PATH, os.path.join(build_dir, "code", "fw.img"))
+        write_disc(os.path.join(build_dir, "game.iso"), DISC_SIZE)
+        return build_dir
+
+    def read_outputs(self, build_dir: str):
+        outputs = {}
+        paths = glob.glob(os.path.join(glob.escape(build_dir), "content", "hif_*.nfs"))
+        for path in paths + [os.path.join(build_dir, "code", "fw.img")]:
+            with open(path, "rb") as f:
+                outputs[os.path.relpath(path, build_dir)] = f.read()
+        return outputs
+
+    def compare(self, name: str, write_disc, flags) -> None:
+        native_dir = self.prepare("native", write_disc)
+        tool_dir = self.prepare("tool", write_disc)
+        self.assertTrue(NfsIsoConverter.can_convert_natively(os.path.join(native_dir, "game.iso"), flags))
+
+        NfsIsoConverter.convert_iso_to_nfs(os.path.join(native_dir, "game.iso"), os.path.join(native_dir, "content"),
+                                           flags)
+        Nfs2Iso2Nfs.run([*flags, "-iso", os.path.join(tool_dir, "game.iso")],
+                        cwd=os.path.join(tool_dir, "content")).check_returncode()
+
+        native, tool = self.read_outputs(native_dir), self.read_outputs(tool_dir)
+        self.assertEqual(sorted(native), sorted(tool))
+        for path in tool:
+            self.assertTrue(native[path] == tool[path], f"{path} differs")
+        self.assertEqual(hash_nfs_parts(os.path.join(tool_dir, "content")), GOLDEN_NFS[name])
+
+    def test_gamecube(self):
+        self.compare("gamecube", SyntheticDisc.write_gamecube, ["-enc", "-homebrew", "-passthrough"])
+
+    @mock.patch.object(Config, "WiiCommonKey", WII_COMMON_KEY)
+    def test_wii(self):
+        self.compare("wii", SyntheticDisc.write_wii, ["-enc"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from http_stand_in import StandInFile, StandInServer
+from nus_client import NUSClient
+
+COMMON_KEY = bytes(16).hex()
+DATA = bytes(range(256)) * (3 * NUSClient.CHUNK_SIZE // 256)
+
+
+class IterRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.client = NUSClient(self.server.url, COMMON_KEY)
+        self.addCleanup(self.client.session.close)
+        sleep = mock.patch("nus_client.time.sleep")
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_resume_after_dropped_connection(self):
+        drop_after = NUSClient.CHUNK_SIZE + 123
+        self.server.files["/title/00000001"] = StandInFile(DATA, drop_after=drop_after)
+        self.assertEqual(self.client.get("title/00000001"), DATA)
+
+        # Resumes after the last chunk that was handed out, a partial chunk is fetched again
+        first, second = self.server.get_requests()
+        self.assertNotIn("Range", first.headers)
+        self.assertEqual(second.headers["Range"], f"bytes={NUSClient.CHUNK_SIZE}-")
+
+    def test_resume_within_range(self):
+        drop_after = NUSClient.CHUNK_SIZE
+        self.server.files["/title/00000001"] = StandInFile(DATA, drop_after=drop_after)
+        start, end = 1000, 2 * NUSClient.CHUNK_SIZE + 1000
+        self.assertEqual(b"".join(self.client._iter_range("title/00000001", start, end)), DATA[start:end])
+
+        first, second = self.server.get_requests()
+        self.assertEqual(first.headers["Range"], f"bytes={start}-{end - 1}")
+        self.assertEqual(second.headers["Range"], f"bytes={start + drop_after}-{end - 1}")
+
+    def test_range_ignored_by_server(self):
+        self.server.files["/title/00000001"] = StandInFile(DATA, ignore_range=True)
+        with self.assertRaises(IOError):
+            b"".join(self.client._iter_range("title/00000001", 0, 100))
+        self.assertEqual(len(self.server.get_requests()), 1)
+
+    def test_missing_file_is_not_retried(self):
+        with self.assertRaises(Exception):
+            self.client.get("title/00000002")
+        self.assertEqual(len(self.server.get_requests()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from Crypto.Cipher import AES
+
+from http_stand_in import StandInFile, StandInServer
+from nus_client import FstContent, NUSClient, Tmd
+from nus_packer import NUSPacker, PackedContent, PackedFile, _pack_content
+
+TITLE_KEY = bytes(range(16))
+COMMON_KEY = "00112233445566778899aabbccddeeff"
+TITLE_ID = 0x0005000010ABCD00
+
+
+class HashTreeTest(unittest.TestCase):
+    def pack(self, num_blocks: int, temp_dir: str) -> bytes:
+        data_size = num_blocks * NUSPacker.HASHED_DATA_SIZE
+        source = os.path.join(temp_dir, "data.bin")
+        with open(source, "wb") as f:
+            f.write(os.urandom(data_size))
+        content = PackedContent(1, True, 0, 0, 0, [PackedFile("data.bin", source, data_size, 0)], data_size)
+        _, tmd_hash, _ = _pack_content(content, TITLE_KEY, temp_dir)
+        return tmd_hash
+
+    def read_headers(self, temp_dir: str):
+        with open(os.path.join(temp_dir, "00000001.app"), "rb") as f:
+            block_index = 0
+            while True:
+                block = f.read(NUSPacker.HASHED_BLOCK_SIZE)
+                if not block:
+                    break
+                header = AES.new(TITLE_KEY, AES.MODE_CBC, iv=bytes(16)).decrypt(block[:NUSPacker.HASHED_HEADER_SIZE])
+                # Every block's data is encrypted with its own H0 hash as the IV
+                iv = header[block_index % 16 * 0x14:block_index % 16 * 0x14 + 0x10]
+                data = AES.new(TITLE_KEY, AES.MODE_CBC, iv=iv).decrypt(block[NUSPacker.HASHED_HEADER_SIZE:])
+                block_index += 1
+                yield header, data
+
+    def check_tree(self, num_blocks: int) -> None:
+        table_size = NUSPacker.HASH_TABLE_SIZE
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tmd_hash = self.pack(num_blocks, temp_dir)
+            headers = list(self.read_headers(temp_dir))
+            self.assertEqual(len(headers), num_blocks)
+
+            for block, (header, data) in enumerate(headers):
+                h0_table = header[:table_size]
+                h1_table = header[table_size:2 * table_size]
+                h2_table = header[2 * table_size:3 * table_size]
+                i = block % 16
+                self.assertEqual(h0_table[i * 0x14:(i + 1) * 0x14], hashlib.sha1(data).digest())
+                i = block // 16 % 16
+                self.assertEqual(h1_table[i * 0x14:(i + 1) * 0x14], hashlib.sha1(h0_table).digest())
+                i = block // 256 % 16
+                self.assertEqual(h2_table[i * 0x14:(i + 1) * 0x14], hashlib.sha1(h1_table).digest())
+
+            with open(os.path.join(temp_dir, "00000001.h3"), "rb") as f:
+                h3 = f.read()
+            self.assertEqual(h3[:0x14], hashlib.sha1(headers[0][0][2 * table_size:3 * table_size]).digest())
+            self.assertEqual(tmd_hash, hashlib.sha1(h3).digest())
+
+    def test_partial_h0_table(self):
+        self.check_tree(4)
+
+    def test_partial_h1_table(self):
+        self.check_tree(20)
+
+    def test_full_h0_table(self):
+        self.check_tree(16)
+
+
+class RoundTripTest(unittest.TestCase):
+    """Packs a small title and reads it back the way NUSClient reads titles off NUS."""
+
+    FILES = {
+        "/code/app.xml": f"""<?xml version="1.0" encoding="utf-8"?>
+<app type="complex" access="777">
+  <os_version type="hexBinary" length="8">000500101000400A</os_version>
+  <title_id type="hexBinary" length="8">{TITLE_ID:016X}</title_id>
+  <title_version type="hexBinary" length="4">00000000</title_version>
+  <group_id type="hexBinary" length="4">0000ABCD</group_id>
+</app>
+""".encode("utf-8"),
+        "/code/cos.xml": os.urandom(300),
+        "/code/fw.img": os.urandom(70000),
+        "/meta/meta.xml": os.urandom(500),
+        "/meta/iconTex.tga": os.urandom(0x10012),
+        "/content/hif_000000.nfs": os.urandom(3 * NUSPacker.HASHED_DATA_SIZE + 5),
+        "/content/hif_000001.nfs": os.urandom(100),
+    }
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        source_folder = os.path.join(self.temp_dir.name, "source")
+        for path, data in self.FILES.items():
+            os.makedirs(os.path.dirname(source_folder + path), exist_ok=True)
+            with open(source_folder + path, "wb") as f:
+                f.write(data)
+        certificate_chain = os.path.join(self.temp_dir.name, "title.cert")
+        with open(certificate_chain, "wb") as f:
+            f.write(bytes(0x100))
+
+        self.output_folder = os.path.join(self.temp_dir.name, "output")
+        self.packer = NUSPacker(source_folder, COMMON_KEY, TITLE_KEY)
+        self.contents = self.packer.layout_contents()
+        self.packer.pack(self.output_folder, certificate_chain, processes=2)
+
+    def read_output(self, name: str) -> bytes:
+        with open(os.path.join(self.output_folder, name), "rb") as f:
+            return f.read()
+
+    def test_tmd(self):
+        tmd = Tmd(self.read_output("title.tmd"))
+        self.assertEqual(tmd.title_id, TITLE_ID.to_bytes(8, byteorder="big"))
+        self.assertEqual(len(tmd.contents), len(self.contents) + 1)
+        for i, record in enumerate(tmd.contents):
+            self.assertEqual((record.id, record.index), (i, i))
+            data = self.read_output(f"{record.id:08X}.app")
+            self.assertEqual(record.size, len(data))
+            if record.hashed:
+                expected = hashlib.sha1(self.read_output(f"{record.id:08X}.h3")).digest()
+            else:
+                iv = record.index.to_bytes(2, byteorder="big") + bytes(14)
+                expected = hashlib.sha1(AES.new(TITLE_KEY, AES.MODE_CBC, iv=iv).decrypt(data)).digest()
+            self.assertEqual(record.hash, expected)
+
+    def test_files(self):
+        title_id = f"{TITLE_ID:016x}"
+        server = StandInServer()
+        tmd = Tmd(self.read_output("title.tmd"))
+        server.files[f"/{title_id}/tmd"] = StandInFile(self.read_output("title.tmd"))
+        server.files[f"/{title_id}/cetk"] = StandInFile(self.read_output("title.tik"))
+        for record in tmd.contents:
+            server.files[f"/{title_id}/{record.id:08x}"] = StandInFile(self.read_output(f"{record.id:08X}.app"))
+
+        with server:
+            client = NUSClient(server.url, COMMON_KEY)
+            fst = client.get_fst(title_id)
+            self.assertEqual(sorted(fst.files), sorted(self.FILES))
+            for path, data in self.FILES.items():
+                output_path = os.path.join(self.temp_dir.name, "download")
+                client.download_file(title_id, path, output_path)
+                with open(output_path, "rb") as f:
+                    self.assertTrue(f.read() == data, f"{path} differs")
+
+        fst_sectors = len(self.read_output("00000000.app")) // NUSPacker.SECTOR_SIZE
+        self.assertEqual(fst.contents[0], FstContent(0, fst_sectors, TITLE_ID, NUSPacker.GROUP_ID_CODE, 0))
+        self.assertEqual(len(fst.contents), len(tmd.contents))
+        offset = fst.contents[0].offset + (0 if fst_sectors == 1 else fst_sectors) + 2
+        for record, entry in zip(tmd.contents[1:], fst.contents[1:]):
+            sectors = record.size // NUSPacker.SECTOR_SIZE
+            content = self.contents[record.index - 1]
+            self.assertEqual(entry.offset, offset)
+            self.assertEqual(entry.size, sectors - (sectors // 64 + 1) * 2 if record.hashed else sectors)
+            self.assertEqual((entry.owner_title_id, entry.group_id), (TITLE_ID, content.group_id))
+            self.assertEqual(entry.hash_mode, 2 if record.hashed else 1)
+            offset += sectors
+
+
+if __name__ == "__main__":
+    unittest.main()
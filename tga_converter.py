@@ -1,52 +1,87 @@
+from typing import List, NamedTuple, Optional
+import hashlib
+import io
+import logging
 import os
+
 from PIL import Image
 
+from atomic_file import AtomicFile
+from config import Config
+from fast_copy import FastCopier
+
+logger = logging.getLogger(__name__)
+
+
+class TgaTarget(NamedTuple):
+    filename: str
+    width: int
+    height: int
+    bits_per_pixel: int
+
 
 class TgaConverter:
+    ICON = TgaTarget("iconTex.tga", 128, 128, 32)
+    TV_BANNER = TgaTarget("bootTvTex.tga", 1280, 720, 24)
+    DRC_BANNER = TgaTarget("bootDrcTex.tga", 854, 480, 24)
+    LOGO = TgaTarget("bootLogoTex.tga", 170, 42, 32)
+
+    MODES = {
+        8: "L",
+        24: "RGB",
+        32: "RGBA",
+    }
+
+    # Bump when a change here changes the rendered output
+    CACHE_VERSION = 1
 
     @staticmethod
-    def convert(img_path: str, output_filename: str, output_folder: str, width: int, height: int, bits_per_pixel: int) -> str:
-        im = Image.open(img_path)
-        resized = im.resize((width, height), Image.LANCZOS)
-
-        if bits_per_pixel == 24:
-            resized.mode = "RGB"
-        elif bits_per_pixel == 32:
-            resized.mode = "RGBA"
-        elif bits_per_pixel == 8:
-            resized.mode = "LA"
-        else:
-            raise ValueError(f"Don't know how to convert to {bits_per_pixel}bpp")
+    def get_cache_dir() -> str:
+        return os.path.join(Config.get_cache_dir(), "tga")
 
-        """
-        SAVE = {
-            "1": ("1", 1, 0, 3),
-            "L": ("L", 8, 0, 3),
-            "LA": ("LA", 16, 0, 3),
-            "P": ("P", 8, 1, 1),
-            "RGB": ("BGR", 24, 0, 2),
-            "RGBA": ("BGRA", 32, 0, 2),
-        }
-        rawmode, bits, colormaptype, imagetype = SAVE[im.mode]
-        """
+    @classmethod
+    def convert(cls, img_path: str, output_filename: str, output_folder: str, width: int, height: int,
+                bits_per_pixel: int) -> str:
+        target = TgaTarget(output_filename, width, height, bits_per_pixel)
+        return cls.convert_all(img_path, [target], output_folder)[0]
 
-        # Explicitly save uncompressed
-        output_path = os.path.join(output_folder, output_filename)
-        resized.save(output_path, compression=None)
+    @classmethod
+    def convert_all(cls, img_path: str, targets: List[TgaTarget], output_folder: str,
+                    cache_dir: Optional[str] = None) -> List[str]:
+        """Render img_path into every target, decoding it at most once.
 
+        Rendered TGAs are cached by the hash of the source image and the target size and depth, so the same artwork
+        is only ever rendered once.
         """
-        Png2Tga.run([
-            "-i",
-            os.path.abspath(img_path),
-            "-o",
-            os.path.abspath(output_folder),
-            f"--width={width}",
-            f"--height={height}",
-            f"--tga-bpp={bits_per_pixel}",
-            "--tga-compression=none"
-        ])
-
-        new_filename = os.path.splitext(os.path.basename(img_path))[0] + ".tga"
-        return os.path.abspath(os.path.join(output_folder, new_filename))
-        """
-        return output_path
+        cache_dir = cache_dir or cls.get_cache_dir()
+        with open(img_path, "rb") as f:
+            data = f.read()
+        source_hash = hashlib.sha256(data).hexdigest()
+
+        im = None
+        output_paths = []
+        for target in targets:
+            if target.bits_per_pixel not in cls.MODES:
+                raise ValueError(f"Don't know how to convert to {target.bits_per_pixel}bpp")
+
+            spec = f"{cls.CACHE_VERSION}:{source_hash}:{target.width}x{target.height}x{target.bits_per_pixel}"
+            key = hashlib.sha256(spec.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(cache_dir, key[:2], key + ".tga")
+            output_path = os.path.join(output_folder, target.filename)
+
+            if not os.path.isfile(cache_path):
+                if im is None:
+                    im = Image.open(io.BytesIO(data))
+                    im = im.convert("RGBA" if "A" in im.getbands() or "transparency" in im.info else "RGB")
+                logger.debug(f"Rendering {target.filename} ({target.width}x{target.height}) from {img_path}")
+                resized = im.resize((target.width, target.height), Image.LANCZOS)
+                resized = resized.convert(cls.MODES[target.bits_per_pixel])
+                with AtomicFile(cache_path, suffix=".tga") as f:
+                    # Explicitly save uncompressed
+                    resized.save(f, format="TGA", compression=None)
+
+            FastCopier.link(cache_path, output_path, allow_symlink=False)
+            output_paths.append(output_path)
+
+        return output_paths
+
@@ -1,7 +1,13 @@
-from typing import Any, Type, List
+from typing import Any, Dict, Type, List
+import os
 import pathlib
 import subprocess
 import logging
+import tempfile
+import time
+
+from metrics import Metrics
+from tracing import Tracer
 
 logger = logging.getLogger(__name__)
 
@@ -22,22 +28,72 @@ class Tool:
 
     def _run(self, args: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
         logger.info(f"Running {' '.join(args)}")
-        p = subprocess.run(args, **kwargs, capture_output=True)
+        start_time = time.monotonic()
+        with Tracer.span(os.path.basename(self.path), "tool", measure_io=False, args=args) as span_args:
+            # Output goes to files rather than pipes, so nothing needs reading while the tool runs and it can be
+            # reaped by wait_with_rusage
+            with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+                process = subprocess.Popen(args, **kwargs, stdout=stdout_file, stderr=stderr_file)
+                rusage = self.wait_with_rusage(process)
+                stdout_file.seek(0)
+                stdout = stdout_file.read()
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+            if rusage is not None:
+                usage = self.get_rusage_args(rusage)
+                span_args.update(usage)
+                logger.debug(f"{os.path.basename(self.path)} used {usage['cpu_user'] + usage['cpu_system']:.1f}s CPU, "
+                             f"{usage['max_rss'] / 2**20:.1f} MiB max RSS")
+        Metrics.observe("tool_duration_seconds", time.monotonic() - start_time, tool=os.path.basename(self.path))
+        Metrics.progress()
+        p = subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
         if p.stdout:
             logger.debug(f'stdout: {p.stdout.decode("utf-8", errors="replace")}')
         if p.stderr:
             logger.debug(f'stderr: {p.stderr.decode("utf-8", errors="replace")}')
         return p
 
+    @staticmethod
+    def wait_with_rusage(process: subprocess.Popen) -> Any:
+        """Wait for process to exit and return its own resource usage, or None where that isn't available."""
+        if not hasattr(os, "wait4"):
+            process.wait()
+            return None
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Already reaped elsewhere, e.g. with SIGCHLD ignored, which wait() knows how to deal with
+            process.wait()
+            return None
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return rusage
+
+    @staticmethod
+    def get_rusage_args(rusage: Any) -> Dict[str, Any]:
+        # ru_maxrss is in KiB on Linux, and block counts are in 512 byte units
+        return {
+            "cpu_user": rusage.ru_utime,
+            "cpu_system": rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss * 1024,
+            "read_bytes": rusage.ru_inblock * 512,
+            "written_bytes": rusage.ru_oublock * 512,
+        }
+
+    def use_stand_in(self, path: str) -> None:
+        """Run path in place of the real tool from now on, e.g. a stand-in script for benchmarks."""
+        self.path = os.path.abspath(path)
+        self.directory = os.path.dirname(self.path)
+
+    def get_args(self, args: List[str]) -> List[str]:
+        return [self.path] + args
+
     def run(self, args: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
-        complete_args = [self.path] + args
-        return self._run(complete_args, **kwargs)
+        return self._run(self.get_args(args), **kwargs)
 
 
 class JarTool(Tool):
-    def run(self, args: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
-        complete_args = ["java", "-jar", self.path] + args
-        return self._run(complete_args, **kwargs)
+    def get_args(self, args: List[str]) -> List[str]:
+        return ["java", "-jar", self.path] + args
 
 
 # C2W_Patcher = Tool.get_tool("C2W", "c2w_patcher.exe")
@@ -47,8 +103,8 @@ Nfs2Iso2Nfs = Tool.get_tool("nfs2iso2nfs", "nfs2iso2nfs")
 # WBFS_File = Tool.get_tool("EXE", "wbfs_file")
 # WiiVMC = Tool.get_tool("EXE", "wii-vmc")
 
-JNUSTool = JarTool.get_tool("JNUSTool", "jnustool.jar")
-NUSPacker = Tool.get_tool("CNUS_Packer", "CNUSPACKER")
+# JNUSTool = JarTool.get_tool("JNUSTool", "jnustool.jar")
+# NUSPacker = Tool.get_tool("CNUS_Packer", "CNUSPACKER")
 # Wav2Btsnd = Tool.get_tool("JAR", "wav2btsnd")
 
 # NKit2ISO = Tool.get_tool("NKIT", "ConvertToISO")
@@ -0,0 +1,161 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import contextlib
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """Records spans as Chrome trace_event "complete" events, from every process of a batch.
+
+    Each process appends its events to its own file in a shared trace directory, which worker processes find through
+    an environment variable, so nothing needs to be sent back to the parent. export() merges them into one trace for
+    chrome://tracing or Perfetto. Spans are free when tracing is off.
+    """
+    ENV_VAR = "PYWIIUINJECTOR_TRACE_DIR"
+
+    _lock = threading.Lock()
+    _fd: Optional[int] = None
+    _fd_pid: Optional[int] = None
+    _named_tracks: Dict[Tuple[int, int], str] = {}
+
+    @classmethod
+    def enable(cls, trace_dir: str) -> None:
+        os.makedirs(trace_dir, exist_ok=True)
+        # Inherited by every process started from here on
+        os.environ[cls.ENV_VAR] = os.path.abspath(trace_dir)
+
+    @classmethod
+    def disable(cls) -> None:
+        os.environ.pop(cls.ENV_VAR, None)
+        with cls._lock:
+            fd = cls._fd if cls._fd_pid == os.getpid() else None
+            cls._fd = None
+            cls._fd_pid = None
+        if fd is not None:
+            os.close(fd)
+
+    @classmethod
+    def get_trace_dir(cls) -> Optional[str]:
+        return os.environ.get(cls.ENV_VAR)
+
+    @staticmethod
+    def now() -> int:
+        # The monotonic clock is shared by all processes, so their timestamps line up
+        return time.monotonic_ns() // 1000
+
+    @staticmethod
+    def read_thread_io() -> Optional[Tuple[int, int]]:
+        """Bytes the calling thread has read and written so far, where the OS keeps count."""
+        try:
+            with open("/proc/thread-self/io", "r") as f:
+                counters = dict(line.split(": ") for line in f.read().splitlines())
+            return int(counters["rchar"]), int(counters["wchar"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @classmethod
+    def record(cls, event: Dict[str, Any]) -> None:
+        trace_dir = cls.get_trace_dir()
+        if trace_dir is None:
+            return
+        line = (json.dumps(event) + "\n").encode("utf-8")
+        with cls._lock:
+            # A forked worker inherits the parent's file, but must write to a file of its own
+            fd = cls._fd if cls._fd_pid == os.getpid() else None
+        if fd is None:
+            new_fd = os.open(os.path.join(trace_dir, f"{os.getpid()}.jsonl"), os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                             0o644)
+            with cls._lock:
+                if cls._fd_pid != os.getpid():
+                    cls._fd = new_fd
+                    cls._fd_pid = os.getpid()
+                fd = cls._fd
+            if fd != new_fd:
+                # Another thread got there first
+                os.close(new_fd)
+        # One write per event to a file opened for appending, so events of concurrent threads never interleave
+        os.write(fd, line)
+
+    @classmethod
+    def _name_track(cls, pid: int, tid: int, name: str) -> None:
+        if cls._named_tracks.get((pid, tid)) == name:
+            return
+        cls._named_tracks[(pid, tid)] = name
+        cls.record({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name: str, category: str, track: Optional[str] = None, measure_io: bool = True,
+             **args: Any) -> Iterator[Dict[str, Any]]:
+        """Time the body as one span. Yields its args, for the body to add what it learns along the way.
+
+        Spans normally show on the track of the thread they run in. Spans given a track name, e.g. a title, show on
+        a track of that name instead, as long as they don't overlap on it.
+        """
+        if cls.get_trace_dir() is None:
+            yield dict(args)
+            return
+
+        args = dict(args)
+        io_start = cls.read_thread_io() if measure_io else None
+        start = cls.now()
+        try:
+            yield args
+        finally:
+            end = cls.now()
+            if io_start is not None:
+                io_end = cls.read_thread_io()
+                if io_end is not None:
+                    args.setdefault("read_bytes", io_end[0] - io_start[0])
+                    args.setdefault("written_bytes", io_end[1] - io_start[1])
+
+            pid = os.getpid()
+            if track is None:
+                tid = threading.get_ident()
+                cls._name_track(pid, tid, threading.current_thread().name)
+            else:
+                tid = zlib.crc32(track.encode("utf-8"))
+                cls._name_track(pid, tid, track)
+            cls.record({"name": name, "cat": category, "ph": "X", "ts": start, "dur": end - start, "pid": pid,
+                        "tid": tid, "args": args})
+
+    @classmethod
+    def traced(cls, category: str) -> Callable[[Callable], Callable]:
+        """Decorator that records every call of a function as a span named after it."""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with cls.span(func.__name__, category):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def export(cls, output_path: str, trace_dir: Optional[str] = None) -> int:
+        """Merge the events of every process into one Chrome trace_event JSON file. Returns the number of events."""
+        trace_dir = trace_dir or cls.get_trace_dir()
+        events: List[Dict[str, Any]] = []
+        for path in sorted(glob.glob(os.path.join(glob.escape(trace_dir), "*.jsonl"))):
+            pid = int(os.path.splitext(os.path.basename(path))[0])
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                           "args": {"name": "main" if pid == os.getpid() else f"worker {pid}"}})
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # Cut short by a worker that was killed mid-write
+                        pass
+
+        with open(output_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info(f"Wrote {len(events)} trace events to {output_path}")
+        return len(events)
@@ -0,0 +1,105 @@
+from typing import BinaryIO, List, NamedTuple
+import logging
+import os
+import struct
+import time
+
+from disc_image import DiscImage, IsoImage, copy_disc_range, open_disc_image
+
+logger = logging.getLogger(__name__)
+
+
+class WiiPartition(NamedTuple):
+    offset: int
+    type: int
+    data_offset: int
+    data_size: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.data_offset + self.data_size
+
+
+class WiiDisc:
+    PARTITION_TABLE_OFFSET = 0x40000
+    # Everything up to here (disc header, partition table, region settings) is kept as is
+    HEADER_AREA_SIZE = 0x50000
+
+    PARTITION_TYPE_DATA = 0
+    PARTITION_TYPE_UPDATE = 1
+
+    COPY_CHUNK_SIZE = 1 << 24
+
+    @classmethod
+    def get_partitions(cls, f: BinaryIO) -> List[WiiPartition]:
+        partitions = []
+        f.seek(cls.PARTITION_TABLE_OFFSET)
+        groups = struct.unpack(">8I", f.read(32))
+        for count, table_offset in zip(groups[::2], groups[1::2]):
+            f.seek(table_offset << 2)
+            entries = [struct.unpack(">II", f.read(8)) for _ in range(count)]
+            for partition_offset, partition_type in entries:
+                partition_offset <<= 2
+                f.seek(partition_offset + 0x2B8)
+                data_offset, data_size = struct.unpack(">II", f.read(8))
+                partitions.append(WiiPartition(partition_offset, partition_type, data_offset << 2, data_size << 2))
+        return partitions
+
+    @classmethod
+    def build_partition_table(cls, partitions: List[WiiPartition]) -> bytes:
+        # A single group whose entries directly follow the group table
+        table_offset = cls.PARTITION_TABLE_OFFSET + 0x20
+        table = struct.pack(">II", len(partitions), table_offset >> 2).ljust(0x20, b"\x00")
+        for partition in partitions:
+            table += struct.pack(">II", partition.offset >> 2, partition.type)
+        return table
+
+    @classmethod
+    def rewrite(cls, source_iso: str, output_iso: str) -> str:
+        """Write a copy of source_iso that only contains its data partitions.
+
+        The partitions are copied verbatim, still encrypted and at their original offsets, so this is a single
+        sequential copy of the data that is kept. Everything else (update partition, channels) is left as holes, as
+        are blocks that the source image (e.g. WBFS) marks as unused.
+        """
+        start_time = time.monotonic()
+        with open_disc_image(source_iso) as src, open(output_iso, "wb") as dst:
+            partitions = [p for p in cls.get_partitions(src) if p.type == cls.PARTITION_TYPE_DATA]
+            if not partitions:
+                raise ValueError(f"{source_iso} does not contain a data partition")
+
+            src.seek(0)
+            header = bytearray(src.read(cls.HEADER_AREA_SIZE))
+            table = cls.build_partition_table(partitions)
+            header[cls.PARTITION_TABLE_OFFSET:cls.PARTITION_TABLE_OFFSET + len(table)] = table
+            header[cls.PARTITION_TABLE_OFFSET + len(table):cls.PARTITION_TABLE_OFFSET + 0x100] = \
+                bytes(0x100 - len(table))
+            dst.write(header)
+            dst.flush()
+
+            copied = 0
+            for partition in partitions:
+                copied += cls._copy_range(src, dst, partition.offset, partition.end - partition.offset)
+            dst.truncate(max(p.end for p in partitions))
+
+        elapsed = max(time.monotonic() - start_time, 1e-9)
+        logger.info(f"Copied {copied / 2**20:.1f} MiB of partition data in {elapsed:.1f}s "
+                    f"({copied / 2**20 / elapsed:.1f} MB/s)")
+        return output_iso
+
+    @classmethod
+    def _copy_range(cls, src: DiscImage, dst: BinaryIO, offset: int, size: int) -> int:
+        if isinstance(src, IsoImage) and hasattr(os, "copy_file_range"):
+            try:
+                remaining = size
+                while remaining > 0:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), remaining, offset + size - remaining,
+                                           offset + size - remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+                return size - remaining
+            except OSError:
+                logger.debug("copy_file_range unsupported, copying normally")
+
+        return copy_disc_range(src, dst, offset, size, cls.COPY_CHUNK_SIZE)
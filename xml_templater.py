@@ -1,37 +1,75 @@
-from typing import Any, Dict
-from jinja2 import Environment, meta, FileSystemLoader, Template
+from typing import Any, Dict, FrozenSet, Optional
+from jinja2 import Environment, FileSystemBytecodeCache, meta, FileSystemLoader, Template
+import argparse
+import functools
+import glob
 import os
 
+from config import Config
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
 
 class XMLTemplate:
+    # One environment per process, so every template is only compiled once no matter how many titles get built
+    _environment: Optional[Environment] = None
 
     def __init__(self, filename: str):
         self.filename = filename
-        self.env = Environment(
-            loader=FileSystemLoader(os.path.dirname(os.path.abspath(__file__))),
-            autoescape=True
-        )
+
+    @staticmethod
+    def get_bytecode_cache_dir() -> str:
+        return os.path.join(Config.get_cache_dir(), "templates")
+
+    @classmethod
+    def get_environment(cls) -> Environment:
+        if cls._environment is None:
+            bytecode_cache_dir = cls.get_bytecode_cache_dir()
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            cls._environment = Environment(
+                # Absolute, so templates load the same from any working directory
+                loader=FileSystemLoader(project_root),
+                bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir),
+                autoescape=True
+            )
+        return cls._environment
 
     @property
     def template(self) -> Template:
-        return self.env.get_template(self.filename)
+        return self.get_environment().get_template(self.filename)
 
     def generate(self, **kwargs: Any) -> str:
-        missing = set(self.get_kwargs()) - set(kwargs.keys())
+        missing = self.get_variables(self.filename) - set(kwargs.keys())
         if len(missing) > 0:
             raise ValueError(f"Missing kwargs: {missing}")
         return self.template.render(**kwargs)
 
     def get_kwargs(self) -> Dict[str, Any]:
-        with open(self.filename, "r") as f:
-            source = f.read()
-        parsed_content = self.env.parse(source)
-        return {k: None for k in meta.find_undeclared_variables(parsed_content)}
+        return {k: None for k in self.get_variables(self.filename)}
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def get_variables(cls, filename: str) -> FrozenSet[str]:
+        env = cls.get_environment()
+        source, _, _ = env.loader.get_source(env, filename)
+        return frozenset(meta.find_undeclared_variables(env.parse(source)))
+
+    @classmethod
+    def precompile(cls) -> None:
+        """Compile every template into the bytecode cache, e.g. at install time."""
+        for path in glob.glob(os.path.join(project_root, "*.template")):
+            cls.get_environment().get_template(os.path.basename(path))
 
-if __name__ == "__main__":
-    template = XMLTemplate("meta.xml.template")
-    a = template.get_kwargs()
-    print(template.generate(**a))
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render or precompile the XML templates.")
+    parser.add_argument("--precompile", action="store_true",
+                        help="Compile all templates into the bytecode cache and exit.")
+    args = parser.parse_args()
 
+    if args.precompile:
+        XMLTemplate.precompile()
+    else:
+        template = XMLTemplate("meta.xml.template")
+        a = template.get_kwargs()
+        print(template.generate(**a))